@@ -0,0 +1,91 @@
+import numpy as np
+import SimpleITK as sitk
+from scipy import ndimage
+
+from CIP.logic.FastMarchingFronts import FastMarchingFronts
+
+SPACING = (0.7, 0.8, 1.3)
+
+
+def create_volume(shape=(50, 60, 55), seed=0):
+    """ Random "air" regions (-1000) over soft tissue (40)
+    """
+    rng = np.random.RandomState(seed)
+    air = ndimage.binary_dilation(rng.rand(*shape) < 0.02, iterations=2) | (rng.rand(*shape) < 0.3)
+    return np.where(air, -1000, 40).astype(np.int16)
+
+
+def reference_fronts(volume, fronts, speedThreshold=-800):
+    """ Original implementation: every front marches over the whole volume
+    :return: numpy array with the shape of the volume
+    """
+    speedMap = sitk.GetImageFromArray((volume < speedThreshold).astype(np.int32))
+    speedMap.SetSpacing(SPACING)
+    fastMarchingFilter = sitk.FastMarchingImageFilter()
+    result = np.zeros(volume.shape, np.float32)
+    for seed, stoppingValue in fronts:
+        fastMarchingFilter.SetStoppingValue(stoppingValue)
+        fastMarchingFilter.SetTrialPoints([list(seed)])
+        arrivalTimes = sitk.GetArrayFromImage(fastMarchingFilter.Execute(speedMap))
+        distances = np.zeros(volume.shape, np.float32)
+        reached = arrivalTimes <= stoppingValue
+        distances[reached] = stoppingValue - arrivalTimes[reached]
+        result += distances
+    return result
+
+
+def run_full(fastMarchingFronts, fronts):
+    """ Result of FastMarchingFronts.run pasted in an array with the shape of the volume
+    """
+    box, distances = fastMarchingFronts.run(fronts)
+    result = np.zeros(fastMarchingFronts.volumeArray.shape, np.float32)
+    result[box] = distances
+    return result
+
+
+def random_fronts(rng, shape, count=3):
+    return [((rng.randint(shape[2]), rng.randint(shape[1]), rng.randint(shape[0])), float(rng.uniform(5, 25)))
+            for _ in range(count)]
+
+
+def test_fast_marching_fronts_roi_equals_full_volume():
+    """ The fronts that march over a box around their seeds give the same result as the fronts that march over the
+    whole volume (with one or several threads)
+    """
+    volume = create_volume()
+    rng = np.random.RandomState(1)
+    for _ in range(3):
+        fronts = random_fronts(rng, volume.shape)
+        expected = reference_fronts(volume, fronts)
+        for roiMode in (True, False):
+            for numThreads in (1, 3):
+                fastMarchingFronts = FastMarchingFronts(volume, SPACING, roiMode=roiMode, numThreads=numThreads,
+                                                        cacheStoppingFactor=1)
+                assert np.array_equal(run_full(fastMarchingFronts, fronts), expected)
+
+
+def test_fast_marching_fronts_roi_box():
+    """ In ROI mode the result only covers the region around the seeds
+    """
+    volume = create_volume()
+    box, distances = FastMarchingFronts(volume, SPACING).run([((10, 10, 10), 5.0)])
+    assert distances.shape == volume[box].shape
+    assert distances.size < volume.size
+    box, distances = FastMarchingFronts(volume, SPACING, roiMode=False).run([((10, 10, 10), 5.0)])
+    assert distances.shape == volume.shape
+
+
+def test_fast_marching_fronts_cache():
+    """ Reusing the cached fronts (moving one seed, changing the stopping values) gives the same result as running all
+    the fronts again
+    """
+    volume = create_volume(seed=2)
+    rng = np.random.RandomState(3)
+    fastMarchingFronts = FastMarchingFronts(volume, SPACING)
+    fronts = random_fronts(rng, volume.shape)
+    for _ in range(6):
+        assert np.array_equal(run_full(fastMarchingFronts, fronts), reference_fronts(volume, fronts))
+        # Move one of the seeds and change all the stopping values
+        fronts[rng.randint(len(fronts))] = random_fronts(rng, volume.shape, 1)[0]
+        fronts = [(seed, stoppingValue * rng.uniform(0.8, 1.2)) for seed, stoppingValue in fronts]
+    assert len(fastMarchingFronts.__cache__) <= FastMarchingFronts.CACHE_SIZE
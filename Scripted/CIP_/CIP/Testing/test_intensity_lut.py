@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from CIP.logic.IntensityLUT import IntensityLUT
+
+
+def create_ct(shape=(20, 30, 40), dtype=np.int16, minimum=None, maximum=None, seed=0):
+    """ Random volume (by default it covers the whole range of the type)
+    """
+    info = np.iinfo(dtype)
+    minimum = info.min if minimum is None else minimum
+    maximum = info.max if maximum is None else maximum
+    return np.random.RandomState(seed).randint(minimum, maximum + 1, size=shape).astype(dtype)
+
+
+def test_linear_equals_direct_arithmetic():
+    """ Calibration table vs the direct computation on the volume (values inside the int16 range)
+    """
+    ct = create_ct(minimum=-1024, maximum=3071)
+    for slope, intercept in ((1.0, 0.0), (1.02, 5.3), (0.97, -12.6), (-1.1, 2.0)):
+        expected = (ct * slope + intercept).astype(np.int16)
+        assert np.array_equal(IntensityLUT.linear(slope, intercept).apply(ct), expected)
+
+
+def test_linear_clip():
+    """ Values out of the range of the output type are saturated
+    """
+    for dtype in (np.int16, np.uint16, np.int8, np.uint8):
+        ct = create_ct(dtype=dtype)
+        for outputDtype in (np.int16, np.uint8):
+            info = np.iinfo(outputDtype)
+            expected = np.clip(ct * 2.5 - 100, info.min, info.max).astype(outputDtype)
+            result = IntensityLUT.linear(2.5, -100, inputDtype=dtype, outputDtype=outputDtype).apply(ct)
+            assert result.dtype == outputDtype
+            assert np.array_equal(result, expected)
+
+
+def test_window_equals_direct_arithmetic():
+    """ Window table vs the float32 computation used in the parenchyma analysis
+    """
+    ct = create_ct()
+    for minimum, maximum in ((-1024, 3071), (-1000, -500), (-1350, 150)):
+        expected = np.clip(ct, minimum, maximum).astype(np.float32)
+        expected -= minimum
+        expected *= 255.0 / (maximum - minimum)
+        result = IntensityLUT.window(minimum, maximum).apply(ct)
+        assert result.dtype == np.float32
+        assert np.array_equal(result, expected)
+
+
+def test_non_contiguous_arrays():
+    """ Sliced and transposed volumes, as input and as output
+    """
+    ct = create_ct((30, 40, 50), minimum=-1024, maximum=3071)
+    lut = IntensityLUT.linear(1.02, 5)
+    for view in (ct[::2, 3:, ::-1], ct.transpose(2, 0, 1), ct[:, 5, :], np.asfortranarray(ct)):
+        expected = (view * 1.02 + 5).astype(np.int16)
+        assert np.array_equal(lut.apply(view), expected)
+        out = np.empty(view.shape[::-1], np.int16).T
+        assert lut.apply(view, out=out) is out
+        assert np.array_equal(out, expected)
+
+
+def test_apply_in_place():
+    """ The transform can be written on the input volume, also when it is bigger than a chunk
+    """
+    ct = create_ct((10, 100, 100), minimum=-1024, maximum=3071)
+    expected = (ct * 0.5 + 10).astype(np.int16)
+    assert ct.size > IntensityLUT.CHUNK_SIZE
+    result = IntensityLUT.linear(0.5, 10).apply(ct, out=ct)
+    assert result is ct
+    assert np.array_equal(ct, expected)
+
+
+def test_errors():
+    with pytest.raises(ValueError):
+        IntensityLUT(lambda v: v, np.float32)
+    lut = IntensityLUT.linear(1, 0)
+    with pytest.raises(ValueError):
+        lut.apply(np.zeros(10, np.uint16))
+    with pytest.raises(ValueError):
+        lut.apply(np.zeros(10, np.int16), out=np.zeros(10, np.float32))
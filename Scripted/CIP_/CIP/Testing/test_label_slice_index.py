@@ -0,0 +1,97 @@
+import numpy as np
+
+from CIP.logic.LabelSliceIndex import LabelSliceIndex
+
+
+def create_labelmap(shape=(30, 20, 25), labels=(1, 2, 5, 300), seed=0):
+    """ Sparse labelmap with some empty slices
+    """
+    rng = np.random.RandomState(seed)
+    labelmap = np.zeros(shape, np.int32)
+    voxels = rng.rand(*shape) < 0.01
+    labelmap[voxels] = rng.choice(labels, size=int(voxels.sum()))
+    labelmap[5:9] = 0
+    return labelmap
+
+
+def brute_force_counts(labelmap):
+    """ Dictionary of [label: number of voxels in every slice], counted slice by slice
+    """
+    counts = {}
+    for label in np.unique(labelmap):
+        if label != 0:
+            counts[label] = np.array([np.sum(labelmap[z] == label) for z in range(labelmap.shape[0])])
+    return counts
+
+
+def check_index(index, labelmap):
+    counts = brute_force_counts(labelmap)
+    assert index.labels == sorted(counts)
+    for label, labelCounts in counts.items():
+        assert np.array_equal(index.__counts__[:, index.__labels__.index(label)], labelCounts)
+        assert np.array_equal(index.getSlices(label), np.flatnonzero(labelCounts))
+        assert label in index
+    assert np.array_equal(index.getSlices(), np.flatnonzero(labelmap.reshape(labelmap.shape[0], -1).any(axis=1)))
+    # Labels that were removed from the labelmap
+    for label in set(index.__labels__) - set(counts):
+        assert not index.__counts__[:, index.__labels__.index(label)].any()
+        assert label not in index
+        assert len(index.getSlices(label)) == 0
+
+
+def test_label_slice_index_equals_brute_force():
+    for labels in ((1, 2, 5, 300), (1, 70000), (-3, 4)):
+        labelmap = create_labelmap(labels=labels)
+        index = LabelSliceIndex(labelmap)
+        check_index(index, labelmap)
+        # Same result as the original Util.get_labelmap_slices (labels > 0)
+        expected = dict((label, np.unique(np.where(labelmap == label)[0])) for label in labels if label > 0)
+        result = index.toDictionary()
+        for label in expected:
+            assert np.array_equal(result[label], expected[label])
+
+
+def test_label_slice_index_empty():
+    index = LabelSliceIndex(np.zeros((4, 3, 3), np.uint8))
+    assert index.labels == []
+    assert len(index.getSlices()) == 0
+    assert index.nextSlice(1) is None and index.previousSlice(1) is None
+
+
+def test_label_slice_index_update_slice():
+    """ Edits of single slices vs rebuilding the index from scratch
+    """
+    rng = np.random.RandomState(1)
+    labelmap = create_labelmap()
+    index = LabelSliceIndex(labelmap)
+    for _ in range(30):
+        z = rng.randint(labelmap.shape[0])
+        operation = rng.randint(3)
+        if operation == 0:
+            labelmap[z] = 0
+        elif operation == 1:
+            labelmap[z, rng.randint(20), :] = rng.choice([1, 2, 7])
+        else:
+            labelmap[z][labelmap[z] == rng.choice([1, 2, 5, 300])] = 0
+        index.updateSlice(z, labelmap[z])
+        check_index(index, labelmap)
+
+
+def test_label_slice_index_next_previous_slice():
+    """ Navigation vs a linear search over the slices
+    """
+    labelmap = create_labelmap()
+    index = LabelSliceIndex(labelmap)
+    for label in (None, 1, 300):
+        slices = index.getSlices(label).tolist()
+        for position in np.arange(-1, labelmap.shape[0] + 1, 0.5):
+            for tolerance in (0, 2):
+                after = [s for s in slices if s > position + tolerance]
+                before = [s for s in slices if s < position - tolerance]
+                assert index.nextSlice(position, label, tolerance) == (after[0] if after else slices[0])
+                assert index.previousSlice(position, label, tolerance) == (before[-1] if before else slices[-1])
+                assert index.nextSlice(position, label, tolerance, continuous=False) == \
+                    (after[0] if after else None)
+                assert index.previousSlice(position, label, tolerance, continuous=False) == \
+                    (before[-1] if before else None)
+    assert index.nextSlice(0, label=1000) is None
@@ -0,0 +1,166 @@
+import numpy as np
+import SimpleITK as sitk
+from scipy import ndimage
+
+from CIP.logic.lung_splitter import LungSplitter
+
+
+class ReferenceLungSplitter(object):
+    """ Original implementation of LungSplitter (one SimpleITK connected components call per 2D cut), used to check
+    that the slice-batched engine gives exactly the same labelmaps
+    """
+    def __init__(self, split_thirds=False):
+        self.split_thirds = split_thirds
+        self.size_th = 0.05
+        self.RightLabel = 2
+        self.LeftLabel = 3
+        self.WholeLung = 1
+        self.UpperThird = 20
+        self.MiddleThrid = 21
+        self.LowerThird = 22
+        self.LeftUpperThird = 9
+        self.LeftMiddleThird = 10
+        self.LeftLowerThrid = 11
+        self.RightUpperThird = 12
+        self.RightMiddleThrid = 13
+        self.RightLowerThrid = 14
+        self.cc_f = sitk.ConnectedComponentImageFilter()
+        self.r_f = sitk.RelabelComponentImageFilter()
+        self.ls = sitk.LabelShapeStatisticsImageFilter()
+
+    def execute(self, lm):
+        lm_np = sitk.GetArrayFromImage(lm)
+        lm_region_np = lm_np & 255
+        lm_type_np = lm_np >> 8
+
+        lm_wl_np = lm_region_np
+        wl_mask = (lm_region_np == self.WholeLung) | (lm_region_np == self.UpperThird) | \
+                  (lm_region_np == self.MiddleThrid) | (lm_region_np == self.LowerThird)
+        if np.sum(wl_mask) == 0:
+            return lm
+
+        lm_wl_np[wl_mask] = self.WholeLung
+        lm_wl = sitk.GetImageFromArray(lm_wl_np)
+        lm_wl.CopyInformation(lm)
+        olm_np = sitk.GetArrayFromImage(sitk.Image(lm_wl))
+        size = lm_wl.GetSize()
+
+        for zz in range(size[2]):
+            self.twoobject_label_cut(lm_wl[:, :, zz], olm_np[zz, :, :], 2, zz, 0)
+        for yy in range(size[1]):
+            self.twoobject_label_cut(lm_wl[:, yy, :], olm_np[:, yy, :], 1, yy, 0)
+        for xx in range(size[0]):
+            self.__majority_voting_cut__(lm_wl[xx, :, :], olm_np[:, :, xx])
+
+        if self.split_thirds is True:
+            vol_right = np.sum(olm_np == self.RightLabel)
+            vol_left = np.sum(olm_np == self.LeftLabel)
+            target_vol_right = 0
+            target_vol_left = 0
+            for zz in range(size[2]):
+                cut = olm_np[zz, :, :]
+                right_mask = (cut == self.RightLabel)
+                left_mask = (cut == self.LeftLabel)
+                slice_vol_right = np.sum(right_mask)
+                slice_vol_left = np.sum(left_mask)
+                if target_vol_right <= vol_right / 3:
+                    cut[right_mask] = self.RightLowerThrid
+                elif target_vol_right <= 2 * vol_right / 3:
+                    cut[right_mask] = self.RightMiddleThrid
+                else:
+                    cut[right_mask] = self.RightUpperThird
+                target_vol_right = target_vol_right + slice_vol_right
+                if target_vol_left <= vol_left / 3:
+                    cut[left_mask] = self.LeftLowerThrid
+                elif target_vol_left <= 2 * vol_left / 3:
+                    cut[left_mask] = self.LeftMiddleThird
+                else:
+                    cut[left_mask] = self.LeftUpperThird
+                target_vol_left = target_vol_left + slice_vol_left
+
+        olm_np[np.logical_not(wl_mask)] = lm_region_np[np.logical_not(wl_mask)]
+        olm_np = olm_np + (lm_type_np << 8)
+        olm = sitk.GetImageFromArray(olm_np)
+        olm.CopyInformation(lm)
+        return olm
+
+    def __majority_voting_cut__(self, cut, out_np):
+        cc = self.cc_f.Execute(cut)
+        n_objects = self.cc_f.GetObjectCount()
+        rr_np = sitk.GetArrayFromImage(self.r_f.Execute(cc))
+        for oo in range(n_objects):
+            left_sum = np.sum(out_np[rr_np == oo + 1] == self.LeftLabel)
+            right_sum = np.sum(out_np[rr_np == oo + 1] == self.RightLabel)
+            out_np[rr_np == oo + 1] = self.LeftLabel if left_sum > right_sum else self.RightLabel
+
+    def twoobject_label_cut(self, cut, out_np, cutting_axis, cutting_idx, l_r_axis=0):
+        cc = self.cc_f.Execute(cut)
+        if self.cc_f.GetObjectCount() <= 1:
+            return
+        rr = self.r_f.Execute(cc)
+        self.ls.Execute(rr)
+        cut_size = np.prod(rr.GetSize())
+        rr_np = sitk.GetArrayFromImage(rr)
+        ss1 = np.sum(rr_np == 1)
+        ss2 = np.sum(rr_np == 2)
+        if 1.0 * ss1 / cut_size > self.size_th and 1.0 * ss2 / cut_size > self.size_th:
+            # LPS coordinates: the region with the biggest x is the left lung
+            if self.ls.GetCentroid(1)[l_r_axis] > self.ls.GetCentroid(2)[l_r_axis]:
+                out_np[rr_np == 1] = self.LeftLabel
+                out_np[rr_np == 2] = self.RightLabel
+            else:
+                out_np[rr_np == 1] = self.RightLabel
+                out_np[rr_np == 2] = self.LeftLabel
+
+def create_lungs_labelmap(shape, direction=(1, 0, 0, 0, 1, 0, 0, 0, 1), seed=0):
+    """ Two ellipsoids (whole lung label) joined by a bridge, plus some small blobs of other labels and types
+    :return: SimpleITK image
+    """
+    rng = np.random.RandomState(seed)
+    a = np.zeros(shape, np.uint16)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    for cx in (shape[2] * 0.3, shape[2] * 0.7):
+        r = ((z - shape[0] / 2.0) / (shape[0] * 0.4)) ** 2 + ((y - shape[1] / 2.0) / (shape[1] * 0.35)) ** 2 + \
+            ((x - cx) / (shape[2] * 0.17)) ** 2
+        a[r < 1] = 1
+    noise = ndimage.binary_dilation(rng.rand(*shape) < 0.002) & (a == 0)
+    a[noise] = rng.choice([1, 20, 21, 5], size=int(noise.sum()))
+    a[:, shape[1] // 2 - 2:shape[1] // 2 + 2, int(shape[2] * 0.45):int(shape[2] * 0.55)] = 1
+    a[a == 5] = 5 | (3 << 8)
+    image = sitk.GetImageFromArray(a)
+    image.SetSpacing((0.7, 0.8, 1.5))
+    image.SetDirection(direction)
+    return image
+
+
+def test_lung_splitter_equals_reference():
+    """ The slice-batched engine must give exactly the same labelmap as the original implementation
+    """
+    for shape in ((20, 30, 40), (40, 64, 64)):
+        for direction in ((1, 0, 0, 0, 1, 0, 0, 0, 1), (-1, 0, 0, 0, -1, 0, 0, 0, 1)):
+            lm = create_lungs_labelmap(shape, direction)
+            for split_thirds in (False, True):
+                expected = sitk.GetArrayFromImage(ReferenceLungSplitter(split_thirds).execute(lm))
+                result = sitk.GetArrayFromImage(LungSplitter(split_thirds).execute(lm))
+                assert result.dtype == expected.dtype
+                assert np.array_equal(result, expected)
+
+
+def test_lung_splitter_without_lungs():
+    """ A labelmap without whole lung labels is returned unchanged
+    """
+    a = np.zeros((5, 10, 10), np.uint16)
+    a[2, 3:6, 3:6] = 5
+    lm = sitk.GetImageFromArray(a)
+    assert np.array_equal(sitk.GetArrayFromImage(LungSplitter().execute(lm)), a)
+
+
+def test_lung_splitter_threads():
+    """ The result must be bit-identical no matter the number of threads that process the slabs
+    """
+    lm = create_lungs_labelmap((40, 64, 64), seed=1)
+    for split_thirds in (False, True):
+        expected = sitk.GetArrayFromImage(LungSplitter(split_thirds, num_threads=1).execute(lm))
+        for num_threads in (2, 4, 7):
+            result = sitk.GetArrayFromImage(LungSplitter(split_thirds, num_threads=num_threads).execute(lm))
+            assert np.array_equal(result, expected)
@@ -0,0 +1,114 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from CIP.logic.MeshCrossSection import MeshCrossSection
+
+
+def create_airway_mesh():
+    """ Triangle mesh of a synthetic airway: a trachea that splits in two bronchi, so that the planes below the
+    bifurcation cut the mesh in several contours
+    :return: vtkPolyData
+    """
+    z, y, x = np.mgrid[:60, :40, :40]
+    airway = ((x - 20) ** 2 + (y - 20) ** 2 < 7 ** 2) & (z > 30)
+    for side in (-1, 1):
+        airway |= ((x - 20 - side * (32 - z) * 0.4) ** 2 + (y - 20) ** 2 < 5 ** 2) & (z <= 32) & (z > 4)
+    image = vtk.vtkImageData()
+    image.SetDimensions(40, 40, 60)
+    image.SetSpacing(0.7, 0.7, 1.0)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(airway.astype(np.uint8).ravel(), deep=True))
+    marchingCubes = vtk.vtkMarchingCubes()
+    marchingCubes.SetInputData(image)
+    marchingCubes.SetValue(0, 0.5)
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputConnection(marchingCubes.GetOutputPort())
+    triangleFilter.Update()
+    return triangleFilter.GetOutput()
+
+
+def vtk_section(polyData, normal, origin):
+    """ Reference section: vtkCutter + vtkConnectivityFilter (closest point region), joined in polylines with a
+    vtkStripper so that the area does not depend on the orientation of the segments returned by the cutter
+    :return: tuple (contour points, area)
+    """
+    plane = vtk.vtkPlane()
+    plane.SetOrigin(origin)
+    plane.SetNormal(normal / np.linalg.norm(normal))
+    cutter = vtk.vtkCutter()
+    cutter.SetCutFunction(plane)
+    cutter.SetInputData(polyData)
+    connectivity = vtk.vtkConnectivityFilter()
+    connectivity.SetInputConnection(cutter.GetOutputPort())
+    connectivity.SetExtractionModeToClosestPointRegion()
+    connectivity.SetClosestPoint(origin)
+    cleaner = vtk.vtkCleanPolyData()
+    cleaner.SetInputConnection(connectivity.GetOutputPort())
+    cleaner.PointMergingOff()
+    stripper = vtk.vtkStripper()
+    stripper.SetInputConnection(cleaner.GetOutputPort())
+    stripper.JoinContiguousSegmentsOn()
+    stripper.Update()
+
+    output = stripper.GetOutput()
+    points = numpy_support.vtk_to_numpy(output.GetPoints().GetData())
+    total = np.zeros(3)
+    lines = output.GetLines()
+    lines.InitTraversal()
+    ids = vtk.vtkIdList()
+    while lines.GetNextCell(ids):
+        loop = points[[ids.GetId(i) for i in range(ids.GetNumberOfIds())]]
+        total += np.sum(np.cross(loop[:-1], loop[1:]), axis=0)
+    return points, abs(np.dot(total, normal / np.linalg.norm(normal))) / 2
+
+
+def random_planes(count, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(count):
+        origin = np.array([14 + rng.normal(), 14 + rng.normal(), rng.uniform(8, 55)])
+        normal = np.array([rng.normal() * 0.3, rng.normal() * 0.3, 1.0])
+        yield normal, origin
+
+
+def test_mesh_cross_section_equals_vtk_cutter():
+    """ Centroid, area and inscribed radius of the sections must match the vtkCutter + vtkConnectivityFilter pipeline
+    """
+    polyData = create_airway_mesh()
+    section = MeshCrossSection.fromPolyData(polyData)
+    for normal, origin in random_planes(50):
+        expectedPoints, expectedArea = vtk_section(polyData, normal, origin)
+        points, segments = section.section(normal, origin, origin)
+        assert len(points) == len(expectedPoints)
+        # The VTK points are single precision
+        assert np.isclose(MeshCrossSection.area(points, segments, normal), expectedArea, rtol=1e-5)
+        assert np.isclose(section.sectionArea(normal, origin), expectedArea, rtol=1e-5)
+        centroid = MeshCrossSection.centroid(points)
+        expectedCentroid = np.mean(expectedPoints, axis=0)
+        assert np.allclose(centroid, expectedCentroid, atol=1e-5)
+        assert np.isclose(MeshCrossSection.inscribedRadius(points, centroid),
+                          np.sqrt(np.min(np.sum((expectedPoints - expectedCentroid) ** 2, axis=1))), atol=1e-5)
+
+
+def test_mesh_cross_section_empty():
+    """ A plane that does not cut the mesh gives an empty section
+    """
+    section = MeshCrossSection.fromPolyData(create_airway_mesh())
+    points, segments = section.section((0, 0, 1), (0, 0, 100))
+    assert len(points) == 0 and len(segments) == 0
+    assert section.sectionArea((0, 0, 1), (0, 0, 100), emptyArea=1000) == 1000
+    assert len(MeshCrossSection.fromPolyData(vtk.vtkPolyData()).cut((0, 0, 1), (0, 0, 0))[0]) == 0
+
+
+def test_mesh_cross_section_fit_sections():
+    """ The fits must give the same results when they run one after another or in processes
+    """
+    section = MeshCrossSection.fromPolyData(create_airway_mesh())
+    fits = [(origin, (1, 0, 1)) for normal, origin in random_planes(4, seed=1)]
+    expected = section.fitSections(fits, numWorkers=1)
+    steps = []
+    for useProcesses in (False, True):
+        results = section.fitSections(fits, numWorkers=3, useProcesses=useProcesses, callbackStepFunction=steps.append)
+        for result, expectedResult in zip(results, expected):
+            for value, expectedValue in zip(result, expectedResult):
+                assert np.array_equal(value, expectedValue)
+    assert sorted(steps) == sorted(list(range(len(fits))) * 2)
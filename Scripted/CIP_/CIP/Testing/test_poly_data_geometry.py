@@ -0,0 +1,58 @@
+import numpy as np
+import vtk
+
+from CIP.logic.PolyDataGeometry import PolyDataGeometry
+
+
+def create_sphere():
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(10)
+    sphere.SetThetaResolution(30)
+    sphere.SetPhiResolution(20)
+    sphere.Update()
+    return sphere.GetOutput()
+
+
+def test_poly_data_geometry_views():
+    """ The numpy views give the same points and cells as the VTK API, and share its memory
+    """
+    polyData = create_sphere()
+    geometry = PolyDataGeometry(polyData)
+    points = geometry.points
+    assert np.array_equal(points, [polyData.GetPoint(i) for i in range(polyData.GetNumberOfPoints())])
+    triangles = geometry.triangles
+    assert triangles.shape == (polyData.GetNumberOfCells(), 3)
+    for i in range(polyData.GetNumberOfCells()):
+        ids = polyData.GetCell(i).GetPointIds()
+        assert triangles[i].tolist() == [ids.GetId(j) for j in range(3)]
+    points[0] = (1, 2, 3)
+    assert polyData.GetPoint(0) == (1, 2, 3)
+
+    assert PolyDataGeometry(vtk.vtkPolyData()).points.shape == (0, 3)
+    assert geometry.lines.shape == (0, 0)
+
+
+def test_poly_data_geometry_closest_points():
+    """ Closest points vs vtkPointLocator, also after modifying the points of the mesh
+    """
+    polyData = create_sphere()
+    geometry = PolyDataGeometry(polyData)
+    tree = geometry.buildTree()
+    assert geometry.buildTree() is tree and geometry.tree is tree
+    queryPoints = np.random.RandomState(0).uniform(-15, 15, (200, 3))
+    for _ in range(2):
+        locator = vtk.vtkPointLocator()
+        locator.SetDataSet(polyData)
+        locator.BuildLocator()
+        indexes, distances = geometry.closestPoints(queryPoints)
+        points = geometry.points
+        for queryPoint, index, distance in zip(queryPoints, indexes, distances):
+            expected = locator.FindClosestPoint(queryPoint)
+            # Ties between points at the same distance can be solved in a different way
+            assert np.isclose(np.linalg.norm(points[expected] - queryPoint), distance)
+            assert np.isclose(np.linalg.norm(points[index] - queryPoint), distance)
+        assert np.array_equal(geometry.closestPointsCoordinates(queryPoints), points[indexes])
+        # Move the mesh. The kd-tree must be rebuilt
+        points *= 1.3
+        polyData.GetPoints().Modified()
+        assert geometry.buildTree() is not tree
@@ -0,0 +1,152 @@
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+
+class FastMarchingFronts(object):
+    """ Sum of several fast marching fronts that grow from single seeds over a binary speed map obtained thresholding
+    a volume (ex: the air inside the airway, for the trachea stent planning).
+    Every front contributes with its "inverted distance" (stopping value - arrival time) in the voxels that it reaches.
+    A front never travels further than its stopping value, and the arrival time at a voxel is never shorter than its
+    euclidean distance to the seed (the speed is 0 or 1), so in ROI mode every front only marches over a box around its
+    seed that contains that sphere (plus a small margin). The result is the same as marching over the whole volume, but
+    the time and the memory depend on the size of the fronts instead of the size of the volume.
+    The fronts are independent, so they run concurrently in a thread pool (SimpleITK releases the GIL), every one with
+    its own filter, and they are added to a single float32 buffer in the same order as they were passed.
+    The arrival times of every front are cached by seed voxel (and speed map parameters). The arrival time at a voxel
+    does not depend on the stopping value, so a cached front can be reused for any smaller stopping value, and when a
+    seed is moved only the fronts that changed are marched again. The fronts are cached with some extra stopping value
+    (cacheStoppingFactor) so that they can also be reused when the other seeds get a little further. The speed map is
+    computed only once for the whole volume. An object should be used just for one volume (and discarded if the
+    voxels change).
+    Ex:
+        fronts = FastMarchingFronts(ctArray, spacing)
+        box, distances = fronts.run([(seed1, 50.0), (seed2, 40.0)])
+        # distances contains the sum of both fronts in ctArray[box]
+    """
+    # Extra voxels around the sphere that a front can reach
+    MARGIN = 2
+    # Maximum number of fronts kept in the cache
+    CACHE_SIZE = 8
+
+    def __init__(self, volumeArray, spacing, speedThreshold=-800, roiMode=True, numThreads=None,
+                 cacheStoppingFactor=1.25):
+        """
+        :param volumeArray: numpy array (z, y, x) of the volume
+        :param spacing: spacing of the volume (x, y, z)
+        :param speedThreshold: the fronts can only travel through the voxels below this value
+        :param roiMode: march every front over a box around its seed (otherwise the whole volume is used)
+        :param numThreads: number of fronts that run at the same time (default: number of cpus). Use 1 to run them
+        one after another in the calling thread
+        :param cacheStoppingFactor: factor applied to the stopping value of the fronts that are not in the cache
+        (use 1 to march exactly up to the requested stopping values)
+        """
+        self.volumeArray = volumeArray
+        self.spacing = tuple(spacing)
+        self.speedThreshold = speedThreshold
+        self.roiMode = roiMode
+        self.numThreads = numThreads if numThreads is not None else (os.cpu_count() or 1)
+        self.cacheStoppingFactor = max(cacheStoppingFactor, 1.0)
+        self.__speedMap__ = None
+        self.__speedMapThreshold__ = None
+        # Key: (seed, speed map parameters, roiMode). Value: (stopping value, box, arrival times)
+        self.__cache__ = OrderedDict()
+
+    def frontBox(self, seed, stoppingValue):
+        """ Region of the volume that a front can reach
+        :param seed: IJK (x, y, z) coordinates of the seed
+        :param stoppingValue: stopping value of the front (physical units)
+        :return: tuple of slices (z, y, x) of the volume array
+        """
+        shape = self.volumeArray.shape
+        if not self.roiMode:
+            return tuple(slice(0, size) for size in shape)
+        box = []
+        # Numpy axes are in z, y, x order
+        for axis in (2, 1, 0):
+            radius = int(math.ceil(stoppingValue / self.spacing[axis])) + self.MARGIN
+            box.append(slice(max(int(seed[axis]) - radius, 0), min(int(seed[axis]) + radius + 1, shape[2 - axis])))
+        return tuple(box)
+
+    def speedMap(self, box):
+        """ Speed map (1 inside the threshold, 0 otherwise) in a box of the volume. The threshold of the whole volume is
+        computed the first time and reused for all the fronts
+        :param box: tuple of slices (z, y, x)
+        :return: SimpleITK image (int32)
+        """
+        if self.__speedMap__ is None or self.__speedMapThreshold__ != self.speedThreshold:
+            self.__speedMap__ = self.volumeArray < self.speedThreshold
+            self.__speedMapThreshold__ = self.speedThreshold
+        image = sitk.GetImageFromArray(self.__speedMap__[box].astype(np.int32))
+        image.SetSpacing(self.spacing)
+        return image
+
+    def arrivalTimes(self, seed, stoppingValue, box):
+        """ Run a single front
+        :param seed: IJK (x, y, z) coordinates of the seed
+        :param stoppingValue: stopping value of the front
+        :param box: box of the front (see frontBox)
+        :return: numpy array with the shape of the box with the arrival time of the front (bigger than the stopping
+        value in the voxels that were not reached)
+        """
+        # A new filter for every front, so that the fronts can run in different threads
+        fastMarchingFilter = sitk.FastMarchingImageFilter()
+        fastMarchingFilter.SetStoppingValue(stoppingValue)
+        fastMarchingFilter.SetTrialPoints([[int(seed[axis]) - box[2 - axis].start for axis in range(3)]])
+        return sitk.GetArrayFromImage(fastMarchingFilter.Execute(self.speedMap(box)))
+
+    def clearCache(self):
+        self.__cache__.clear()
+
+    def __cacheKey__(self, seed):
+        return tuple(int(c) for c in seed), self.speedThreshold, self.spacing, self.roiMode
+
+    def run(self, fronts):
+        """ Run all the fronts and sum their inverted distances
+        :param fronts: list of tuples (seed, stopping value), where seed are the IJK (x, y, z) coordinates of the seed
+        :return: tuple (box, array). The box is a tuple of slices (z, y, x) that contains all the fronts, and the array
+        (float32, with the shape of the box) the sum of the inverted distances of all the fronts
+        """
+        boxes = [self.frontBox(seed, stoppingValue) for seed, stoppingValue in fronts]
+        box = tuple(slice(min(b[axis].start for b in boxes), max(b[axis].stop for b in boxes)) for axis in range(3))
+        result = np.zeros([s.stop - s.start for s in box], np.float32)
+
+        # Fronts that are not in the cache or that were cached with a smaller stopping value
+        pending = OrderedDict()
+        for seed, stoppingValue in fronts:
+            key = self.__cacheKey__(seed)
+            cached = self.__cache__.get(key)
+            if cached is None or cached[0] < stoppingValue:
+                stoppingValue = max(stoppingValue * self.cacheStoppingFactor, pending.get(key, (None, 0))[1])
+                pending[key] = (seed, stoppingValue, self.frontBox(seed, stoppingValue))
+        if len(pending) > 0:
+            # Threshold the volume before starting the threads
+            self.speedMap(box)
+            if self.numThreads <= 1 or len(pending) <= 1:
+                arrivals = [self.arrivalTimes(*front) for front in pending.values()]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.numThreads, len(pending))) as executor:
+                    arrivals = list(executor.map(lambda front: self.arrivalTimes(*front), pending.values()))
+            for (key, (seed, stoppingValue, frontBox)), arrivalTimes in zip(pending.items(), arrivals):
+                self.__cache__[key] = (stoppingValue, frontBox, arrivalTimes)
+
+        for (seed, stoppingValue), frontBox in zip(fronts, boxes):
+            key = self.__cacheKey__(seed)
+            self.__cache__.move_to_end(key)
+            cachedBox, arrivalTimes = self.__cache__[key][1:]
+            # The box of the front is contained in the box of the cached front (same seed, bigger stopping value)
+            arrivalTimes = arrivalTimes[tuple(slice(frontBox[axis].start - cachedBox[axis].start,
+                                                    frontBox[axis].stop - cachedBox[axis].start) for axis in range(3))]
+            # Inverted distance. The voxels that were not reached (arrival time bigger than the stopping value) are 0
+            distances = stoppingValue - arrivalTimes
+            np.maximum(distances, 0, out=distances)
+            result[tuple(slice(frontBox[axis].start - box[axis].start, frontBox[axis].stop - box[axis].start)
+                         for axis in range(3))] += distances.astype(np.float32)
+
+        while len(self.__cache__) > self.CACHE_SIZE:
+            self.__cache__.popitem(last=False)
+        return box, result
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class IntensityLUT(object):
+    """ Pointwise intensity transform (calibration, windowing, normalization...) precomputed for every possible input
+    value and applied with a single gather over the volume.
+    It only makes sense for 8/16 bits integer volumes (the usual case in CT), where the table has at most 65536
+    entries (64 KiB for int8/uint8 outputs, 128 KiB for int16...). The function is evaluated once per possible input
+    value, so any numpy expression can be used and the result is exactly the same as evaluating it on the volume.
+    The volume is processed in chunks, so the only temporary memory is proportional to the chunk size, and the
+    transform can be performed in place when the input and output types are the same.
+    Ex:
+        lut = IntensityLUT(lambda v: v * 1.02 + 5, np.int16, np.int16)
+        lut.apply(ctArray, out=ctArray)
+    """
+    # Number of voxels processed in every gather. Small chunks keep the temporary indexes in the CPU cache
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, function, inputDtype=np.int16, outputDtype=None):
+        """
+        :param function: function that receives a numpy array with all the possible input values (inputDtype)
+        and returns the transformed values
+        :param inputDtype: type of the volumes that will be transformed (8 or 16 bits integer)
+        :param outputDtype: type of the result (default: type returned by the function)
+        """
+        inputDtype = np.dtype(inputDtype)
+        if not IntensityLUT.isSupported(inputDtype):
+            raise ValueError("Lookup tables are only supported for 8/16 bits integer volumes (got {})".format(
+                inputDtype))
+        self.inputDtype = inputDtype
+        # The table is indexed with the unsigned reinterpretation of the input, so that negative values do not need
+        # an offset (ex: int16 -1 is 65535)
+        self.__indexDtype__ = np.dtype("u{}".format(inputDtype.itemsize))
+        values = np.arange(1 << (8 * inputDtype.itemsize), dtype=self.__indexDtype__).view(inputDtype)
+        table = np.asarray(function(values))
+        self.outputDtype = np.dtype(outputDtype) if outputDtype is not None else table.dtype
+        self.table = table.astype(self.outputDtype)
+
+    @staticmethod
+    def isSupported(dtype):
+        """ True if a volume of this type can be transformed with a lookup table
+        """
+        dtype = np.dtype(dtype)
+        return dtype.kind in "ui" and dtype.itemsize <= 2
+
+    @staticmethod
+    def linear(slope, intercept, inputDtype=np.int16, outputDtype=np.int16):
+        """ Table for value * slope + intercept (ex: calibration). For integer outputs the result is truncated
+        (like numpy astype) and saturated to the range of the output type
+        """
+        outputDtype = np.dtype(outputDtype)
+
+        def function(values):
+            result = values.astype(np.float64) * slope + intercept
+            if outputDtype.kind in "ui":
+                info = np.iinfo(outputDtype)
+                np.clip(result, info.min, info.max, result)
+            return result
+        return IntensityLUT(function, inputDtype, outputDtype)
+
+    @staticmethod
+    def window(minimum, maximum, minOutput=0.0, maxOutput=255.0, inputDtype=np.int16, outputDtype=np.float32):
+        """ Table for an intensity window: values are clipped to [minimum, maximum] and linearly mapped to
+        [minOutput, maxOutput]
+        """
+        def function(values):
+            result = np.clip(values, minimum, maximum).astype(np.float32)
+            result -= minimum
+            result *= (maxOutput - minOutput) / float(maximum - minimum)
+            result += minOutput
+            return result
+        return IntensityLUT(function, inputDtype, outputDtype)
+
+    def apply(self, array, out=None):
+        """ Transform a volume
+        :param array: numpy array of type inputDtype
+        :param out: numpy array of type outputDtype and the same shape where the result is written. It can be the
+        input array itself (in place transform). If None, a new array is allocated
+        :return: transformed array
+        """
+        if array.dtype != self.inputDtype:
+            raise ValueError("The lookup table was built for {} volumes (got {})".format(self.inputDtype, array.dtype))
+        if out is None:
+            out = np.empty(array.shape, dtype=self.outputDtype)
+        elif out.shape != array.shape or out.dtype != self.outputDtype:
+            raise ValueError("The output array must have shape {} and type {}".format(array.shape, self.outputDtype))
+
+        if not (array.flags.c_contiguous and out.flags.c_contiguous):
+            out[...] = self.table[array.view(self.__indexDtype__)]
+            return out
+
+        indexes = array.reshape(-1).view(self.__indexDtype__)
+        result = out.reshape(-1)
+        for start in range(0, indexes.size, self.CHUNK_SIZE):
+            chunk = slice(start, start + self.CHUNK_SIZE)
+            # All the indexes are valid, so "clip" mode just avoids the extra buffering of the default mode
+            np.take(self.table, indexes[chunk], out=result[chunk], mode="clip")
+        return out
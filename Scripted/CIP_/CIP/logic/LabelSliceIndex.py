@@ -0,0 +1,139 @@
+import bisect
+import numpy as np
+
+
+class LabelSliceIndex(object):
+    """ Index of the slices where every label of a labelmap is present.
+    It is built with a single pass over the labelled voxels (a 2D histogram of (slice, label) obtained with bincount),
+    it can be updated when a single slice is edited without scanning the whole volume again, and it answers the
+    "next/previous slice that contains a label" queries with a binary search over sorted lists of slices.
+    The labelmap is read with Z,Y,X coordinates (numpy array obtained from a VTK volume), so a slice is the first index.
+    The background (label 0) is not indexed.
+    Ex:
+        index = LabelSliceIndex(slicer.util.arrayFromVolume(labelmapNode))
+        index.getSlices(labelCode)
+        index.nextSlice(currentSlice, labelCode)
+    """
+
+    # Maximum label that is mapped to its column with a lookup table (bigger labels are sorted)
+    MAX_LUT_LABEL = 2 ** 16
+
+    def __init__(self, labelmapArray):
+        """
+        :param labelmapArray: integer numpy array (slices, rows, cols)
+        """
+        numSlices = labelmapArray.shape[0]
+        mask = labelmapArray != 0
+        labels = labelmapArray[mask]
+        voxelSlices = np.repeat(np.arange(numSlices), np.count_nonzero(mask.reshape(numSlices, -1), axis=1))
+
+        if labels.size > 0 and labels.dtype.kind in "ui" and 0 <= labels.min() and labels.max() < self.MAX_LUT_LABEL:
+            # Column of every label with a lookup table built from the histogram of the labels (no sorting)
+            present = np.bincount(labels) > 0
+            uniqueLabels = np.flatnonzero(present)
+            groups = (np.cumsum(present) - 1)[labels]
+        else:
+            uniqueLabels, groups = np.unique(labels, return_inverse=True)
+        self.__labels__ = uniqueLabels.tolist()
+        numLabels = len(self.__labels__)
+        # Number of voxels of every label in every slice (2D histogram of (slice, label))
+        self.__counts__ = np.bincount(voxelSlices * numLabels + groups.ravel(),
+                                      minlength=numSlices * numLabels).reshape(numSlices, numLabels)
+
+        # Sorted lists of slices for every label and for any label
+        self.__slices__ = dict((label, np.flatnonzero(self.__counts__[:, i]).tolist())
+                               for i, label in enumerate(self.__labels__))
+        self.__anyLabelSlices__ = np.flatnonzero(self.__counts__.any(axis=1)).tolist()
+
+    @property
+    def labels(self):
+        """ Sorted list of the labels present in the labelmap
+        """
+        # The labels added by updateSlice are appended at the end of the columns
+        return sorted(label for label in self.__labels__ if len(self.__slices__[label]) > 0)
+
+    def __contains__(self, label):
+        return len(self.__slices__.get(label, ())) > 0
+
+    def getSlices(self, label=None):
+        """ Sorted numpy array of the slices that contain a label
+        :param label: label code. If None, the slices that contain any label
+        :return: numpy array of slice indexes (empty if the label is not present)
+        """
+        return np.array(self.__getSlicesList__(label), dtype=np.intp)
+
+    def toDictionary(self):
+        """ Dictionary of [label_Code: numpy array of slices] (same format as Util.get_labelmap_slices)
+        """
+        return dict((label, self.getSlices(label)) for label in self.labels)
+
+    def updateSlice(self, sliceIndex, sliceArray):
+        """ Update the index after a slice of the labelmap has been modified.
+        The cost only depends on the size of the slice, not on the size of the volume
+        :param sliceIndex: index of the slice in the volume
+        :param sliceArray: 2D numpy array with the new content of the slice
+        """
+        labels = sliceArray[sliceArray != 0]
+        newLabels, newCounts = np.unique(labels, return_counts=True)
+        for label in newLabels.tolist():
+            if label not in self.__slices__:
+                # Label that was not in the labelmap. Add a new column
+                self.__labels__.append(label)
+                self.__slices__[label] = []
+                self.__counts__ = np.hstack((self.__counts__, np.zeros((self.__counts__.shape[0], 1),
+                                                                      dtype=self.__counts__.dtype)))
+        row = np.zeros(len(self.__labels__), dtype=self.__counts__.dtype)
+        row[[self.__labels__.index(label) for label in newLabels.tolist()]] = newCounts
+
+        previousRow = self.__counts__[sliceIndex]
+        for i in np.flatnonzero((previousRow > 0) != (row > 0)):
+            self.__toggleSlice__(self.__slices__[self.__labels__[i]], sliceIndex, row[i] > 0)
+        if previousRow.any() != row.any():
+            self.__toggleSlice__(self.__anyLabelSlices__, sliceIndex, row.any())
+        self.__counts__[sliceIndex] = row
+
+    @staticmethod
+    def __toggleSlice__(slices, sliceIndex, present):
+        """ Insert/remove a slice in a sorted list of slices
+        """
+        if present:
+            bisect.insort(slices, sliceIndex)
+        else:
+            slices.pop(bisect.bisect_left(slices, sliceIndex))
+
+    def __getSlicesList__(self, label):
+        if label is None:
+            return self.__anyLabelSlices__
+        return self.__slices__.get(label, [])
+
+    def nextSlice(self, position, label=None, tolerance=0, continuous=True):
+        """ First slice after a position that contains a label
+        :param position: current position (slice index, it can be a float)
+        :param label: label code. If None, any label
+        :param tolerance: minimum distance to the current position
+        :param continuous: when there are no more slices after the position, return the first one
+        :return: slice index or None if there are no slices
+        """
+        slices = self.__getSlicesList__(label)
+        i = bisect.bisect_right(slices, position + max(tolerance, 0))
+        if i < len(slices):
+            return slices[i]
+        if continuous and len(slices) > 0:
+            return slices[0]
+        return None
+
+    def previousSlice(self, position, label=None, tolerance=0, continuous=True):
+        """ Last slice before a position that contains a label
+        :param position: current position (slice index, it can be a float)
+        :param label: label code. If None, any label
+        :param tolerance: minimum distance to the current position
+        :param continuous: when there are no more slices before the position, return the last one
+        :return: slice index or None if there are no slices
+        """
+        slices = self.__getSlicesList__(label)
+        i = bisect.bisect_left(slices, position - max(tolerance, 0))
+        if i > 0:
+            return slices[i - 1]
+        if continuous and len(slices) > 0:
+            return slices[-1]
+        return None
@@ -0,0 +1,206 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import scipy.optimize as scipy_opt
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .PolyDataGeometry import PolyDataGeometry
+
+
+class MeshCrossSection(object):
+    """ Cross sections of a triangle mesh with planes, computed with numpy over the vertices and triangles of the mesh.
+    It gives the same contour as a vtkCutter with a vtkPlane followed by a vtkConnectivityFilter in "closest point
+    region" mode, but the mesh is converted to numpy arrays only once, so it is suitable for objective functions
+    that cut the same mesh many times (ex: find the plane with the minimum cross section area).
+    The contour is returned as an array of points and an array of segments (pairs of point indexes). As in
+    vtkTriangle::Contour, the segments of all the triangles are oriented consistently, so the contour of a closed mesh
+    is a set of closed oriented polygons.
+    Ex:
+        section = MeshCrossSection.fromPolyData(tracheaPolyData)
+        points, segments = section.section(normal, origin, closestPoint=origin)
+        area = MeshCrossSection.area(points, segments, normal)
+    """
+    # For every case of vertices inside the plane (bit i set when the vertex i is in the positive side), edges of the
+    # triangle where the segment starts and ends. Edge i goes from vertex i to vertex (i + 1) % 3
+    __SEGMENT_EDGES__ = np.array([[-1, -1], [0, 2], [1, 0], [1, 2], [2, 1], [0, 1], [2, 0], [-1, -1]])
+
+    def __init__(self, vertices, triangles):
+        """
+        :param vertices: numpy array (N, 3) with the coordinates of the vertices
+        :param triangles: integer numpy array (M, 3) with the vertex indexes of every triangle
+        """
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.triangles = np.asarray(triangles, dtype=np.intp)
+
+    @staticmethod
+    def fromPolyData(polyData):
+        """ Build the cross section kernel for a vtkPolyData that only contains triangles (ex: the output of a
+        vtkTriangleFilter)
+        :param polyData: vtkPolyData
+        :return: MeshCrossSection
+        """
+        triangles = PolyDataGeometry.cellsView(polyData.GetPolys())
+        if len(triangles) > 0 and triangles.shape[1] != 3:
+            raise ValueError("The mesh must contain only triangles")
+        return MeshCrossSection(PolyDataGeometry.pointsView(polyData), triangles.reshape(-1, 3))
+
+    def cut(self, normal, origin):
+        """ Intersection of the whole mesh with a plane
+        :param normal: normal of the plane (it does not need to be normalized)
+        :param origin: point of the plane
+        :return: tuple (points, segments), where points is a float array (P, 3) and segments an integer array (S, 2)
+        """
+        normal = np.asarray(normal, dtype=np.float64)
+        normal = normal / np.linalg.norm(normal)
+        distances = (self.vertices - np.asarray(origin, dtype=np.float64)).dot(normal)
+
+        # Case of every triangle (as in vtkTriangle::Contour, the vertices on the plane are inside)
+        inside = distances[self.triangles] >= 0
+        cases = inside[:, 0] + 2 * inside[:, 1] + 4 * inside[:, 2]
+        crossed = (cases != 0) & (cases != 7)
+        triangles = self.triangles[crossed]
+        edges = self.__SEGMENT_EDGES__[cases[crossed]]
+
+        # Mesh edges where the segments start and end (2 per triangle), always from the inside vertex to the outside one
+        rows = np.arange(len(triangles))[:, np.newaxis]
+        a = triangles[rows, edges]
+        b = triangles[rows, (edges + 1) % 3]
+        swap = distances[a] < 0
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+
+        # The same edge of the mesh is shared by the two triangles next to it, so the contour points are identified by
+        # their edge. A point that falls on a vertex (distance 0) is identified by the vertex itself
+        onVertex = distances[a] == 0
+        keys = np.where(onVertex, a, a * len(self.vertices) + b + len(self.vertices)).reshape(-1)
+        uniqueKeys, firstIndex, segments = np.unique(keys, return_index=True, return_inverse=True)
+        a, b = a.reshape(-1)[firstIndex], b.reshape(-1)[firstIndex]
+        t = distances[a] / (distances[a] - distances[b])
+        points = self.vertices[a] + t[:, np.newaxis] * (self.vertices[b] - self.vertices[a])
+        return points, segments.reshape(-1, 2)
+
+    def section(self, normal, origin, closestPoint=None):
+        """ Intersection of the mesh with a plane, keeping only the connected contour that contains the contour point
+        closest to a given point (like vtkConnectivityFilter in "closest point region" mode)
+        :param normal: normal of the plane
+        :param origin: point of the plane
+        :param closestPoint: point used to select the contour (default: origin)
+        :return: tuple (points, segments) (see cut). Both arrays are empty if the plane does not cut the mesh
+        """
+        points, segments = self.cut(normal, origin)
+        if len(points) == 0:
+            return points, segments
+        if closestPoint is None:
+            closestPoint = origin
+        closest = np.argmin(np.sum((points - np.asarray(closestPoint, dtype=np.float64)) ** 2, axis=1))
+
+        graph = coo_matrix((np.ones(len(segments)), (segments[:, 0], segments[:, 1])), shape=(len(points),) * 2)
+        labels = connected_components(graph, directed=False)[1]
+        region = labels == labels[closest]
+        # Renumber the points of the region
+        newIndexes = np.cumsum(region) - 1
+        regionSegments = segments[region[segments[:, 0]]]
+        return points[region], newIndexes[regionSegments]
+
+    @staticmethod
+    def area(points, segments, normal):
+        """ Area enclosed by an oriented contour, projected on the plane with the given normal
+        :param points: numpy array (P, 3)
+        :param segments: integer numpy array (S, 2)
+        :param normal: normal of the plane
+        :return: area
+        """
+        normal = np.asarray(normal, dtype=np.float64)
+        total = np.sum(np.cross(points[segments[:, 0]], points[segments[:, 1]]), axis=0)
+        return abs(np.dot(total, normal / np.linalg.norm(normal)) / 2)
+
+    @staticmethod
+    def centroid(points):
+        """ Mean of the contour points
+        """
+        return np.mean(points, axis=0)
+
+    @staticmethod
+    def inscribedRadius(points, center):
+        """ Radius of the biggest circle centered in "center" that does not cross the contour (distance from the
+        center to the closest contour point)
+        """
+        return np.sqrt(np.min(np.sum((points - np.asarray(center, dtype=np.float64)) ** 2, axis=1)))
+
+    def sectionArea(self, normal, origin, emptyArea=1000):
+        """ Area of the section of the plane that contains the contour point closest to its origin
+        :param normal: normal of the plane
+        :param origin: point of the plane
+        :param emptyArea: value returned when the plane does not cut the mesh
+        :return: area
+        """
+        points, segments = self.section(normal, origin, origin)
+        if len(points) == 0:
+            return emptyArea
+        return MeshCrossSection.area(points, segments, normal)
+
+    def fitSection(self, point, initialNormal=(1, 0, 1), options=None):
+        """ Plane through a point with the minimum section area (SLSQP over the normal, constrained to unit length)
+        :param point: point of the plane
+        :param initialNormal: initial normal of the optimization
+        :param options: options of scipy.optimize.minimize
+        :return: tuple (normal, centroid, inscribed radius) of the section
+        """
+        cons = ({'type': 'eq', 'fun': lambda n: np.array(np.sqrt(sum((n[0:3]) ** 2)) - 1),
+                 'jac': lambda n: np.array(n[0:3] / np.sqrt(sum((n[0:3]) ** 2)))})
+        normal = scipy_opt.minimize(self.sectionArea, initialNormal, args=(point,), constraints=cons, method='SLSQP',
+                                    options=options).x
+        points = self.section(normal, point, point)[0]
+        centroid = MeshCrossSection.centroid(points)
+        return normal, centroid, MeshCrossSection.inscribedRadius(points, centroid)
+
+    def fitSections(self, fits, numWorkers=None, useProcesses=False, options=None, callbackStepFunction=None):
+        """ Run several independent fitSection optimizations.
+        The optimizer and the objective function are mostly Python code that holds the GIL, so running the fits in
+        threads would not be faster than running them one after another. The only way to run them in parallel is a pool
+        of processes that receive the mesh arrays only once, when they are created. Processes are only forked (a spawned
+        process would start a new instance of the application that embeds Python, ex: Slicer), and only in Linux
+        (forking a process with Qt/VTK state is not safe in macOS). Otherwise the fits run one after another in the
+        calling thread, so by default there is no speedup
+        :param fits: list of tuples (point, initial normal)
+        :param numWorkers: number of processes (default: number of cpus). Use 1 to run the fits in the calling process
+        :param useProcesses: run the fits in a pool of forked processes (only in Linux)
+        :param options: options of scipy.optimize.minimize
+        :param callbackStepFunction: function(index) invoked in the calling thread every time that a fit finishes
+        :return: list of results of fitSection, in the same order as the fits
+        """
+        numWorkers = min(numWorkers or os.cpu_count() or 1, len(fits))
+        results = [None] * len(fits)
+        if numWorkers <= 1 or not useProcesses or not sys.platform.startswith("linux"):
+            for index, (point, initialNormal) in enumerate(fits):
+                results[index] = self.fitSection(point, initialNormal, options)
+                if callbackStepFunction:
+                    callbackStepFunction(index)
+            return results
+
+        executor = ProcessPoolExecutor(max_workers=numWorkers, mp_context=multiprocessing.get_context("fork"),
+                                       initializer=__initSectionWorker__, initargs=(self.vertices, self.triangles))
+        with executor:
+            futures = dict((executor.submit(__fitSectionWorker__, point, initialNormal, options), index)
+                           for index, (point, initialNormal) in enumerate(fits))
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if callbackStepFunction:
+                    callbackStepFunction(futures[future])
+        return results
+
+
+# Cross section kernel of every worker process of MeshCrossSection.fitSections
+__workerSection__ = None
+
+
+def __initSectionWorker__(vertices, triangles):
+    global __workerSection__
+    __workerSection__ = MeshCrossSection(vertices, triangles)
+
+
+def __fitSectionWorker__(point, initialNormal, options):
+    return __workerSection__.fitSection(point, initialNormal, options)
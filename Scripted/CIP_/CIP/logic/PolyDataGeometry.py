@@ -0,0 +1,110 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from vtk.util import numpy_support
+
+
+class PolyDataGeometry(object):
+    """ Numpy access to the geometry of a vtkPolyData, to avoid crossing the Python/VTK boundary point by point.
+    - The points and the cells are exposed as numpy views of the VTK arrays (no copies).
+    - The closest point queries are answered in batch by a kd-tree of the points, built the first time that it is
+    needed and cached until the points of the mesh are modified (vtkPoints MTime).
+    Please note that the views are only valid while the polydata keeps the same point/cell arrays, and that the points
+    modified through a view must be followed by a call to polyData.GetPoints().Modified().
+    Ex:
+        geometry = PolyDataGeometry(tracheaModel.GetPolyData())
+        indexes, distances = geometry.closestPoints(cylinderPoints)
+        closest = geometry.points[indexes]
+    """
+    def __init__(self, polyData):
+        """
+        :param polyData: vtkPolyData
+        """
+        self.polyData = polyData
+        self.__tree__ = None
+        self.__treeMTime__ = None
+
+    @staticmethod
+    def pointsView(polyData):
+        """ Numpy view of the points of a polydata
+        :param polyData: vtkPolyData
+        :return: numpy array (N, 3) (empty if the polydata has no points)
+        """
+        points = polyData.GetPoints()
+        if points is None:
+            return np.zeros((0, 3))
+        return numpy_support.vtk_to_numpy(points.GetData())
+
+    @staticmethod
+    def cellsView(cellArray):
+        """ Numpy view of the point ids of a vtkCellArray where all the cells have the same number of points
+        (ex: triangles, line segments)
+        :param cellArray: vtkCellArray (ex: polyData.GetPolys(), polyData.GetLines())
+        :return: integer numpy array (number of cells, points per cell)
+        """
+        if cellArray.GetNumberOfCells() == 0:
+            return np.zeros((0, 0), dtype=np.intp)
+        if hasattr(cellArray, "GetConnectivityArray"):
+            # VTK >= 9: offsets + connectivity arrays
+            sizes = np.diff(numpy_support.vtk_to_numpy(cellArray.GetOffsetsArray()))
+            connectivity = numpy_support.vtk_to_numpy(cellArray.GetConnectivityArray())
+        else:
+            # Legacy layout: (number of points, id0, id1...) for every cell
+            data = numpy_support.vtk_to_numpy(cellArray.GetData())
+            size = data[0]
+            if data.size % (size + 1) != 0:
+                raise ValueError("All the cells must have the same number of points")
+            sizes = data.reshape(-1, size + 1)[:, 0]
+            connectivity = data.reshape(-1, size + 1)[:, 1:]
+        if np.any(sizes != sizes[0]):
+            raise ValueError("All the cells must have the same number of points")
+        return connectivity.reshape(-1, sizes[0])
+
+    @property
+    def points(self):
+        """ Numpy view of the points (N, 3)
+        """
+        return PolyDataGeometry.pointsView(self.polyData)
+
+    @property
+    def triangles(self):
+        """ Numpy view of the point ids of the polygons (they must be triangles)
+        """
+        return PolyDataGeometry.cellsView(self.polyData.GetPolys())
+
+    @property
+    def lines(self):
+        """ Numpy view of the point ids of the lines (they must be segments with the same number of points)
+        """
+        return PolyDataGeometry.cellsView(self.polyData.GetLines())
+
+    @property
+    def tree(self):
+        """ kd-tree of the points (cached until the points are modified, see buildTree)
+        """
+        return self.buildTree()
+
+    def buildTree(self):
+        """ Build the kd-tree of the points if it was not built yet or the points were modified since then.
+        It can be called in advance so that the first closest point query does not pay for it
+        :return: scipy cKDTree
+        """
+        mtime = self.polyData.GetPoints().GetMTime() if self.polyData.GetPoints() is not None else 0
+        if self.__tree__ is None or self.__treeMTime__ != mtime:
+            self.__tree__ = cKDTree(self.points)
+            self.__treeMTime__ = mtime
+        return self.__tree__
+
+    def closestPoints(self, queryPoints):
+        """ Closest point of the polydata to every query point
+        :param queryPoints: numpy array (M, 3)
+        :return: tuple (indexes, distances), numpy arrays (M)
+        """
+        distances, indexes = self.tree.query(np.asarray(queryPoints, dtype=np.float64).reshape(-1, 3))
+        return indexes, distances
+
+    def closestPointsCoordinates(self, queryPoints):
+        """ Coordinates of the closest point of the polydata to every query point
+        :param queryPoints: numpy array (M, 3)
+        :return: numpy array (M, 3)
+        """
+        return self.points[self.closestPoints(queryPoints)[0]]
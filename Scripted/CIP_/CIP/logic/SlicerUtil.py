@@ -839,6 +839,27 @@ class SlicerUtil:
         colorNode.SetNumberOfColors(numberOfColors)
         return colorNode
 
+    @staticmethod
+    def setTableNodeNumericColumns(tableNode, columns):
+        """ Fill a table node with numeric columns taken from numpy arrays.
+        Every array is wrapped as a vtkFloatArray with a single numpy_to_vtk call (no per-cell SetValue).
+        Columns that already exist in the table with the same name are replaced, so the same node can be
+        reused when the data change (no new MRML nodes are needed)
+        @param tableNode: vtkMRMLTableNode
+        @param columns: list of (columnName, numpy array) tuples. All the arrays should have the same length
+        @return: vtkTable
+        """
+        import numpy as np
+        from vtk.util import numpy_support
+        table = tableNode.GetTable()
+        for columnName, values in columns:
+            arr = numpy_support.numpy_to_vtk(np.ascontiguousarray(values, dtype=np.float32), deep=True)
+            arr.SetName(columnName)
+            # vtkFieldData.AddArray replaces any existing array with the same name
+            table.GetRowData().AddArray(arr)
+        tableNode.Modified()
+        return table
+
     @staticmethod
     def getInteractor(sliceNodeID):
         """
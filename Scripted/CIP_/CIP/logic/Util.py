@@ -12,6 +12,7 @@ import subprocess
 
 from . import file_conventions
 from .geometry_topology_data import *
+from .LabelSliceIndex import LabelSliceIndex
 
 class Util: 
     # Constants
@@ -287,49 +288,18 @@ class Util:
 
     #########
     # OTHER FUNCTIONS
-    @staticmethod
-    def get_labelmap_slices(npArray):
-        """ Get a dictionary with the slices where all the label data are contained in a numpy array
-        representing a labelmap.
-        The output will be a dictionary of [label_Code: array of slices]
-        :param npArray: numpy array representing the image
-        :return: dictionary of [label_Code: numpy array of slices]
-        """
-        # Extract labelmaps
-        return Util.get_labelmap_slices_from_numpy_array(npArray)
-    
     @staticmethod
     def get_labelmap_slices(np_array):
         """ Get a dictionary with the slices where all the label data are contained in a numpy array
         representing a labelmap.
         The output will be a dictionary of [label_Code: array of slices]
-        Method 1: "2 steps" process compressing the array. It works much better when there are few slices with data
+        Method 1: single pass over the labelled voxels (see LabelSliceIndex). Use directly a LabelSliceIndex object
+        when the labelmap is going to be edited or navigated
         :param np_array: numpy array representing the image
         :return: dictionary of [label_Code: numpy array of slices]
         """
-        #start = time.clock()
-        # Get an array with the slices that contain any data
-        positions = np.where(np_array > 0)
-        slices = np.unique(positions[0])
-         
-        # Build a new array just with the slices that contain data
-        boundArray = np_array[slices,:,:]
-         
-        # Search for all the different label maps
-        labelMaps = np.unique(boundArray)
-         
-        result = {}    
-        for label in (label for label in labelMaps if label>0):
-            # Get the slices that contain the label
-            s = np.where(boundArray == label)
-            # "Translate" to the true slice numbers and store the result
-            result[label] = slices[np.unique(s[0])] 
-        
-    #     end = time.clock()
-    #     print ("get_labelmap_slices_from_numpy_array took {0} seconds".format(end-start))
-         
-        return result
-    
+        return LabelSliceIndex(np_array).toDictionary()
+
     @staticmethod 
     def get_labelmap_slices_2(np_array):
         """Get a dictionary with the slices where all the label data are contained. The origin is a numpy array.
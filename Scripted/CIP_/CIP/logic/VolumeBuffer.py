@@ -0,0 +1,140 @@
+import numpy as np
+import SimpleITK as sitk
+import vtk
+from vtk.util import numpy_support
+
+
+class VolumeBuffer(object):
+    """ Exchange the voxels of MRML volume nodes with numpy and SimpleITK avoiding the intermediate copies.
+    - The numpy views of a node point to the scalars of its vtkImageData, with Z,Y,X(,components) coordinates.
+    - A SimpleITK image always owns its buffer, so creating it from a node costs exactly one copy (no file IO layer,
+    unlike sitkUtils), and its voxels can be read back as a numpy view.
+    - The results are written back into the existing buffer of the node, so no new vtkImageData is allocated when
+    the size and the type of the voxels do not change.
+    The geometry of the SimpleITK images is expressed in LPS (ITK convention), like in sitkUtils.
+    Please note that a numpy view of a node is only valid while the image data of the node is not replaced
+    (ex: a new crop).
+    Ex:
+        image = VolumeBuffer.sitkImage(volumeNode)
+        result = sitk.BinaryThreshold(image, 100, 200)
+        VolumeBuffer.writeSitkImage(labelmapNode, result)
+    """
+
+    @staticmethod
+    def arrayView(volumeNode):
+        """ Numpy array that shares the memory of the scalars of a volume node
+        :param volumeNode: vtkMRMLScalarVolumeNode (or any subclass)
+        :return: numpy array (slices, rows, cols) or (slices, rows, cols, components) for vector volumes
+        """
+        imageData = volumeNode.GetImageData()
+        shape = list(reversed(imageData.GetDimensions()))
+        components = imageData.GetNumberOfScalarComponents()
+        if components > 1:
+            shape.append(components)
+        return numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+
+    @staticmethod
+    def getITKGeometry(volumeNode):
+        """ Geometry of a volume node in ITK convention (LPS)
+        :param volumeNode: vtkMRMLVolumeNode
+        :return: tuple (origin, spacing, direction), where direction is a row-major flattened 3x3 matrix
+        """
+        matrix = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASDirectionMatrix(matrix)
+        # RAS to LPS: flip the first two axes
+        flip = (-1, -1, 1)
+        direction = tuple(flip[row] * matrix.GetElement(row, col) for row in range(3) for col in range(3))
+        origin = tuple(flip[i] * volumeNode.GetOrigin()[i] for i in range(3))
+        return origin, tuple(volumeNode.GetSpacing()), direction
+
+    @staticmethod
+    def setITKGeometry(volumeNode, image):
+        """ Set the geometry of a volume node from a SimpleITK image
+        :param volumeNode: vtkMRMLVolumeNode
+        :param image: SimpleITK image (LPS)
+        """
+        flip = (-1, -1, 1)
+        direction = image.GetDirection()
+        matrix = vtk.vtkMatrix4x4()
+        for row in range(3):
+            for col in range(3):
+                matrix.SetElement(row, col, flip[row] * direction[row * 3 + col])
+        volumeNode.SetIJKToRASDirectionMatrix(matrix)
+        volumeNode.SetOrigin([flip[i] * image.GetOrigin()[i] for i in range(3)])
+        volumeNode.SetSpacing(image.GetSpacing())
+
+    @staticmethod
+    def sitkImage(volumeNode):
+        """ SimpleITK image with the voxels and the geometry (LPS) of a volume node, copied straight from the buffer
+        of the node.
+        It replaces sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(nodeName))
+        :param volumeNode: vtkMRMLScalarVolumeNode (or any subclass)
+        :return: SimpleITK image
+        """
+        array = VolumeBuffer.arrayView(volumeNode)
+        image = sitk.GetImageFromArray(array, isVector=array.ndim == 4)
+        origin, spacing, direction = VolumeBuffer.getITKGeometry(volumeNode)
+        image.SetOrigin(origin)
+        image.SetSpacing(spacing)
+        image.SetDirection(direction)
+        return image
+
+    @staticmethod
+    def arrayFromSitkImage(image):
+        """ Numpy view of the voxels of a SimpleITK image (Z,Y,X coordinates), without copying them.
+        Unlike sitk.GetArrayViewFromImage, the returned array keeps a reference to the image, so it can be stored
+        after the image goes out of scope
+        :param image: SimpleITK image
+        :return: numpy array
+        """
+        return np.asarray(_SitkArrayHolder(image))
+
+    @staticmethod
+    def writeArray(volumeNode, array):
+        """ Write a numpy array into the scalars of a volume node.
+        The current buffer is reused when the shape and the type of the voxels are the same. Otherwise a new
+        vtkImageData is created (the geometry of the node is not modified).
+        The node is notified so that the views and the observers are refreshed
+        :param volumeNode: vtkMRMLScalarVolumeNode (or any subclass)
+        :param array: numpy array in Z,Y,X(,components) coordinates
+        """
+        imageData = volumeNode.GetImageData()
+        view = VolumeBuffer.arrayView(volumeNode) if imageData is not None and \
+            imageData.GetPointData().GetScalars() is not None else None
+        if view is not None and view.shape == array.shape and view.dtype == array.dtype:
+            if not np.shares_memory(view, array):
+                np.copyto(view, array)
+            imageData.GetPointData().GetScalars().Modified()
+            imageData.Modified()
+        else:
+            components = array.shape[3] if array.ndim == 4 else 1
+            scalars = numpy_support.numpy_to_vtk(np.ascontiguousarray(array).reshape(-1, components), deep=True,
+                                                 array_type=numpy_support.get_vtk_array_type(array.dtype))
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+            imageData.GetPointData().SetScalars(scalars)
+            volumeNode.SetAndObserveImageData(imageData)
+
+        volumeNode.StorableModified()
+        volumeNode.Modified()
+        volumeNode.InvokeEvent(volumeNode.ImageDataModifiedEvent, volumeNode)
+
+    @staticmethod
+    def writeSitkImage(volumeNode, image, updateGeometry=True):
+        """ Write a SimpleITK image into an existing volume node (reusing its buffer when possible).
+        It replaces sitk.WriteImage(image, sitkUtils.GetSlicerITKReadWriteAddress(nodeName))
+        :param volumeNode: vtkMRMLScalarVolumeNode (or any subclass)
+        :param image: SimpleITK image
+        :param updateGeometry: set the origin, spacing and direction of the node from the image
+        """
+        if updateGeometry:
+            VolumeBuffer.setITKGeometry(volumeNode, image)
+        VolumeBuffer.writeArray(volumeNode, sitk.GetArrayViewFromImage(image))
+
+
+class _SitkArrayHolder(object):
+    """ Expose the buffer of a SimpleITK image through the numpy array interface, keeping the image alive
+    """
+    def __init__(self, image):
+        self.image = image
+        self.__array_interface__ = sitk.GetArrayViewFromImage(image).__array_interface__
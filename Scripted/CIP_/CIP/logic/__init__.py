@@ -2,6 +2,12 @@ from .Util import *
 from .SlicerUtil import *
 from .geometry_topology_data import *
 from .EventsTrigger import *
+from .LabelSliceIndex import *
+from .VolumeBuffer import *
+from .IntensityLUT import *
+from .FastMarchingFronts import *
+from .MeshCrossSection import *
+from .PolyDataGeometry import *
 from . import file_conventions
 #from StructuresParameters import *
 #from Colors import *
@@ -1,10 +1,22 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import SimpleITK as sitk
 import numpy as np
+from scipy import ndimage
 
 
 class LungSplitter:
-    def __init__(self, split_thirds=False):
+    def __init__(self, split_thirds=False, num_threads=1):
+        """
+        :param split_thirds: split every lung in upper, middle and lower thirds
+        :param num_threads: number of threads that label the slabs of every pass in parallel (default: 1, every pass
+        runs in the calling thread). The gain of more threads depends on how much of the labelling and the numpy
+        kernels runs without the GIL, which has not been measured in multi-core machines. None: number of cpus.
+        The result does not depend on the number of threads
+        """
         self.split_thirds = split_thirds
+        self.num_threads = num_threads if num_threads is not None else (os.cpu_count() or 1)
         
         self.size_th = 0.05
         self.coordinate_system = 'lps'
@@ -36,13 +48,28 @@ class LungSplitter:
         self.RightMiddleThrid = 13
         self.RightLowerThrid = 14
 
+        # Number of slices labelled at once by the slice-batched engine (it bounds the temporary memory)
+        self.slab_size = 32
+        # 2D face connectivity (same as sitk.ConnectedComponent default) in every slice of a slab, and no
+        # connectivity between slices, so that the slices are labelled independently in a single call
+        self.slice_structure = np.zeros((3, 3, 3), dtype=bool)
+        self.slice_structure[1] = ndimage.generate_binary_structure(2, 1)
+
         self.cc_f = sitk.ConnectedComponentImageFilter()
-        self.r_f = sitk.RelabelComponentImageFilter()
-        self.ls = sitk.LabelShapeStatisticsImageFilter()
 
     def execute(self, lm):
-        # Get Region/Type Information
-        lm_np = sitk.GetArrayFromImage(lm)
+        olm = sitk.GetImageFromArray(self.execute_array(lm))
+        olm.CopyInformation(lm)
+        return olm
+
+    def execute_array(self, lm):
+        """ Split the lungs of a labelmap, returning the result as a numpy array (Z,Y,X) with the same type as lm,
+        so that it can be written straight into a volume node buffer (see VolumeBuffer.writeArray)
+        :param lm: SimpleITK labelmap image
+        :return: numpy array
+        """
+        # Get Region/Type Information (the input voxels are not copied)
+        lm_np = sitk.GetArrayViewFromImage(lm)
         lm_region_np = lm_np & 255
         lm_type_np = lm_np >> 8
 
@@ -53,144 +80,197 @@ class LungSplitter:
 
         if np.sum(wl_mask) == 0:
             # Nothing to do a filter should return the input lm
-            return lm
+            return lm_np
 
         lm_wl_np[wl_mask] = self.WholeLung
-        lm_wl = sitk.GetImageFromArray(lm_wl_np)
-        lm_wl.CopyInformation(lm)
+        lm_wl_fg = lm_wl_np != 0
 
         # Output holder copy
-        olm_tmp = sitk.Image(lm_wl)
-        olm_np = sitk.GetArrayFromImage(olm_tmp)
+        olm_np = lm_wl_np.copy()
 
-        size = lm_wl.GetSize()
+        # Contribution of every numpy axis (z, y, x) to the physical left-right coordinate (l_r_axis=0)
+        direction = lm.GetDirection()
+        spacing = lm.GetSpacing()
+        lr_weights = [direction[2 - a] * spacing[2 - a] for a in range(3)]
 
         # Axial run
-        for zz in range(size[2]):
-            cut = lm_wl[:, :, zz]
-            out_cut = olm_np[zz, :, :]
-            self.twoobject_label_cut(cut, out_cut, 2, zz, 0)
+        self.twoobject_label_slices(lm_wl_fg, olm_np, 0, lr_weights)
 
         # Coronal run
-        for yy in range(size[1]):
-            cut = lm_wl[:, yy, :]
-            out_cut = olm_np[:, yy, :]
-            self.twoobject_label_cut(cut, out_cut, 1, yy, 0)
+        self.twoobject_label_slices(lm_wl_fg, olm_np, 1, lr_weights)
 
         # Do majority voting split along sagittal
-        for xx in range(size[0]):
-            cut = lm_wl[xx, :, :]
-            out_cut = olm_np[:, :, xx]
-            self.allobjects_majority_voting_label_cut(cut,out_cut)
+        self.allobjects_majority_voting_label_slices(lm_wl_fg, olm_np, 2)
 
         # Splitting in Thirds
         if self.split_thirds is True:
-            vol_right = np.sum(olm_np == self.RightLabel)
-            vol_left = np.sum(olm_np == self.LeftLabel)
-            target_vol_right = 0
-            target_vol_left = 0
-            for zz in range(size[2]):
-                cut = olm_np[zz, :, :]
-                right_mask = (cut == self.RightLabel)
-                left_mask = (cut == self.LeftLabel)
-
-                slice_vol_right = np.sum(right_mask)
-                slice_vol_left = np.sum(left_mask)
-                if target_vol_right <= vol_right/3:
-                    cut[right_mask] = self.RightLowerThrid
-                elif target_vol_right > vol_right/3 and target_vol_right <= 2*vol_right/3:
-                    cut[right_mask] = self.RightMiddleThrid
-                else:
-                    cut[right_mask] = self.RightUpperThird
-
-                target_vol_right = target_vol_right + slice_vol_right
-
-                if target_vol_left <= vol_left/3:
-                    cut[left_mask] = self.LeftLowerThrid
-                elif target_vol_left > vol_left/3 and target_vol_left <= 2*vol_left/3:
-                    cut[left_mask] = self.LeftMiddleThird
-                else:
-                    cut[left_mask] = self.LeftUpperThird
-
-                target_vol_left = target_vol_left + slice_vol_left
+            self.split_lung_thirds(olm_np, self.RightLabel,
+                                   (self.RightLowerThrid, self.RightMiddleThrid, self.RightUpperThird))
+            self.split_lung_thirds(olm_np, self.LeftLabel,
+                                   (self.LeftLowerThrid, self.LeftMiddleThird, self.LeftUpperThird))
 
         # Transfer type labels to output LM
         olm_np[np.logical_not(wl_mask)] = lm_region_np[np.logical_not(wl_mask)]
-        olm_np = olm_np + (lm_type_np << 8)
+        olm_np += lm_type_np << 8
+        return olm_np
 
-        olm = sitk.GetImageFromArray(olm_np)
-        olm.CopyInformation(lm)
-        return olm
+    def label_slices(self, slab):
+        """ Label the connected components of all the 2D slices of a slab (first axis) with a single 3D labeling.
+        The components of every slice are numbered consecutively, slice after slice, in the same raster order as
+        sitk.ConnectedComponent would number them in every 2D cut.
+        :param slab: boolean numpy array (slices, rows, cols)
+        :return: tuple (labels array, number of components, component slice, sizes, row sums, col sums). The
+        arrays indexed by component have n+1 elements (index 0 is the background)
+        """
+        labels, n = ndimage.label(slab, structure=self.slice_structure)
+        flat = labels.reshape(-1)
+        voxels = np.flatnonzero(flat)
+        components = flat[voxels]
+        num_rows, num_cols = slab.shape[1:]
+        voxel_slices, in_slice = np.divmod(voxels, num_rows * num_cols)
+        rows, cols = np.divmod(in_slice, num_cols)
+
+        component_slice = np.zeros(n + 1, dtype=np.intp)
+        component_slice[components] = voxel_slices
+        sizes = np.bincount(components, minlength=n + 1)
+        row_sums = np.bincount(components, weights=rows, minlength=n + 1)
+        col_sums = np.bincount(components, weights=cols, minlength=n + 1)
+        return labels, n, component_slice, sizes, row_sums, col_sums
+
+    def split_lung_thirds(self, olm_np, lung_label, third_labels):
+        """ Relabel the voxels of a lung in thirds along the axial axis, by cumulative volume: a slice belongs to
+        the lower third while the volume of the lung in the previous slices is not above 1/3 of the total volume, to
+        the middle third while it is not above 2/3, and to the upper third after that.
+        :param olm_np: output numpy array (z, y, x), modified in place
+        :param lung_label: label of the lung (RightLabel/LeftLabel)
+        :param third_labels: labels for the (lower, middle, upper) thirds
+        """
+        lung_mask = olm_np == lung_label
+        slice_volumes = np.count_nonzero(lung_mask.reshape(lung_mask.shape[0], -1), axis=1)
+        volume = slice_volumes.sum()
+        # Volume of the lung in the slices below every slice
+        previous_volumes = np.cumsum(slice_volumes) - slice_volumes
+        slice_labels = np.where(previous_volumes <= volume / 3, third_labels[0],
+                                np.where(previous_volumes <= 2 * volume / 3, third_labels[1], third_labels[2]))
+        slice_labels = slice_labels.astype(olm_np.dtype)
+        olm_np[lung_mask] = np.broadcast_to(slice_labels[:, np.newaxis, np.newaxis], olm_np.shape)[lung_mask]
+
+    def __slabs__(self, array, axis):
+        """ Views of an array with the cutting axis moved to the first position, in slabs of slab_size slices
+        """
+        view = np.moveaxis(array, axis, 0)
+        for start in range(0, view.shape[0], self.slab_size):
+            yield view[start:start + self.slab_size]
+
+    def __run_slabs__(self, function, lm_fg, olm_np, cutting_axis):
+        """ Run function(fg_slab, out_slab) for all the slabs of a pass. Every slab only writes its own slices of
+        the output, so the slabs can be distributed among num_threads threads. The passes themselves are still
+        sequential, because every pass uses the result of the previous one.
+        """
+        slabs = list(zip(self.__slabs__(lm_fg, cutting_axis), self.__slabs__(olm_np, cutting_axis)))
+        if self.num_threads <= 1 or len(slabs) <= 1:
+            for fg_slab, out_slab in slabs:
+                function(fg_slab, out_slab)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.num_threads, len(slabs))) as executor:
+            # list() re-raises the exceptions of the workers
+            list(executor.map(lambda slab: function(*slab), slabs))
+
+    def twoobject_label_slices(self, lm_fg, olm_np, cutting_axis, lr_weights):
+        """ Two objects labelling of all the cuts along an axis at once: in every cut with 2 or more
+        components, if the two biggest components are above the size threshold, the left one is labelled as
+        LeftLabel and the right one as RightLabel.
+        :param lm_fg: boolean numpy array (z, y, x) with the labelled voxels
+        :param olm_np: output numpy array (z, y, x), modified in place
+        :param cutting_axis: numpy axis of the cuts (0: axial, 1: coronal, 2: sagittal)
+        :param lr_weights: contribution of a unit index in every numpy axis to the physical left-right coordinate
+        """
+        cut_axes = [a for a in range(3) if a != cutting_axis]
+        row_weight, col_weight = lr_weights[cut_axes[0]], lr_weights[cut_axes[1]]
+        def label_slab(fg_slab, out_slab):
+            self.__twoobject_label_slab__(fg_slab, out_slab, row_weight, col_weight)
+        self.__run_slabs__(label_slab, lm_fg, olm_np, cutting_axis)
+
+    def __twoobject_label_slab__(self, fg_slab, out_slab, row_weight, col_weight):
+        """ twoobject_label_slices for a single slab (slices, rows, cols)
+        """
+        labels, n, component_slice, sizes, row_sums, col_sums = self.label_slices(fg_slab)
+        if n < 2:
+            return
+        cut_size = fg_slab.shape[1] * fg_slab.shape[2]
+
+        # Components sorted by slice, then by decreasing size (and by label in case of a tie, like
+        # sitk.RelabelComponent). The first two of every slice are the two biggest objects of the cut
+        components = np.arange(1, n + 1)
+        order = components[np.lexsort((components, -sizes[1:], component_slice[1:]))]
+        order_slices = component_slice[order]
+        first = np.flatnonzero(np.diff(order_slices, prepend=-1))
+        first = first[(np.append(first[1:], n) - first) >= 2]
+        c1, c2 = order[first], order[first + 1]
+
+        valid = (1.0 * sizes[c1] / cut_size > self.size_th) & (1.0 * sizes[c2] / cut_size > self.size_th)
+        c1, c2 = c1[valid], c2[valid]
+        centroid1 = (row_sums[c1] * row_weight + col_sums[c1] * col_weight) / sizes[c1]
+        centroid2 = (row_sums[c2] * row_weight + col_sums[c2] * col_weight) / sizes[c2]
+        c1_is_left = centroid1 > centroid2
+        if self.coordinate_system != 'lps':
+            c1_is_left = ~c1_is_left
+
+        assignment = np.zeros(n + 1, dtype=out_slab.dtype)
+        assignment[c1] = np.where(c1_is_left, self.LeftLabel, self.RightLabel)
+        assignment[c2] = np.where(c1_is_left, self.RightLabel, self.LeftLabel)
+        self.__assign__(out_slab, labels, assignment)
+
+    def allobjects_majority_voting_label_slices(self, lm_fg, olm_np, cutting_axis):
+        """ Same as allobjects_majority_voting_label_cut for all the cuts along an axis at once: every component
+        of every cut is labelled with the label (LeftLabel/RightLabel) that is more frequent in the component
+        :param lm_fg: boolean numpy array (z, y, x) with the labelled voxels
+        :param olm_np: output numpy array (z, y, x), modified in place
+        :param cutting_axis: numpy axis of the cuts (0: axial, 1: coronal, 2: sagittal)
+        """
+        self.__run_slabs__(self.__majority_voting_label_slab__, lm_fg, olm_np, cutting_axis)
+
+    def __majority_voting_label_slab__(self, fg_slab, out_slab):
+        labels, n = self.label_slices(fg_slab)[:2]
+        if n > 0:
+            self.majority_voting(labels, n, out_slab)
+
+    def majority_voting(self, labels, n_objects, out_np):
+        """ Label every component with the label (LeftLabel/RightLabel) that is more frequent in the component
+        (RightLabel in case of a tie). The left/right counts of all the components are obtained with a single
+        bincount over (component, current label), and all the components are relabelled at once.
+        :param labels: numpy array with the component of every voxel (0: background)
+        :param n_objects: number of components (labels 1..n_objects)
+        :param out_np: numpy array with the same shape as labels, modified in place
+        """
+        flat_labels = labels.reshape(-1)
+        voxels = np.flatnonzero(flat_labels)
+        values = np.ravel(out_np)[voxels]
+        # 0: other label, 1: left, 2: right
+        votes = (values == self.LeftLabel) + 2 * (values == self.RightLabel)
+        counts = np.bincount(flat_labels[voxels] * 3 + votes, minlength=(n_objects + 1) * 3).reshape(-1, 3)
+        assignment = np.where(counts[:, 1] > counts[:, 2], self.LeftLabel, self.RightLabel).astype(out_np.dtype)
+        assignment[0] = 0
+        self.__assign__(out_np, labels, assignment)
+
+    @staticmethod
+    def __assign__(out_slab, labels, assignment):
+        """ Write the label assigned to every component (0: leave untouched) in the output slab
+        """
+        values = assignment[labels]
+        mask = values != 0
+        out_slab[mask] = values[mask]
 
     def allobjects_majority_voting_label_cut(self, cut, out_np):
         cc = self.cc_f.Execute(cut)
         n_objects = self.cc_f.GetObjectCount()
-        rr = self.r_f.Execute(cc)
-        rr_np = sitk.GetArrayFromImage(rr)
-
-        for oo in range(n_objects):
-            out_np[rr_np == oo + 1]
-            left_sum = np.sum(out_np[rr_np == oo + 1] == self.LeftLabel)
-            right_sum = np.sum(out_np[rr_np == oo + 1] == self.RightLabel)
-            if left_sum > right_sum:
-                out_np[rr_np == oo + 1] = self.LeftLabel
-            else:
-                out_np[rr_np == oo + 1] = self.RightLabel
+        if n_objects > 0:
+            # The vote does not depend on the order of the components, so they do not need to be relabelled
+            self.majority_voting(sitk.GetArrayViewFromImage(cc), n_objects, out_np)
 
     def oneobject_majority_voting_label_cut(self, cut, out_np):
         cc = self.cc_f.Execute(cut)
         n_objects = self.cc_f.GetObjectCount()
-        rr = self.r_f.Execute(cc)
-        rr_np = sitk.GetArrayFromImage(rr)
 
         if n_objects == 1:
-            out_np[rr_np == 1]
-            left_sum = np.sum(out_np[rr_np == 1] == self.LeftLabel)
-            right_sum = np.sum(out_np[rr_np == 1] == self.RightLabel)
-            if left_sum > right_sum:
-                out_np[rr_np == 1] = self.LeftLabel
-            else:
-                out_np[rr_np == 1] = self.RightLabel
-
-    def twoobject_label_cut(self, cut, out_np, cutting_axis, cutting_idx, l_r_axis=0):
-        # Detect and label components
-
-        cc = self.cc_f.Execute(cut)
-        n_objects = self.cc_f.GetObjectCount()
-
-        if n_objects <= 1:
-            # Leave mask untouch
-            return
-        else:
-            rr = self.r_f.Execute(cc)
-            self.ls.Execute(rr)
-            vox_size = np.prod(rr.GetSpacing())
-            cut_size = np.prod(rr.GetSize())
-            total_area = cut_size * vox_size
-
-            rr_np = sitk.GetArrayFromImage(rr)
-
-            ss1 = np.sum(rr_np == 1)
-            ss2 = np.sum(rr_np == 2)
-
-            # Get Components that pass threshold
-            if 1.0 * ss1 / cut_size > self.size_th and 1.0 * ss2 / cut_size > self.size_th:
-
-                centroid1 = self.ls.GetCentroid(1)
-                centroid2 = self.ls.GetCentroid(2)
-                if centroid1[l_r_axis] > centroid2[l_r_axis]:
-                    if self.coordinate_system == 'lps':
-                        # Region 1 L and Region 2 R
-                        out_np[rr_np == 1] = self.LeftLabel
-                        out_np[rr_np == 2] = self.RightLabel
-                    else:
-                        out_np[rr_np == 1] = self.RightLabel
-                        out_np[rr_np == 2] = self.LeftLabel
-                else:
-                    if self.coordinate_system == 'lps':
-                        # Region 1 R and Region 2 L
-                        out_np[rr_np == 1] = self.RightLabel
-                        out_np[rr_np == 2] = self.LeftLabel
-                    else:
-                        out_np[rr_np == 1] = self.LeftLabel
-                        out_np[rr_np == 2] = self.RightLabel
+            self.majority_voting(sitk.GetArrayViewFromImage(cc), n_objects, out_np)
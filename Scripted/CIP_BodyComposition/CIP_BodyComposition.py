@@ -14,8 +14,9 @@ import qt, vtk, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 
 from CIP.logic.SlicerUtil import SlicerUtil
-from CIP.logic import Util
-from CIP_BodyComposition_logic import BodyCompositionParameters
+from CIP.logic import Util, LabelSliceIndex
+from CIP_BodyComposition_logic import BodyCompositionParameters, BodyCompositionBatch, GroupedStatistics, \
+    IncrementalStatistics, SlabMorphology
 from CIP.ui import CaseReportsWidget
 import CIP.ui as CIPUI
 
@@ -43,6 +44,9 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
     """GUI object"""
 
     __preventDialogs__ = False
+    # Editor effects that only modify the slice of the view where they are applied (except PaintEffect with the sphere
+    # option, see __getEditedRegion__)
+    SLICE_EFFECTS = ("PaintEffect", "DrawEffect", "LevelTracingEffect", "RectangleEffect")
     # @property
     # def preventDialogs(self):
     #     return self.__preventDialogs__
@@ -90,7 +94,7 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
         self.colorTableNode = None
         self.disableEvents = False
-        self.labelMapSlices = {}  # Dict. with the slices that contain data for each label in a label map volume
+        self.labelMapSlices = {}  # Dict. with a LabelSliceIndex (slices that contain data for each label) per label map volume
         self.statistics = {}  # Dictionary with all the statistics calculated for a volume
 
         # Create the appropiate color maps for each type of segmentation
@@ -212,6 +216,25 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         self.btnAnalysis2.setFixedWidth(250)
         self.statsButtonsFrame.layout().addWidget(self.btnAnalysis2)
 
+        # Update the statistics while the labelmap is edited (only the modified slices are recomputed)
+        self.incrementalStatsCheckBox = qt.QCheckBox()
+        self.incrementalStatsCheckBox.setText("Update the statistics while editing")
+        self.incrementalStatsCheckBox.setChecked(False)
+        self.incrementalStatsCheckBox.setToolTip("Refresh the statistics table every time the labelmap is modified. "
+                                                 "Only the edited slices are analyzed again")
+        self.statsButtonsFrame.layout().addWidget(self.incrementalStatsCheckBox)
+        self.labelmapObserver = None
+        self.observedLabelmapNode = None
+        # Observers of the mouse buttons in the slice views, to know where the editor effects are applied
+        self.sliceViewsObservers = []
+        self.__editedSliceNode__ = None
+        # Regions of the labelmap modified since the last refresh (None when the region is unknown)
+        self.__pendingModifiedRegions__ = []
+        # Several modifications in a row (ex: a paint stroke) are processed just once
+        self.incrementalStatsTimer = qt.QTimer()
+        self.incrementalStatsTimer.singleShot = True
+        self.incrementalStatsTimer.interval = 0
+
         # Reports widget
         columns = CaseReportsWidget.getColumnKeysNormalizedDictionary(self.storedColumnNames)
         self.reportsWidget = CaseReportsWidget(self.moduleName, columns, parentWidget=self.statsButtonsFrame)
@@ -285,6 +308,8 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         self.btnAnalysis2.connect("clicked()", self.onBtnAnalysisClicked)
         self.btnGoToNextStructure.connect("clicked()", self.onBtnNextClicked)
         self.btnGoToPreviousStructure.connect("clicked()", self.onBtnPrevClicked)
+        self.incrementalStatsCheckBox.connect("stateChanged(int)", self.onIncrementalStatsStateChanged)
+        self.incrementalStatsTimer.connect("timeout()", self.refreshStatisticsIncremental)
         self.reportsWidget.addObservable(self.reportsWidget.EVENT_SAVE_BUTTON_CLICKED, self.onSaveReport)
 
         slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.__onSceneClosed__)
@@ -588,6 +613,7 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
         # Calculate the slices that contain data for each label map (when neccesary)
         self.__sliceChecking__(labelMapNode, forceSlicesReload)
+        self.__observeLabelmapNode__()
 
         # Set the appropiate default values for the editor
         self.__setStructureProperties__()
@@ -700,7 +726,7 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
         # Calculate the values
         # if SlicerUtil.IsDevelopment: print("Calculating slices for Volume " + volumeID)
-        self.labelMapSlices[volumeID] = self.logic.getLabelmapSlices(labelMapNode)
+        self.labelMapSlices[volumeID] = self.logic.getLabelSliceIndex(labelMapNode)
 
     def getCurrentGrayscaleNode(self):
         """Get the grayscale node that is currently active in the widget"""
@@ -731,167 +757,281 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
         # Refresh the calculation of the slices
         self.__sliceChecking__(self.getCurrentLabelMapNode(), forceRefresh=True)
-        self.statisticsTableModel = qt.QStandardItemModel()
-        self.tableView.setModel(self.statisticsTableModel)
-        self.tableView.verticalHeader().visible = False
-        # IMPORTANT: We need this list because otherwise the items seem to be removed from memory!
-        self.items = []
 
         try:
             # Perform the analysis (the result will be a list of StatsWrapper objects
             self.lastAnalysisResults = self.logic.calculateStatistics(self.editorWidget.masterVolume,
                                                                       self.editorWidget.labelmapVolume,
                                                                       labelmapSlices=self.labelMapSlices[
-                                                                          self.editorWidget.labelmapVolume.GetID()],
+                                                                          self.editorWidget.labelmapVolume.GetID()].toDictionary(),
                                                                       callbackStepFunction=self.updateProgressBar)
 
-            # Load rows
-            row = 0
-            for labelStat in self.lastAnalysisResults:
-                descr = labelStat.LabelDescription
-                if labelStat.AdditionalDescription:
-                    descr = "{0}. {1}".format(descr, labelStat.AdditionalDescription)
-                tooltip = "{0}: {1}".format(labelStat.LabelCode, descr)
-
-                # Label Color
-                col = 0
-
-                color = qt.QColor()
-                color.setRgb(labelStat.LabelRGBColor[0], labelStat.LabelRGBColor[1], labelStat.LabelRGBColor[2])
-                item = qt.QStandardItem()
-                item.setData(color, qt.Qt.DecorationRole)
-                item.setEditable(False)
-                item.setToolTip(tooltip)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Label name
-                col = 1
-                item = qt.QStandardItem()
-                item.setData(str(labelStat.LabelDescription), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                item.setToolTip(tooltip)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Count
-                col = 2
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.Count), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Area
-                col = 3
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.AreaMm2), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Min
-                col = 4
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.Min), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Max
-                col = 5
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.Max), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Mean
-                col = 6
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.Mean), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Standar Deviation
-                col = 7
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.StdDev), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Median
-                col = 8
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.Median), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                # Num.Slices
-                col = 9
-                item = qt.QStandardItem()
-                item.setData(float(labelStat.NumSlices), qt.Qt.DisplayRole)
-                item.setEditable(False)
-                self.statisticsTableModel.setItem(row, col, item)
-                self.items.append(item)
-
-                row += 1
-
-            # Set headers and colums data
-            # IMPORTANT: for some reason, this does not work if we do it before adding the items
+            self.__loadStatisticsTable__()
+
+            # Expand the panel and collapse the rest of the widget ones
+            self.statisticsCollapsibleButton.collapsed = False
+            self.structuresCollapsibleButton.collapsed = True
+            self.__collapseEditorWidget__(False)
+
+            # Make table visible
+            #self.tableView.visible = self.btnExport.visible = True
+            self.tableView.visible = True
+        except StopIteration as ex:
+            print("The process was interrupted by the user")
+
+    def __loadStatisticsTable__(self):
+        """Load the results of the last analysis (self.lastAnalysisResults) in the statistics table"""
+        self.statisticsTableModel = qt.QStandardItemModel()
+        self.tableView.setModel(self.statisticsTableModel)
+        self.tableView.verticalHeader().visible = False
+        # IMPORTANT: We need this list because otherwise the items seem to be removed from memory!
+        self.items = []
+
+        # Load rows
+        row = 0
+        for labelStat in self.lastAnalysisResults:
+            descr = labelStat.LabelDescription
+            if labelStat.AdditionalDescription:
+                descr = "{0}. {1}".format(descr, labelStat.AdditionalDescription)
+            tooltip = "{0}: {1}".format(labelStat.LabelCode, descr)
+
+            # Label Color
             col = 0
-            self.statisticsTableModel.setHeaderData(col, 1, " ")
-            self.tableView.setColumnWidth(col, 30)
 
-            col = 1
-            self.statisticsTableModel.setHeaderData(col, 1, "Label")
-            self.tableView.setColumnWidth(col, 125)
+            color = qt.QColor()
+            color.setRgb(labelStat.LabelRGBColor[0], labelStat.LabelRGBColor[1], labelStat.LabelRGBColor[2])
+            item = qt.QStandardItem()
+            item.setData(color, qt.Qt.DecorationRole)
+            item.setEditable(False)
+            item.setToolTip(tooltip)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Label name
+            col = 1
+            item = qt.QStandardItem()
+            item.setData(str(labelStat.LabelDescription), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            item.setToolTip(tooltip)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
+
+            # Count
             col = 2
-            self.statisticsTableModel.setHeaderData(col, 1, "Count")
-            self.tableView.setColumnWidth(col, 50)
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.Count), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Area
             col = 3
-            self.statisticsTableModel.setHeaderData(col, 1, "Area (mm2)")
-            self.tableView.setColumnWidth(col, 75)
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.AreaMm2), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Min
             col = 4
-            self.statisticsTableModel.setHeaderData(col, 1, "Min")
-            self.tableView.setColumnWidth(col, 45)
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.Min), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Max
             col = 5
-            self.statisticsTableModel.setHeaderData(col, 1, "Max")
-            self.tableView.setColumnWidth(col, 45)
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.Max), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Mean
             col = 6
-            self.statisticsTableModel.setHeaderData(col, 1, "Mean")
-            self.tableView.setColumnWidth(col, 65)
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.Mean), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Standar Deviation
             col = 7
-            self.statisticsTableModel.setHeaderData(col, 1, "Std.Dev.")
-            self.tableView.setColumnWidth(col, 65)
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.StdDev), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Median
             col = 8
-            self.statisticsTableModel.setHeaderData(col, 1, "Median")
-            self.tableView.setColumnWidth(col, 60)
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.Median), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
 
+            # Num.Slices
             col = 9
-            self.statisticsTableModel.setHeaderData(col, 1, "# Slices")
-            self.tableView.setColumnWidth(col, 50)
-
-            # Expand the panel and collapse the rest of the widget ones
-            self.statisticsCollapsibleButton.collapsed = False
-            self.structuresCollapsibleButton.collapsed = True
-            self.__collapseEditorWidget__(False)
-
-            # Make table visible
-            #self.tableView.visible = self.btnExport.visible = True
-            self.tableView.visible = True
-        except StopIteration as ex:
-            print("The process was interrupted by the user")
+            item = qt.QStandardItem()
+            item.setData(float(labelStat.NumSlices), qt.Qt.DisplayRole)
+            item.setEditable(False)
+            self.statisticsTableModel.setItem(row, col, item)
+            self.items.append(item)
+
+            row += 1
+
+        # Set headers and colums data
+        # IMPORTANT: for some reason, this does not work if we do it before adding the items
+        col = 0
+        self.statisticsTableModel.setHeaderData(col, 1, " ")
+        self.tableView.setColumnWidth(col, 30)
+
+        col = 1
+        self.statisticsTableModel.setHeaderData(col, 1, "Label")
+        self.tableView.setColumnWidth(col, 125)
+
+        col = 2
+        self.statisticsTableModel.setHeaderData(col, 1, "Count")
+        self.tableView.setColumnWidth(col, 50)
+
+        col = 3
+        self.statisticsTableModel.setHeaderData(col, 1, "Area (mm2)")
+        self.tableView.setColumnWidth(col, 75)
+
+        col = 4
+        self.statisticsTableModel.setHeaderData(col, 1, "Min")
+        self.tableView.setColumnWidth(col, 45)
+
+        col = 5
+        self.statisticsTableModel.setHeaderData(col, 1, "Max")
+        self.tableView.setColumnWidth(col, 45)
+
+        col = 6
+        self.statisticsTableModel.setHeaderData(col, 1, "Mean")
+        self.tableView.setColumnWidth(col, 65)
+
+        col = 7
+        self.statisticsTableModel.setHeaderData(col, 1, "Std.Dev.")
+        self.tableView.setColumnWidth(col, 65)
+
+        col = 8
+        self.statisticsTableModel.setHeaderData(col, 1, "Median")
+        self.tableView.setColumnWidth(col, 60)
+
+        col = 9
+        self.statisticsTableModel.setHeaderData(col, 1, "# Slices")
+        self.tableView.setColumnWidth(col, 50)
+
+    def refreshStatisticsIncremental(self):
+        """Refresh the statistics table recomputing only the slices of the labelmap that changed since the last
+        refresh"""
+        masterNode = self.getCurrentGrayscaleNode()
+        labelmapNode = self.getCurrentLabelMapNode()
+        modifiedRegion = self.__mergeRegions__(self.__pendingModifiedRegions__)
+        self.__pendingModifiedRegions__ = []
+        if not masterNode or not labelmapNode:
+            return
+        self.lastAnalysisResults = self.logic.calculateStatisticsIncremental(masterNode, labelmapNode,
+                                                                             modifiedRegion=modifiedRegion)
+        # Update the slices of every label just in the modified slices
+        sliceIndex = self.labelMapSlices.get(labelmapNode.GetID())
+        labelmapArray = slicer.util.arrayFromVolume(labelmapNode)
+        if sliceIndex is None or len(self.logic.lastModifiedSlices) == labelmapArray.shape[0]:
+            self.labelMapSlices[labelmapNode.GetID()] = self.logic.getLabelSliceIndex(labelmapNode)
+        else:
+            for sliceNumber in self.logic.lastModifiedSlices:
+                sliceIndex.updateSlice(sliceNumber, labelmapArray[sliceNumber])
+        self.__loadStatisticsTable__()
+        self.tableView.visible = True
+
+    def __observeLabelmapNode__(self):
+        """Observe the modifications of the current labelmap when the incremental statistics are active"""
+        labelmapNode = self.getCurrentLabelMapNode() if self.incrementalStatsCheckBox.checked else None
+        if labelmapNode is self.observedLabelmapNode:
+            return
+        self.__removeLabelmapObservers__()
+        self.observedLabelmapNode = labelmapNode
+        if labelmapNode is not None:
+            self.labelmapObserver = labelmapNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent,
+                                                             self.__onLabelmapImageDataModified__)
+            layoutManager = slicer.app.layoutManager()
+            for sliceViewName in layoutManager.sliceViewNames():
+                sliceWidget = layoutManager.sliceWidget(sliceViewName)
+                interactor = sliceWidget.sliceView().interactor()
+                sliceNode = sliceWidget.mrmlSliceNode()
+                # High priority, so that the observers are invoked before the editor effects
+                for event in (vtk.vtkCommand.LeftButtonPressEvent, vtk.vtkCommand.RightButtonPressEvent):
+                    tag = interactor.AddObserver(event, lambda caller, event, sliceNode=sliceNode:
+                                                 self.__onSliceViewButtonPressed__(sliceNode), 1.0)
+                    self.sliceViewsObservers.append((interactor, tag))
+                for event in (vtk.vtkCommand.LeftButtonReleaseEvent, vtk.vtkCommand.RightButtonReleaseEvent):
+                    tag = interactor.AddObserver(event, self.__onSliceViewButtonReleased__, 1.0)
+                    self.sliceViewsObservers.append((interactor, tag))
+
+    def __removeLabelmapObservers__(self):
+        """Stop observing the modifications of the labelmap and the slice views"""
+        if self.labelmapObserver is not None:
+            self.observedLabelmapNode.RemoveObserver(self.labelmapObserver)
+            self.labelmapObserver = None
+        self.observedLabelmapNode = None
+        for interactor, tag in self.sliceViewsObservers:
+            interactor.RemoveObserver(tag)
+        self.sliceViewsObservers = []
+        self.__editedSliceNode__ = None
+        self.__pendingModifiedRegions__ = []
+
+    def __getEditedRegion__(self, labelmapNode):
+        """Region of the labelmap array (tuple of slices z, y, x) that contains a modification that has just been made,
+        when it is known: a 2D effect of the editor (they only modify the slice where they are applied) applied in a
+        slice view aligned with the axes of the labelmap. A PaintEffect with the sphere option modifies all the slices
+        within the radius of the brush.
+        :return: tuple of slices or None if the region is unknown (ex: undo/redo, 3D effects, oblique views)
+        """
+        parameterNode = self.editorWidget.toolsBox.parameterNode
+        effect = parameterNode.GetParameter("effect")
+        if self.__editedSliceNode__ is None or effect not in self.SLICE_EFFECTS:
+            return None
+        rasToIJK = vtk.vtkMatrix4x4()
+        labelmapNode.GetRASToIJKMatrix(rasToIJK)
+        sliceToIJK = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(rasToIJK, self.__editedSliceNode__.GetSliceToRAS(), sliceToIJK)
+        normal = np.array([sliceToIJK.GetElement(i, 2) for i in range(3)])
+        axis = int(np.argmax(np.abs(normal)))
+        if abs(normal[axis]) < 0.999 * np.linalg.norm(normal):
+            # Oblique slice
+            return None
+        index = int(round(sliceToIJK.GetElement(axis, 3)))
+        # One extra voxel in every side in case that the slice is not centered
+        margin = 1
+        if effect == "PaintEffect" and parameterNode.GetParameter("PaintEffect,sphere") == "1":
+            try:
+                radius = float(parameterNode.GetParameter("PaintEffect,radius"))
+            except ValueError:
+                # Unknown radius
+                return None
+            margin += int(np.ceil(radius / labelmapNode.GetSpacing()[axis]))
+        region = [slice(None)] * 3
+        # Numpy axes are in z, y, x order
+        region[2 - axis] = slice(max(index - margin, 0), max(index + margin + 1, 0))
+        return tuple(region)
+
+    @staticmethod
+    def __mergeRegions__(regions):
+        """Bounding box of several regions of the labelmap array (see __getEditedRegion__)
+        :return: tuple of slices or None if there are no regions or any of them is unknown
+        """
+        if len(regions) == 0 or any(region is None for region in regions):
+            return None
+        merged = []
+        for axis in range(3):
+            slices = [region[axis] for region in regions]
+            if any(s.start is None for s in slices):
+                merged.append(slice(None))
+            else:
+                merged.append(slice(min(s.start for s in slices), max(s.stop for s in slices)))
+        return tuple(merged)
 
     def updateProgressBar(self, text):
         if self.progressBar.wasCanceled:
@@ -908,27 +1048,34 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
             # Close the window
             self.progressBar.close()
 
-    def getCurrentSlicesForCurrentLabel(self):
-        """Get an array with the list of slices where the current label is present in the current labelmap.
-        Return None in case there is any problem or the label is not present"""
+    def getCurrentLabelCode(self):
+        """Get the label code of the structure selected in the comboboxes (0 if there is any problem)"""
         try:
             region = self.regionComboBox.itemData(self.regionComboBox.currentIndex)
             ctype = self.typeComboBox.itemData(self.typeComboBox.currentIndex)
             item = self.logic.getItem(region, ctype)
-            labelCode = self.logic.getIntCodeItem(item)
+            return self.logic.getIntCodeItem(item)
+        except:
+            return 0
+
+    def getCurrentSlicesForCurrentLabel(self):
+        """Get an array with the list of slices where the current label is present in the current labelmap.
+        Return None in case there is any problem or the label is not present"""
+        try:
+            labelCode = self.getCurrentLabelCode()
 
             if labelCode == 0:
                 # Empty label
                 return None
 
-            # Get a dictionary of [labelCode:array of slices] for the current labelmap volume
-            slices = self.labelMapSlices[self.getCurrentLabelMapNode().GetID()]
+            # Get the LabelSliceIndex for the current labelmap volume
+            sliceIndex = self.labelMapSlices[self.getCurrentLabelMapNode().GetID()]
 
-            if labelCode not in slices:
+            if labelCode not in sliceIndex:
                 # Label not present
                 return None
             # Return the array with the number of slices
-            return slices[labelCode]
+            return sliceIndex.getSlices(labelCode)
 
         except:
             return None
@@ -949,45 +1096,34 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         # Get the K coordinate (slice number in IJK coordinate)
         sliceK = transformationMatrix.MultiplyPoint([0, 0, rasSliceOffset, 1])[2]
 
-        slices = self.getCurrentSlicesForCurrentLabel()
-        if slices is None:
+        labelmap = self.getCurrentLabelMapNode()
+        sliceIndex = self.labelMapSlices[labelmap.GetID()]
+        labelCode = self.getCurrentLabelCode()
+        if labelCode not in sliceIndex:
             # If the label is not present (or there is none selected) take all the slices with any label
-            labelmap = self.getCurrentLabelMapNode()
-            allLabels = self.labelMapSlices[labelmap.GetID()]
-            if len(allLabels) == 0:
+            labelCode = None
+            if len(sliceIndex.labels) == 0:
                 # Try to sync the labelmaps
                 logging.debug("No values in labelmap. Trying to sync...")
                 self.__sliceChecking__(labelmap, forceRefresh=True)
                 # Retry
-                allLabels = self.labelMapSlices[labelmap.GetID()]
-                if len(allLabels) == 0:
+                sliceIndex = self.labelMapSlices[labelmap.GetID()]
+                if len(sliceIndex.labels) == 0:
                     # Still no labels
                     qt.QMessageBox.warning(slicer.util.mainWindow(), 'Warning',
                                        'There are no any values in the labelmap. Please press "Refresh labelmap info" button.')
                     return
-            slices = np.unique(np.concatenate([x for x in list(allLabels.values())]))
 
         # Get the tolerance as an error factor when converting RAS-IJK. The value will depend on
         # the transformation matrix for this node
         transformationMatrix.Invert()
         tolerance = transformationMatrix.GetElement(2, 2)
 
+        # Continuous navigation: after the last slice we go to the first one (and viceversa)
         if (backwards):
-            # backwards navigation
-            try:
-                # Get the previous slice
-                slice = max(x for x in slices if x < sliceK and abs(sliceK - x) > tolerance)
-            except:
-                # Get the last slice (continuous navigation)
-                slice = max(x for x in slices)
+            slice = sliceIndex.previousSlice(sliceK, labelCode, tolerance)
         else:
-            # Forward navigation
-            try:
-                # Get the next slice
-                slice = min(x for x in slices if x > sliceK and abs(x - sliceK) > tolerance)
-            except:
-                # Get the first slice (continuous navigation)
-                slice = min(x for x in slices)
+            slice = sliceIndex.nextSlice(sliceK, labelCode, tolerance)
 
         # Convert the slice to RAS (reverse transformation)
         sliceS = transformationMatrix.MultiplyPoint([0, 0, slice, 1])[2]
@@ -1017,6 +1153,8 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         self.__preventDialogs__ = prevent
 
     def cleanup(self):
+        self.incrementalStatsTimer.stop()
+        self.__removeLabelmapObservers__()
         self.editorWidget.helper.masterSelector.disconnect("currentNodeChanged(vtkMRMLNode*)", self.onMasterNodeSelect)
         self.reportsWidget.cleanup()
         self.reportsWidget = None
@@ -1125,6 +1263,26 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
     # def onBtnRefreshClicked(self):
     #     self.checkMasterAndLabelMapNodes()
 
+    def onIncrementalStatsStateChanged(self, state):
+        self.__observeLabelmapNode__()
+        if self.incrementalStatsCheckBox.checked:
+            self.refreshStatisticsIncremental()
+
+    def __onLabelmapImageDataModified__(self, caller, event):
+        self.__pendingModifiedRegions__.append(self.__getEditedRegion__(caller))
+        self.incrementalStatsTimer.start()
+
+    def __onSliceViewButtonPressed__(self, sliceNode):
+        self.__editedSliceNode__ = sliceNode
+
+    def __onSliceViewButtonReleased__(self, caller, event):
+        # The effects are applied when the button is released, so the slice view is forgotten just after that.
+        # Any other modification (ex: undo with the keyboard) will be analyzed in the whole labelmap
+        qt.QTimer.singleShot(0, self.__forgetEditedSliceNode__)
+
+    def __forgetEditedSliceNode__(self):
+        self.__editedSliceNode__ = None
+
     def onAutoUpdateStateChanged(self, isAutoUpdate):
         SlicerUtil.setSetting("CIP_BodyComposition", "AutoUpdate", isAutoUpdate)
 
@@ -1175,6 +1333,8 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         # Reset the region/type comboboxes to be adjusted properly with the next volume
         self.regionComboBox.currentIndex = 0
         self.resetModuleState()
+        self.incrementalStatsCheckBox.setChecked(False)
+        self.logic.clearIncrementalStatistics()
 
 
 #
@@ -1186,6 +1346,10 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
         """Constructor. """
         ScriptedLoadableModuleLogic.__init__(self)
         self.params = BodyCompositionParameters()
+        # Partial aggregates used by calculateStatisticsIncremental
+        self.__incrementalState__ = None
+        # Slices recomputed in the last call to calculateStatisticsIncremental
+        self.lastModifiedSlices = []
 
     def settingGetOrSetDefault(self, settingName, settingDefaultValue):
         """Try to find the value of a setting and, if it does not exist, set ot to the defaultValue"""
@@ -1196,6 +1360,10 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
         slicer.app.settings().setValue(settingName, settingDefaultValue)
         return settingDefaultValue
 
+    def getLabelSliceIndex(self, labelmapNode):
+        """Get a LabelSliceIndex with the slices where every label appears in a labelmap node"""
+        return LabelSliceIndex(slicer.util.arrayFromVolume(labelmapNode))
+
     def getLabelmapSlices(self, labelmapNode):
         """For each label map, get the slices where it appears. Store the result in labelmapSlices object
         (it will be used later for statistics)"""
@@ -1220,12 +1388,121 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
         else:
             self.getLabelmapSlices(labelNode)
 
-        # List where we will store all the "StatsWrapper" result objects
-        self.stats = []
-
         # Get the spacial resolution to calculate areas
         spacing = grayscaleNode.GetSpacing()
 
+        # Statistics for all the labels in a single pass
+        groupedStats = GroupedStatistics(intensityArray, labelMapArray)
+
+        def labelStats(labelCode):
+            if labelCode not in self.labelmapSlices:
+                # The label is not present in the label map. Return empty stats object
+                return StatsWrapper()
+            stat = self.getStatsFromGroupedStatistics(groupedStats, labelCode, spacing[0], spacing[1])
+            stat.NumSlices = len(self.labelmapSlices[labelCode])
+            return stat
+
+        def nonLeanStats(preprocessingCode, labelCode):
+            stat = self.performAnalysisWithPreprocessing(preprocessingCode, labelCode, intensityArray,
+                                                         labelMapArray, spacing[0], spacing[1])
+            stat.NumSlices = len(self.labelmapSlices[labelCode])
+            return stat
+
+        return self.__buildStatsWrappers__(labelStats, nonLeanStats, callbackStepFunction)
+
+    def calculateStatisticsIncremental(self, grayscaleNode, labelNode, modifiedSlices=None, callbackStepFunction=None,
+                                       modifiedRegion=None):
+        """ Same results as calculateStatistics, but reusing the partial aggregates of the previous call when the nodes
+        are the same, so that only the slices of the labelmap that were modified since then are recomputed.
+        :param grayscaleNode: grayscale volume node (integer scalars)
+        :param labelNode: labelmap volume node
+        :param modifiedSlices: indexes of the modified slices, when known. Otherwise they are found comparing the
+        labelmap with a copy of the one used in the previous call
+        :param callbackStepFunction: function to report the progress
+        :param modifiedRegion: tuple of slices (z, y, x) of the labelmap array that contains all the modifications since
+        the previous call, when it is known. The comparison with the copy is restricted to that region
+        :return: list of StatsWrapper objects
+        """
+        intensityArray = slicer.util.arrayFromVolume(grayscaleNode)
+        labelMapArray = slicer.util.arrayFromVolume(labelNode)
+        if intensityArray.dtype.kind not in "ui":
+            # Full computation. All the slices must be refreshed
+            self.lastModifiedSlices = np.arange(labelMapArray.shape[0])
+            return self.calculateStatistics(grayscaleNode, labelNode, callbackStepFunction=callbackStepFunction)
+
+        key = (grayscaleNode.GetID(), grayscaleNode.GetImageData().GetMTime(), labelNode.GetID(), labelMapArray.shape)
+        state = self.__incrementalState__
+        if state is None or state["Key"] != key:
+            # First call for these nodes (or the grayscale image changed). Compute all the slices
+            state = self.__incrementalState__ = {
+                "Key": key,
+                "Labelmap": labelMapArray.copy(),
+                "Stats": IncrementalStatistics(intensityArray, labelMapArray),
+                # One IncrementalStatistics for every label that needs preprocessing, computed on the closed label
+                "ClosedStats": {}
+            }
+            modifiedSlices = np.arange(labelMapArray.shape[0])
+            for item in self.params.allowedCombinationsParameters:
+                preprocessingCode = self.params.getPreprocessingType(item)
+                if preprocessingCode == 1:
+                    labelCode = self.getIntCodeItem(item)
+                    state["ClosedStats"][labelCode] = IncrementalStatistics(
+                        intensityArray, SlabMorphology.closeLabel(labelMapArray, labelCode))
+        else:
+            if modifiedSlices is None:
+                modifiedSlices = IncrementalStatistics.findModifiedSlices(state["Labelmap"], labelMapArray,
+                                                                          modifiedRegion)
+            else:
+                modifiedSlices = np.unique(np.asarray(modifiedSlices, dtype=np.intp))
+            if modifiedSlices.size > 0:
+                state["Labelmap"][modifiedSlices] = labelMapArray[modifiedSlices]
+                intensitySlab = intensityArray[modifiedSlices]
+                labelmapSlab = labelMapArray[modifiedSlices]
+                state["Stats"].updateSlices(modifiedSlices, intensitySlab, labelmapSlab)
+                # The closing is 3x3x1, so the closed label in a slice only depends on that slice
+                for labelCode, closedStats in state["ClosedStats"].items():
+                    closedStats.updateSlices(modifiedSlices, intensitySlab,
+                                             SlabMorphology.closeLabel(labelmapSlab, labelCode))
+
+        self.lastModifiedSlices = modifiedSlices
+        SlicerUtil.logDevelop("Incremental statistics: {0} slices recomputed".format(len(modifiedSlices)),
+                              includePythonConsole=False)
+        incrementalStats = state["Stats"]
+        self.labelmapSlices = incrementalStats.getLabelmapSlices()
+        spacing = grayscaleNode.GetSpacing()
+
+        def labelStats(labelCode):
+            stat = self.getStatsFromGroupedStatistics(incrementalStats, labelCode, spacing[0], spacing[1])
+            i = incrementalStats.getLabelIndex(labelCode)
+            if i is not None:
+                stat.NumSlices = int(incrementalStats.numSlices[i])
+            return stat
+
+        def nonLeanStats(preprocessingCode, labelCode):
+            closedStats = state["ClosedStats"].get(labelCode)
+            if closedStats is None:
+                return StatsWrapper()
+            stat = self.getStatsFromGroupedStatistics(closedStats, 1, spacing[0], spacing[1])
+            stat.NumSlices = int(incrementalStats.numSlices[incrementalStats.getLabelIndex(labelCode)])
+            return stat
+
+        return self.__buildStatsWrappers__(labelStats, nonLeanStats, callbackStepFunction)
+
+    def clearIncrementalStatistics(self):
+        """ Release the partial aggregates stored by calculateStatisticsIncremental"""
+        self.__incrementalState__ = None
+
+    def __buildStatsWrappers__(self, labelStatsFunction, nonLeanStatsFunction, callbackStepFunction=None):
+        """ Build the list of StatsWrapper results for all the allowed structures
+        :param labelStatsFunction: function(labelCode) that returns the StatsWrapper for a label
+        :param nonLeanStatsFunction: function(preprocessingCode, labelCode) that returns the StatsWrapper for a
+        preprocessed label. It is only invoked when the label is present in the labelmap
+        :param callbackStepFunction: function to report the progress
+        :return: list of StatsWrapper objects
+        """
+        # List where we will store all the "StatsWrapper" result objects
+        self.stats = []
+
         for item in (x for x in self.params.allowedCombinationsParameters if self.getIntCodeItem(x) != 0):
             # Description of the label
             labelCode = self.getIntCodeItem(item)
@@ -1234,17 +1511,7 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
             if callbackStepFunction:
                 callbackStepFunction("Calculating {0}...".format(label))
 
-                # Use just the slices that contain data
-            if labelCode in self.labelmapSlices:
-                trimmedIntensityArray = intensityArray[self.labelmapSlices[labelCode], :, :]
-                trimmedLabelmapArray = labelMapArray[self.labelmapSlices[labelCode], :, :]
-                stat = self.performAnalysisForItem(labelCode, trimmedIntensityArray, trimmedLabelmapArray, spacing[0],
-                                                   spacing[1])
-                stat.NumSlices = len(self.labelmapSlices[labelCode])
-            else:
-                # The label is not present in the label map. Return empty stats object
-                stat = StatsWrapper()
-
+            stat = labelStatsFunction(labelCode)
             stat.LabelCode = labelCode
 
             stat.LabelDescription = label
@@ -1260,9 +1527,7 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
                     # No need to perform any analysis if the label does not exist in the labelmap
                     stat = StatsWrapper()
                 else:
-                    stat = self.performAnalysisWithPreprocessing(preprocessingCode, labelCode, intensityArray,
-                                                                 self.labelmapImageData, spacing[0], spacing[1])
-                    stat.NumSlices = len(self.labelmapSlices[labelCode])
+                    stat = nonLeanStatsFunction(preprocessingCode, labelCode)
 
                 # Same label but adding "(not lean)" to the region-Type
                 stat.LabelCode = labelCode
@@ -1275,6 +1540,42 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
                 self.stats.append(stat)
         return self.stats
 
+    def runBatch(self, manifestPath, outputPath, progressFilePath=None, numWorkers=None, callbackStepFunction=None):
+        """ Analyze a list of segmented cases stored in disk, without loading them in the scene.
+        See BodyCompositionBatch for the format of the files
+        :param manifestPath: csv file with rows (CT path, labelmap path[, case id])
+        :param outputPath: csv file where the results will be appended (one row per label)
+        :param progressFilePath: file with the completed cases, used to resume the process (default: outputPath + ".progress")
+        :param numWorkers: number of cases analyzed in parallel threads (default: number of cpus)
+        :param callbackStepFunction: function(caseId, error) invoked every time that a case is finished
+        :return: list of tuples (case id, error message) for the cases that failed
+        """
+        # Threads: a new process would start a new instance of Slicer
+        return BodyCompositionBatch(numWorkers, useProcesses=False).run(manifestPath, outputPath,
+                                                                        progressFilePath=progressFilePath,
+                                                                        callbackStepFunction=callbackStepFunction)
+
+    def getStatsFromGroupedStatistics(self, groupedStats, labelCode, spacingX, spacingY):
+        """Build a StatsWrapper object for a label from the statistics calculated for all the labels at once.
+            Parameters:
+            - groupedStats: GroupedStatistics object
+            - labelCode: label
+            - spacingX,spacingY: spacial resolution
+            It returns a StatsWrapper object with the numerical data"""
+        stats = StatsWrapper()
+        values = groupedStats.getStatistics(labelCode)
+        if values is None:
+            # The label is not present in the labelmap. Return an empty object
+            return stats
+        stats.Count = values["Count"]
+        stats.AreaMm2 = stats.Count * spacingX * spacingY  # In case that horizontal and vertical are differents
+        stats.Min = values["Min"]
+        stats.Max = values["Max"]
+        stats.Mean = values["Mean"]
+        stats.StdDev = values["StdDev"]
+        stats.Median = values["Median"]
+        return stats
+
     def performAnalysisForItem(self, labelCode, intensityArray, labelMapArray, spacingX, spacingY):
         """Perform the numeric operations for this label.
             Parameters:
@@ -1307,7 +1608,7 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
 
             return stats
 
-    def performAnalysisWithPreprocessing(self, preprocessingCode, labelCode, grayScaleArray, labelmapImageData,
+    def performAnalysisWithPreprocessing(self, preprocessingCode, labelCode, grayScaleArray, labelMapArray,
                                          spacingX, spacingY):
         """Preprocess a label map image and calculates a new intensity image.
         The kind of preprocessing depends on preprocessingCode (see BodyCompositionParameters).
@@ -1318,54 +1619,14 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
                 # Get the slices for this labelCode
                 slices = self.labelmapSlices[labelCode]
 
-                # Slicing filter. We will use this filter to extract just the slices with data in a vtk format
-                resliceFilter = vtk.vtkImageReslice()
-                resliceFilter.SetInputData(labelmapImageData)
-                resliceFilter.SetOutputDimensionality(2)
-                resliceFilter.SetInterpolationModeToNearestNeighbor()
-                mm = vtk.vtkMatrix4x4()
-                width = labelmapImageData.GetDimensions()[0]
-                height = labelmapImageData.GetDimensions()[1]
-                centerX = width / 2
-                centerY = height / 2
-                center = [centerX, centerY, 0]
-                mm.DeepCopy(((1, 0, 0, center[0], 0, 1, 0, center[1], 0, 0, 1, center[2], 0, 0, 0, 1)))
-                resliceFilter.SetResliceAxes(mm)
-
-                # Closing vtkFilter (general)
-                closeFilter = vtk.vtkImageOpenClose3D()
-                closeFilter.SetKernelSize(3, 3, 1)
-                # filter.ReleaseDataFlagOff()
-                closeFilter.SetOpenValue(0)
-                closeFilter.SetCloseValue(labelCode)
-                # The input for this filter will be updated dynamically with the output from the slicing filter
-                closeFilter.SetInputConnection(resliceFilter.GetOutputPort())
-
-                # Init a numpy array where we will store an array per slice
-                label_compound = np.zeros([len(slices), height, width])
-                i = 0
-                for slice in slices:
-                    # Configure the slicing values
-                    mm.SetElement(2, 3, slice)
-                    # Update the closing filter for this slice. It will execute the close just in this slice
-                    closeFilter.Update()
-                    # Get the labelmapImageData object for this slice
-                    imData = closeFilter.GetOutput()
-
-                    # Convert imData in a numpy array
-                    shape = list(imData.GetDimensions())
-                    shape.reverse()
-                    lArray = vtk.util.numpy_support.vtk_to_numpy(imData.GetPointData().GetScalars()).reshape(shape)
-
-                    # Add to the matrix of numpy arrays
-                    label_compound[i, :, :] = lArray[0, :, :]
-                    i = + 1
+                # Extract all the slices with data as a single slab and apply a 3x3x1 closing to the whole slab
+                closedLabelArray = SlabMorphology.closeLabel(labelMapArray[slices, :, :], labelCode)
 
                 # Extract the corresponding slices from the grayscale image
                 slicedGrayscaleArray = grayScaleArray[slices, :, :]
 
-                # Perform the stats just for this array
-                return self.performAnalysisForItem(labelCode, slicedGrayscaleArray, label_compound, spacingX, spacingY)
+                # Perform the stats just for this array (the closed label is stored as 1)
+                return self.performAnalysisForItem(1, slicedGrayscaleArray, closedLabelArray, spacingX, spacingY)
             else:
                 # The label is not present in the labelmap. Return an empty object
                 return StatsWrapper()
@@ -0,0 +1,237 @@
+"""
+Headless body composition analysis for a list of previously segmented cases.
+It does not need Slicer (just numpy and SimpleITK), so it can be run from a regular python interpreter:
+    python -m CIP_BodyComposition_logic manifest.csv results.csv --workers 8
+(from the CIP_BodyComposition module folder, see __main__.py).
+The manifest is a csv file where every row contains the path to the CT, the path to the body composition labelmap
+and, optionally, the case id (by default, the path of the CT relative to the manifest folder, without extension).
+Relative paths are relative to the folder of the manifest, not to the current folder.
+The case ids must be unique. Empty lines and lines that start with '#' are ignored.
+The results are written in the same format as the reports saved in the module (one row per label).
+Every case that has been processed is written in a progress file, so that the process can be resumed after
+an interruption skipping the cases that were already completed.
+"""
+import csv
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import SimpleITK as sitk
+
+from .BodyCompositionParameters import BodyCompositionParameters
+from .GroupedStatistics import GroupedStatistics
+from .SlabMorphology import SlabMorphology
+
+
+class BodyCompositionBatch(object):
+    # Same columns as the reports saved in CIP_BodyComposition module
+    COLUMNS = ["date", "caseId", "regionType", "label", "count", "area", "min", "max", "mean", "std", "median",
+               "numSlices"]
+
+    def __init__(self, numWorkers=None, useProcesses=False):
+        """
+        :param numWorkers: number of cases analyzed in parallel (default: number of cpus).
+        If numWorkers == 1 the cases are processed one after another in the calling thread
+        :param useProcesses: analyze the cases in a pool of processes instead of threads. It should only be used from
+        a regular python interpreter (see __main__.py): inside Slicer a new process would start a new instance of
+        the application
+        """
+        self.numWorkers = numWorkers if numWorkers is not None else (os.cpu_count() or 1)
+        self.useProcesses = useProcesses
+
+    @staticmethod
+    def readManifest(manifestPath):
+        """ Read the list of cases to process
+        :param manifestPath: csv file with rows (CT path, labelmap path[, case id]). Relative paths are relative to
+        the folder of the manifest
+        :return: list of tuples (case id, absolute CT path, absolute labelmap path)
+        """
+        cases = []
+        lines = {}
+        manifestFolder = os.path.dirname(os.path.abspath(manifestPath))
+        with open(manifestPath, 'r') as f:
+            reader = csv.reader(f)
+            for row in reader:
+                if len(row) == 0 or row[0].strip() == "" or row[0].startswith("#"):
+                    continue
+                if len(row) < 2 or row[1].strip() == "":
+                    raise ValueError("{0}, line {1}: expected 'CT path, labelmap path[, case id]'"
+                                     .format(manifestPath, reader.line_num))
+                ctPath = os.path.normpath(os.path.join(manifestFolder, row[0].strip()))
+                labelmapPath = os.path.normpath(os.path.join(manifestFolder, row[1].strip()))
+                if len(row) > 2 and row[2].strip() != "":
+                    caseId = row[2].strip()
+                else:
+                    caseId = BodyCompositionBatch.defaultCaseId(ctPath, manifestFolder)
+                if caseId in lines:
+                    raise ValueError("{0}, line {1}: the case id '{2}' was already used in line {3}"
+                                     .format(manifestPath, reader.line_num, caseId, lines[caseId]))
+                lines[caseId] = reader.line_num
+                cases.append((caseId, ctPath, labelmapPath))
+        return cases
+
+    @staticmethod
+    def defaultCaseId(ctPath, manifestFolder):
+        """ Case id of a CT that has no explicit id in the manifest: path relative to the manifest folder (absolute if
+        it is in a different drive), with "/" separators and without extension (ex: "a/ct.nrrd" => "a/ct")
+        :param ctPath: absolute path to the CT
+        :param manifestFolder: absolute path to the folder of the manifest
+        :return: case id
+        """
+        try:
+            caseId = os.path.relpath(ctPath, manifestFolder)
+        except ValueError:
+            # Windows: different drives
+            caseId = ctPath
+        folder, fileName = os.path.split(caseId)
+        # Remove all the extensions (ex: .nii.gz)
+        return os.path.join(folder, fileName.split(".")[0]).replace(os.sep, "/")
+
+    @staticmethod
+    def readProgress(progressFilePath):
+        """ Case ids that were already completed in a previous execution
+        :param progressFilePath: path to the progress file
+        :return: set of case ids
+        """
+        if not os.path.isfile(progressFilePath):
+            return set()
+        with open(progressFilePath, 'r') as f:
+            return set(line.strip() for line in f if line.strip() != "")
+
+    @staticmethod
+    def getLabelmapSlices(labelmapArray):
+        """ Slices where every label is present, with a single pass over the labelled voxels
+        :param labelmapArray: integer numpy array (slices, rows, cols)
+        :return: dictionary of [label_Code: numpy array of slices]
+        """
+        numSlices = labelmapArray.shape[0]
+        mask = labelmapArray != 0
+        voxelSlices = np.repeat(np.arange(numSlices), np.count_nonzero(mask.reshape(numSlices, -1), axis=1))
+        labels, groups = GroupedStatistics.groupLabels(labelmapArray[mask])
+        pairs = np.unique(voxelSlices * max(labels.size, 1) + groups)
+        pairSlices = pairs // max(labels.size, 1)
+        pairGroups = pairs % max(labels.size, 1)
+        return dict((labels[i], pairSlices[pairGroups == i]) for i in range(labels.size))
+
+    @staticmethod
+    def analyzeArrays(intensityArray, labelmapArray, spacing, parameters=None):
+        """ Body composition statistics for all the allowed structures (including the "non lean" variants obtained
+        with a morphologic closing), with the same results as CIP_BodyCompositionLogic.calculateStatistics
+        :param intensityArray: numpy array (slices, rows, cols) with the gray levels
+        :param labelmapArray: integer numpy array (same shape) with the labels
+        :param spacing: spacing of the volume (x, y, z)
+        :param parameters: BodyCompositionParameters object (optional)
+        :return: list of OrderedDict (one per structure) with the keys: regionType, label, count, area, min, max,
+        mean, std, median, numSlices
+        """
+        if parameters is None:
+            parameters = BodyCompositionParameters()
+        labelmapSlices = BodyCompositionBatch.getLabelmapSlices(labelmapArray)
+        groupedStats = GroupedStatistics(intensityArray, labelmapArray)
+        pixelArea = spacing[0] * spacing[1]
+
+        def row(labelCode, description, stats, numSlices):
+            if stats is None:
+                stats = {"Count": 0, "Min": 0, "Max": 0, "Mean": 0, "StdDev": 0, "Median": 0}
+                numSlices = 0
+            return OrderedDict((("regionType", labelCode), ("label", description), ("count", stats["Count"]),
+                                ("area", stats["Count"] * pixelArea), ("min", stats["Min"]), ("max", stats["Max"]),
+                                ("mean", stats["Mean"]), ("std", stats["StdDev"]), ("median", stats["Median"]),
+                                ("numSlices", numSlices)))
+
+        rows = []
+        for item in (x for x in parameters.allowedCombinationsParameters if parameters.getIntCodeItem(x) != 0):
+            labelCode = parameters.getIntCodeItem(item)
+            description = parameters.getFullStringDescriptionItem(item)
+            stats = groupedStats.getStatistics(labelCode)
+            numSlices = len(labelmapSlices[labelCode]) if labelCode in labelmapSlices else 0
+            rows.append(row(labelCode, description, stats, numSlices))
+
+            if parameters.getPreprocessingType(item) == 1:
+                # Morphologic closing of the label in the slices that contain it (non lean tissue)
+                closedStats = None
+                if stats is not None:
+                    slices = labelmapSlices[labelCode]
+                    closedLabelArray = SlabMorphology.closeLabel(labelmapArray[slices], labelCode)
+                    closedStats = GroupedStatistics(intensityArray[slices], closedLabelArray).getStatistics(1)
+                rows.append(row(labelCode, description + " (non lean)", closedStats, numSlices))
+        return rows
+
+    @staticmethod
+    def analyzeCase(caseId, ctPath, labelmapPath):
+        """ Read a case from disk and analyze it
+        :return: tuple (case id, list of rows)
+        """
+        ct = sitk.ReadImage(ctPath)
+        labelmap = sitk.ReadImage(labelmapPath)
+        rows = BodyCompositionBatch.analyzeArrays(sitk.GetArrayViewFromImage(ct),
+                                                  sitk.GetArrayViewFromImage(labelmap), ct.GetSpacing())
+        return caseId, rows
+
+    def run(self, manifestPath, outputPath, progressFilePath=None, callbackStepFunction=None):
+        """ Analyze all the cases in a manifest that were not processed yet, appending the results to a csv file.
+        A case is written in the progress file only after all its rows have been saved, so a case that was
+        interrupted or failed will be processed again in the next execution
+        :param manifestPath: csv file with rows (CT path, labelmap path[, case id])
+        :param outputPath: csv file where the results will be appended
+        :param progressFilePath: file with the completed case ids (default: outputPath + ".progress")
+        :param callbackStepFunction: function(caseId, error) invoked every time that a case is finished
+        (error is None if the case was processed successfully)
+        :return: list of tuples (case id, error message) for the cases that failed
+        """
+        if progressFilePath is None:
+            progressFilePath = outputPath + ".progress"
+        completed = self.readProgress(progressFilePath)
+        pending = [case for case in self.readManifest(manifestPath) if case[0] not in completed]
+        errors = []
+
+        writeHeader = not os.path.isfile(outputPath) or os.path.getsize(outputPath) == 0
+        with open(outputPath, 'a') as outputFile, open(progressFilePath, 'a') as progressFile:
+            writer = csv.DictWriter(outputFile, fieldnames=self.COLUMNS)
+            if writeHeader:
+                writer.writeheader()
+
+            def saveCase(caseId, rows):
+                date = time.strftime("%Y/%m/%d %H:%M:%S")
+                for row in rows:
+                    writer.writerow(dict(row, date=date, caseId=caseId))
+                outputFile.flush()
+                progressFile.write(caseId + "\n")
+                progressFile.flush()
+
+            def reportError(caseId, error):
+                errors.append((caseId, error))
+                if callbackStepFunction:
+                    callbackStepFunction(caseId, error)
+
+            if self.numWorkers <= 1:
+                for case in pending:
+                    try:
+                        saveCase(*self.analyzeCase(*case))
+                        if callbackStepFunction:
+                            callbackStepFunction(case[0], None)
+                    except Exception:
+                        reportError(case[0], traceback.format_exc())
+            else:
+                # The workers just return the rows. All the files are written from this thread
+                if self.useProcesses:
+                    executor = ProcessPoolExecutor(max_workers=self.numWorkers)
+                else:
+                    # SimpleITK IO and most of the numpy operations release the GIL
+                    executor = ThreadPoolExecutor(max_workers=self.numWorkers)
+                with executor:
+                    futures = dict((executor.submit(BodyCompositionBatch.analyzeCase, *case), case[0])
+                                   for case in pending)
+                    for future in as_completed(futures):
+                        caseId = futures[future]
+                        try:
+                            saveCase(*future.result())
+                            if callbackStepFunction:
+                                callbackStepFunction(caseId, None)
+                        except Exception:
+                            reportError(caseId, traceback.format_exc())
+        return errors
+
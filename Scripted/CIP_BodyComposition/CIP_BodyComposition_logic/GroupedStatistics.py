@@ -0,0 +1,102 @@
+import numpy as np
+
+
+class GroupedStatistics(object):
+    """Intensity statistics (count, sum, sum of squares, min, max, mean, std, median) for every label of a
+    labelmap, calculated with a single pass over the labelled voxels instead of building a mask per label.
+    Counts and sums are obtained with bincount, and min/max/median from one sort of the voxels grouped by label.
+    All the results are numpy arrays aligned with the "labels" array"""
+
+    def __init__(self, intensityArray, labelmapArray, ignoreBackground=True):
+        """
+        :param intensityArray: numpy array with the gray levels
+        :param labelmapArray: integer numpy array (same shape as intensityArray) with the labels
+        :param ignoreBackground: do not calculate statistics for label 0
+        """
+        if ignoreBackground:
+            mask = labelmapArray != 0
+            labels = labelmapArray[mask]
+            values = intensityArray[mask]
+        else:
+            labels = labelmapArray.ravel()
+            values = intensityArray.ravel()
+
+        self.labels, groups = self.groupLabels(labels)
+        self.__compute__(groups, values)
+
+    @staticmethod
+    def groupLabels(labels):
+        """ Get the sorted unique labels and the index of the group (position in the unique labels) of every voxel.
+        It uses a lookup table (linear time) when the labels are non-negative integers
+        :param labels: 1D numpy array of labels
+        :return: tuple (unique labels, group index of every voxel)
+        """
+        if labels.size > 0 and labels.dtype.kind in "ui" and labels.min() >= 0:
+            counts = np.bincount(labels)
+            uniqueLabels = np.flatnonzero(counts)
+            lut = np.zeros(counts.size, dtype=np.intp)
+            lut[uniqueLabels] = np.arange(uniqueLabels.size)
+            return uniqueLabels.astype(labels.dtype), lut[labels]
+        uniqueLabels, groups = np.unique(labels, return_inverse=True)
+        return uniqueLabels, groups.ravel()
+
+    def __compute__(self, groups, values):
+        numGroups = self.labels.size
+        self.counts = np.bincount(groups, minlength=numGroups)
+        fvalues = values.astype(np.float64)
+        self.sums = np.bincount(groups, weights=fvalues, minlength=numGroups)
+        self.sumSquares = np.bincount(groups, weights=fvalues * fvalues, minlength=numGroups)
+
+        # Sort the voxels by group and then by value, so that every group is a sorted contiguous segment
+        sortedValues = self.sortByGroupAndValue(groups, values)
+        starts = np.zeros(numGroups, dtype=np.intp)
+        np.cumsum(self.counts[:-1], out=starts[1:])
+        self.mins = sortedValues[starts]
+        self.maxs = sortedValues[starts + self.counts - 1]
+        # Same convention as numpy.median (mean of the two central values when the count is even)
+        self.medians = (sortedValues[starts + (self.counts - 1) // 2].astype(np.float64) +
+                        sortedValues[starts + self.counts // 2]) / 2.0
+
+        self.means = self.sums / self.counts
+        variances = self.sumSquares / self.counts - self.means * self.means
+        self.stds = np.sqrt(np.maximum(variances, 0))
+
+    @staticmethod
+    def sortByGroupAndValue(groups, values):
+        """ Sort the values by group and, inside every group, by value.
+        For integer values (the usual case in CT) both keys are packed in a single int64 key, which is much
+        faster than a lexicographic sort
+        :param groups: 1D numpy array with the group index of every value
+        :param values: 1D numpy array of values
+        :return: sorted values
+        """
+        if values.size == 0 or values.dtype.kind not in "ui":
+            return values[np.lexsort((values, groups))]
+        minValue = int(values.min())
+        span = int(values.max()) - minValue + 1
+        keys = groups.astype(np.int64) * span
+        keys += values
+        keys -= minValue
+        keys.sort()
+        keys %= span
+        keys += minValue
+        return keys.astype(values.dtype)
+
+    def getLabelIndex(self, label):
+        """ Position of a label in the results arrays (or None if the label is not present)
+        """
+        index = np.searchsorted(self.labels, label)
+        if index < self.labels.size and self.labels[index] == label:
+            return int(index)
+        return None
+
+    def getStatistics(self, label):
+        """ Dictionary with the statistics of a label (or None if the label is not present)
+        :param label: label code
+        :return: dictionary with the keys Count, Min, Max, Mean, StdDev, Median
+        """
+        i = self.getLabelIndex(label)
+        if i is None:
+            return None
+        return {"Count": int(self.counts[i]), "Min": self.mins[i], "Max": self.maxs[i], "Mean": self.means[i],
+                "StdDev": self.stds[i], "Median": self.medians[i]}
@@ -0,0 +1,177 @@
+import numpy as np
+
+from .GroupedStatistics import GroupedStatistics
+
+
+class IncrementalStatistics(GroupedStatistics):
+    """Intensity statistics for every label of a labelmap that can be updated slice by slice.
+    For every (slice, label) it keeps the partial aggregates (count, sum, sum of squares, min, max) and a compact
+    histogram (the distinct intensities and their counts). When some slices are edited only those slices are
+    recomputed, and the partial aggregates of all the slices are merged again (the median is obtained from a dense
+    histogram per label that is updated by subtracting/adding the histograms of the modified slices).
+    The intensities must be integers (the usual case in CT), so that all the aggregates are exact.
+    The merged results are exposed with the same attributes and methods as GroupedStatistics, plus "numSlices"
+    (number of slices that contain every label)"""
+
+    def __init__(self, intensityArray, labelmapArray):
+        """
+        :param intensityArray: integer numpy array (slices, rows, cols) with the gray levels
+        :param labelmapArray: integer numpy array (same shape as intensityArray) with the labels
+        """
+        if intensityArray.dtype.kind not in "ui":
+            raise ValueError("Incremental statistics require an integer intensity volume")
+        # All the histograms share the intensity range of the whole volume
+        self.minValue = int(intensityArray.min())
+        self.span = int(intensityArray.max()) - self.minValue + 1
+        numSlices = labelmapArray.shape[0]
+
+        # Partial aggregates per slice: (labels, counts, sums, sumSquares, mins, maxs)
+        self.__slicePartials__ = [None] * numSlices
+        # Compact histograms per slice: (label of every entry, intensity offset, count)
+        self.__sliceHistograms__ = [None] * numSlices
+        # Dense histogram for every label in the volume
+        self.__histograms__ = {}
+
+        self.updateSlices(np.arange(numSlices), intensityArray, labelmapArray)
+
+    @staticmethod
+    def findModifiedSlices(previousLabelmapArray, labelmapArray, region=None):
+        """ Indexes of the slices that are different in two versions of a labelmap
+        :param previousLabelmapArray: numpy array (slices, rows, cols)
+        :param labelmapArray: numpy array (same shape)
+        :param region: tuple of slices (z, y, x) that contains all the differences, when it is known. Only the voxels
+        in the region are compared
+        :return: numpy array of slice indexes
+        """
+        if region is None:
+            return np.flatnonzero((previousLabelmapArray != labelmapArray).any(axis=(1, 2)))
+        firstSlice = region[0].indices(labelmapArray.shape[0])[0]
+        return np.flatnonzero((previousLabelmapArray[region] != labelmapArray[region]).any(axis=(1, 2))) + firstSlice
+
+    def updateSlices(self, sliceIndices, intensitySlab, labelmapSlab):
+        """ Replace the partial aggregates of some slices and merge the results again.
+        :param sliceIndices: sorted indexes of the modified slices in the volume
+        :param intensitySlab: numpy array (len(sliceIndices), rows, cols) with the gray levels of those slices
+        :param labelmapSlab: numpy array (len(sliceIndices), rows, cols) with the labels of those slices
+        """
+        sliceIndices = np.asarray(sliceIndices, dtype=np.intp)
+        # Remove the previous contribution of the slices to the histograms
+        self.__accumulateHistograms__([self.__sliceHistograms__[z] for z in sliceIndices], -1)
+
+        partials, histograms = self.__computePartials__(intensitySlab, labelmapSlab)
+        for i, z in enumerate(sliceIndices):
+            self.__slicePartials__[z] = partials[i]
+            self.__sliceHistograms__[z] = histograms[i]
+        self.__accumulateHistograms__(histograms, 1)
+
+        self.__merge__()
+
+    def __computePartials__(self, intensitySlab, labelmapSlab):
+        """ Partial aggregates and compact histograms for every (slice, label) of a slab, with a single sort
+        of all the labelled voxels keyed by slice, label and intensity.
+        :return: tuple (list of partial aggregates, list of compact histograms), one item per slice of the slab
+        """
+        numSlices = labelmapSlab.shape[0]
+        mask = labelmapSlab != 0
+        voxelSlices = np.repeat(np.arange(numSlices), np.count_nonzero(mask.reshape(numSlices, -1), axis=1))
+        uniqueLabels, groups = self.groupLabels(labelmapSlab[mask])
+        numLabels = max(uniqueLabels.size, 1)
+
+        keys = voxelSlices.astype(np.int64) * numLabels
+        keys += groups
+        keys *= self.span
+        keys += intensitySlab[mask]
+        keys -= self.minValue
+        keys, entryCounts = np.unique(keys, return_counts=True)
+        entryOffsets = keys % self.span
+        pairs = keys // self.span
+        entrySlices = pairs // numLabels
+        entryLabels = uniqueLabels[pairs % numLabels]
+
+        # Every (slice, label) pair is a contiguous segment of the sorted entries
+        pairStarts = np.flatnonzero(np.diff(pairs, prepend=-1))
+        entryValues = entryOffsets + self.minValue
+        if pairStarts.size > 0:
+            weightedValues = entryValues * entryCounts
+            counts = np.add.reduceat(entryCounts, pairStarts)
+            sums = np.add.reduceat(weightedValues, pairStarts)
+            sumSquares = np.add.reduceat(weightedValues * entryValues, pairStarts)
+            # Entries are sorted by intensity inside every pair
+            mins = entryValues[pairStarts]
+            maxs = entryValues[np.append(pairStarts[1:], pairs.size) - 1]
+        else:
+            counts = sums = sumSquares = mins = maxs = np.zeros(0, dtype=np.int64)
+        pairSlices = entrySlices[pairStarts]
+        pairLabels = entryLabels[pairStarts]
+
+        pairBounds = np.searchsorted(pairSlices, np.arange(numSlices + 1))
+        entryBounds = np.searchsorted(entrySlices, np.arange(numSlices + 1))
+        partials = []
+        histograms = []
+        for i in range(numSlices):
+            p = slice(pairBounds[i], pairBounds[i + 1])
+            e = slice(entryBounds[i], entryBounds[i + 1])
+            partials.append((pairLabels[p], counts[p], sums[p], sumSquares[p], mins[p], maxs[p]))
+            histograms.append((entryLabels[e], entryOffsets[e], entryCounts[e]))
+        return partials, histograms
+
+    def __accumulateHistograms__(self, histograms, sign):
+        """ Add (sign=1) or subtract (sign=-1) compact histograms to the dense histogram of every label
+        """
+        histograms = [h for h in histograms if h is not None]
+        if len(histograms) == 0:
+            return
+        labels = np.concatenate([h[0] for h in histograms])
+        offsets = np.concatenate([h[1] for h in histograms])
+        counts = np.concatenate([h[2] for h in histograms]) * sign
+        for label in np.unique(labels):
+            if label not in self.__histograms__:
+                self.__histograms__[label] = np.zeros(self.span, dtype=np.int64)
+            selection = labels == label
+            np.add.at(self.__histograms__[label], offsets[selection], counts[selection])
+
+    def __merge__(self):
+        """ Merge the partial aggregates of all the slices in the results per label
+        """
+        partials = [p for p in self.__slicePartials__ if p is not None]
+        labels, counts, sums, sumSquares, mins, maxs = [np.concatenate([p[i] for p in partials]) for i in range(6)]
+        self.labels, groups = self.groupLabels(labels)
+        numGroups = self.labels.size
+
+        self.numSlices = np.bincount(groups, minlength=numGroups)
+        self.counts = np.zeros(numGroups, dtype=np.int64)
+        np.add.at(self.counts, groups, counts)
+        self.sums = np.zeros(numGroups, dtype=np.int64)
+        np.add.at(self.sums, groups, sums)
+        self.sumSquares = np.zeros(numGroups, dtype=np.int64)
+        np.add.at(self.sumSquares, groups, sumSquares)
+        self.mins = np.full(numGroups, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(self.mins, groups, mins)
+        self.maxs = np.full(numGroups, np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(self.maxs, groups, maxs)
+
+        # Labels that have been completely erased
+        for label in [l for l in self.__histograms__ if self.getLabelIndex(l) is None]:
+            del self.__histograms__[label]
+
+        # Same convention as numpy.median (mean of the two central values when the count is even)
+        self.medians = np.zeros(numGroups, dtype=np.float64)
+        for i, label in enumerate(self.labels):
+            cumulative = np.cumsum(self.__histograms__[label])
+            low = np.searchsorted(cumulative, (self.counts[i] - 1) // 2, side="right")
+            high = np.searchsorted(cumulative, self.counts[i] // 2, side="right")
+            self.medians[i] = (low + high) / 2.0 + self.minValue
+
+        self.means = self.sums / self.counts
+        variances = self.sumSquares / self.counts - self.means * self.means
+        self.stds = np.sqrt(np.maximum(variances, 0))
+
+    def getLabelmapSlices(self):
+        """ Dictionary with the slices where every label is present (same format as Util.get_labelmap_slices)
+        :return: dictionary of [label_Code: numpy array of slices]
+        """
+        result = {}
+        for z, partial in enumerate(self.__slicePartials__):
+            for label in partial[0]:
+                result.setdefault(label, []).append(z)
+        return dict((label, np.array(slices)) for label, slices in result.items())
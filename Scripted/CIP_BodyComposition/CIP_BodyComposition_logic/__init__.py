@@ -1 +1,5 @@
-from .BodyCompositionParameters import *
\ No newline at end of file
+from .BodyCompositionParameters import *
+from .BodyCompositionBatch import *
+from .GroupedStatistics import *
+from .IncrementalStatistics import *
+from .SlabMorphology import *
@@ -0,0 +1,37 @@
+"""
+Command line entry point of the headless body composition analysis (see BodyCompositionBatch):
+    python -m CIP_BodyComposition_logic manifest.csv results.csv --workers 8
+(from the CIP_BodyComposition module folder).
+The cases are analyzed in a pool of processes, which is only safe here (inside Slicer the batch uses threads).
+"""
+import argparse
+import sys
+
+from CIP_BodyComposition_logic.BodyCompositionBatch import BodyCompositionBatch
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m CIP_BodyComposition_logic",
+                                     description="Body composition analysis for a list of segmented cases")
+    parser.add_argument("manifest", help="csv file with rows: CT path, labelmap path[, case id] "
+                                         "(relative paths are relative to the manifest folder)")
+    parser.add_argument("output", help="csv file where the results will be appended")
+    parser.add_argument("--progress", default=None, help="file with the completed cases (default: OUTPUT.progress)")
+    parser.add_argument("--workers", type=int, default=None, help="number of parallel processes (default: all cpus)")
+    options = parser.parse_args(args)
+
+    def printStep(caseId, error):
+        if error is None:
+            print("{0} completed".format(caseId))
+        else:
+            print("ERROR in {0}:\n{1}".format(caseId, error))
+
+    errors = BodyCompositionBatch(options.workers, useProcesses=True).run(options.manifest, options.output,
+                                                                          options.progress,
+                                                                          callbackStepFunction=printStep)
+    print("Finished. {0} cases failed".format(len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
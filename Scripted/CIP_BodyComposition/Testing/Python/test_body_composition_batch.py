@@ -0,0 +1,78 @@
+import csv
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from CIP_BodyComposition_logic.BodyCompositionBatch import BodyCompositionBatch
+
+# Visceral fat in the abdomen
+LABEL = 18203
+
+
+def write_case(folder, seed):
+    """ Random CT and labelmap saved in folder/ct.nrrd and folder/labelmap.nrrd
+    """
+    os.makedirs(folder)
+    rng = np.random.RandomState(seed)
+    ct = sitk.GetImageFromArray(rng.randint(-1024, 1000, (4, 20, 20)).astype(np.int16))
+    ct.SetSpacing((0.7, 0.7, 2.5))
+    labelmap = np.zeros((4, 20, 20), np.uint16)
+    labelmap[1:3, 5:15, 5:15] = LABEL
+    labelmap = sitk.GetImageFromArray(labelmap)
+    labelmap.CopyInformation(ct)
+    sitk.WriteImage(ct, os.path.join(folder, "ct.nrrd"))
+    sitk.WriteImage(labelmap, os.path.join(folder, "labelmap.nrrd"))
+
+
+def read_case_ids(outputPath):
+    with open(outputPath, 'r') as f:
+        return [row["caseId"] for row in csv.DictReader(f)]
+
+
+def test_body_composition_batch_relative_paths(tmpdir, monkeypatch):
+    """ The relative paths of the manifest are relative to its folder (not to the current folder), the default case
+    ids are relative to the manifest folder, and the completed cases are skipped when the batch is resumed
+    """
+    dataFolder = str(tmpdir.mkdir("data"))
+    write_case(os.path.join(dataFolder, "a"), 0)
+    write_case(os.path.join(dataFolder, "b"), 1)
+    manifestPath = os.path.join(dataFolder, "manifest.csv")
+    with open(manifestPath, 'w') as f:
+        f.write("# CT, labelmap\n")
+        f.write("a/ct.nrrd,a/labelmap.nrrd\n")
+        f.write("b/ct.nrrd,b/labelmap.nrrd\n")
+    # Run from a different folder
+    monkeypatch.chdir(str(tmpdir.mkdir("other")))
+
+    cases = BodyCompositionBatch.readManifest(manifestPath)
+    assert cases == [("a/ct", os.path.join(dataFolder, "a", "ct.nrrd"), os.path.join(dataFolder, "a", "labelmap.nrrd")),
+                     ("b/ct", os.path.join(dataFolder, "b", "ct.nrrd"), os.path.join(dataFolder, "b", "labelmap.nrrd"))]
+
+    outputPath = os.path.join(str(tmpdir), "results.csv")
+    for numWorkers in (1, 2):
+        if os.path.isfile(outputPath):
+            os.remove(outputPath)
+            os.remove(outputPath + ".progress")
+        assert BodyCompositionBatch(numWorkers).run(manifestPath, outputPath) == []
+        caseIds = read_case_ids(outputPath)
+        assert sorted(set(caseIds)) == ["a/ct", "b/ct"]
+        rowsPerCase = caseIds.count("a/ct")
+        assert rowsPerCase > 0 and caseIds.count("b/ct") == rowsPerCase
+        with open(outputPath, 'r') as f:
+            row = next(r for r in csv.DictReader(f) if r["regionType"] == str(LABEL))
+        assert int(row["count"]) == 200 and int(row["numSlices"]) == 2
+
+    # Resume: nothing to do
+    assert BodyCompositionBatch(1).run(manifestPath, outputPath) == []
+    assert len(read_case_ids(outputPath)) == 2 * rowsPerCase
+
+    # Resume after an interruption: only the case that was not completed is processed again
+    with open(outputPath + ".progress", 'w') as f:
+        f.write("a/ct\n")
+    steps = []
+    errors = BodyCompositionBatch(1).run(manifestPath, outputPath,
+                                         callbackStepFunction=lambda caseId, error: steps.append((caseId, error)))
+    assert errors == []
+    assert steps == [("b/ct", None)]
+    assert read_case_ids(outputPath).count("b/ct") == 2 * rowsPerCase
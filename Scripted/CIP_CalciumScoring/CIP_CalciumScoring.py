@@ -1,10 +1,13 @@
 import os, sys, string
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import traceback
 import unittest
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 import numpy as np
 import SimpleITK as sitk
-import sitkUtils
 
 
 from slicer.ScriptedLoadableModule import *
@@ -13,6 +16,7 @@ from CIP.ui import CaseReportsWidget
 from CIP.ui import PreProcessingWidget
 from CIP.ui import PdfReporter
 from CIP.logic.SlicerUtil import SlicerUtil
+from CIP.logic import VolumeBuffer, PolyDataGeometry
 
 #
 # Calc Scoring
@@ -56,6 +60,84 @@ class MouseInteractorActor(vtk.vtkInteractorStyleTrackballCamera):
         #Call parent member
         self.OnLeftButtonUp()
 
+class RecomputeScheduler(object):
+    """ Coalesce bursts of change events (ex: dragging the ROI handles) into a single computation, that runs in a
+    worker thread. Every call to "schedule" restarts a timer, and when the timer expires:
+        - prepareFunction() is invoked in the main thread. It returns the arguments for the computation (or None to skip it)
+        - computeFunction(args) is invoked in a worker thread. It must not access the MRML scene or the GUI
+        - applyFunction(result) is invoked in the main thread, just if no other computation was scheduled meanwhile
+    (stale results are dropped)
+    """
+    def __init__(self, prepareFunction, computeFunction, applyFunction, delayMs=300, pollIntervalMs=50):
+        self.prepareFunction = prepareFunction
+        self.computeFunction = computeFunction
+        self.applyFunction = applyFunction
+        self.__generation__ = 0
+        self.__pending__ = []
+        self.__executor__ = ThreadPoolExecutor(max_workers=1)
+
+        self.__debounceTimer__ = qt.QTimer()
+        self.__debounceTimer__.singleShot = True
+        self.__debounceTimer__.interval = delayMs
+        self.__debounceTimer__.connect("timeout()", self.__onDebounceTimeout__)
+
+        # The results of the worker are checked from the main thread
+        self.__pollTimer__ = qt.QTimer()
+        self.__pollTimer__.interval = pollIntervalMs
+        self.__pollTimer__.connect("timeout()", self.__onPollTimeout__)
+
+    @property
+    def delayMs(self):
+        return self.__debounceTimer__.interval
+
+    @delayMs.setter
+    def delayMs(self, value):
+        self.__debounceTimer__.interval = value
+
+    def schedule(self):
+        """ Request a new computation. Any computation requested before is discarded
+        """
+        self.__generation__ += 1
+        # Computations that did not start yet are not needed anymore
+        for generation, future in self.__pending__:
+            future.cancel()
+        self.__debounceTimer__.start()
+
+    def cancel(self):
+        """ Discard the scheduled and running computations
+        """
+        self.__generation__ += 1
+        self.__debounceTimer__.stop()
+
+    def cleanup(self):
+        self.cancel()
+        self.__pollTimer__.stop()
+        self.__executor__.shutdown(wait=False)
+
+    def __onDebounceTimeout__(self):
+        args = self.prepareFunction()
+        if args is None:
+            return
+        self.__pending__.append((self.__generation__, self.__executor__.submit(self.computeFunction, args)))
+        self.__pollTimer__.start()
+
+    def __onPollTimeout__(self):
+        finished = [p for p in self.__pending__ if p[1].done()]
+        self.__pending__ = [p for p in self.__pending__ if not p[1].done()]
+        if len(self.__pending__) == 0:
+            self.__pollTimer__.stop()
+        for generation, future in finished:
+            if generation != self.__generation__ or future.cancelled():
+                # Stale result
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                logging.error("Error in background computation:\n" + traceback.format_exc())
+                continue
+            self.applyFunction(result)
+
+
 class CIP_CalciumScoring(ScriptedLoadableModule):
     def __init__(self, parent):
         ScriptedLoadableModule.__init__(self, parent)
@@ -114,8 +196,6 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         self.MaximumLesionSize = 500
         self.croppedVolumeNode = slicer.vtkMRMLScalarVolumeNode()
         self.threshImage = vtk.vtkImageData()
-        self.marchingCubes = vtk.vtkDiscreteMarchingCubes()
-        self.transformPolyData = vtk.vtkTransformPolyDataFilter()
 
         self.selectedLabelList = []
         self.labelScores = []
@@ -156,7 +236,12 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         # Instantiate and connect widgets ...
         ScriptedLoadableModuleWidget.setup(self)
 
-        #self.logic = CIP_CalciumScoringLogic()
+        self.logic = CIP_CalciumScoringLogic()
+
+        # Recompute the lesions when the parameters or the ROI change (just once for every burst of changes)
+        delay = int(SlicerUtil.settingGetOrSetDefault(self.moduleName, "RecomputeDelayMs", 300))
+        self.recomputeScheduler = RecomputeScheduler(self.__prepareLesionsComputation__, self.__computeLesions__,
+                                                     self.__applyLesions__, delayMs=delay)
 
         #
         # Parameters Area
@@ -283,7 +368,8 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         slicer.mrmlScene.AddNode(self.roiNode)
         self.ROIWidget.setMRMLAnnotationROINode(self.roiNode)
         roiFormLayout.addRow("", self.ROIWidget)
-        #self.roiNode.AddObserver("ModifiedEvent", self.onROIChangedEvent, 1)
+        tag = self.roiNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onROIChangedEvent)
+        self.observerTags.append([self.roiNode, tag])
 
         # Add vertical spacer
         self.layout.addStretch(1)
@@ -300,6 +386,7 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
             #self.createModels()
 
     def cleanup(self):
+        self.recomputeScheduler.cleanup()
         self.reportsWidget.cleanup()
         self.reportsWidget = None
 
@@ -398,7 +485,7 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
             self.sx=sp[0]
             self.sy=sp[1]
             self.sz=sp[2]
-        #self.createModels()
+        self.recomputeScheduler.schedule()
 
     def onTypeChanged(self, value):
         self.calcificationType = value
@@ -415,32 +502,33 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
 
     def onMinSizeChanged(self, value):
         self.MinimumLesionSize = value
-        #self.createModels()
+        self.recomputeScheduler.schedule()
 
     def onMaxSizeChanged(self, value):
         self.MaximumLesionSize = value
-        #self.createModels()
+        self.recomputeScheduler.schedule()
 
     def onThresholdMinChanged(self, value):
         self.ThresholdMin = value
-        #self.createModels()
+        self.recomputeScheduler.schedule()
 
     def onThresholdMaxChanged(self, value):
         self.ThresholdMax = value
-        #self.createModels()
+        self.recomputeScheduler.schedule()
 
     def onROIChangedEvent(self, observee, event):
-        pass
-        #self.createModels()
+        self.recomputeScheduler.schedule()
     
     def onUpdate(self):
         self.createModels()
 
     def deleteModels(self):
+        slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
         for m in self.modelNodes:
             m.SetAndObservePolyData(None)
             slicer.mrmlScene.RemoveNode(m.GetDisplayNode())
             slicer.mrmlScene.RemoveNode(m)
+        slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
         self.modelNodes = []
         self.selectedLabels = {}
 
@@ -480,109 +568,98 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         qt.QMessageBox.information(slicer.util.mainWindow(), 'Data saved', 'The data were saved successfully')
 
 
-    def computeDensityScore(self, d):
-        score = 0
-        if d > 129 and d < 200:
-            score = 1
-        elif d < 300:
-            score = 2
-        elif d < 400:
-            score = 3
-        else:
-            score = 4
-        return score
-
     def createModels(self):
+        """ Crop, label and score the lesions and create their models (synchronously)"""
+        self.recomputeScheduler.cancel()
+        args = self.__prepareLesionsComputation__()
+        if args is None:
+            self.deleteModels()
+            if self.calcificationType != 0:
+                print ("not implemented")
+            # Otherwise there is no volume or ROI yet
+            return
+        self.__applyLesions__(self.__computeLesions__(args))
+
+    def __prepareLesionsComputation__(self):
+        """ Crop the volume with the ROI (it needs the MRML scene, so it runs in the main thread).
+        :return: arguments for __computeLesions__ (or None if there is nothing to compute)
+        """
+        if self.calcificationType != 0 or not self.volumeNode or not self.roiNode:
+            return None
+        slicer.vtkSlicerCropVolumeLogic().CropVoxelBased(self.roiNode, self.volumeNode, self.croppedNode)
+        croppedImage = VolumeBuffer.sitkImage(self.croppedNode)
+        return (croppedImage, self.ThresholdMin, self.ThresholdMax, self.MinimumLesionSize, self.MaximumLesionSize)
+
+    def __computeLesions__(self, args):
+        """ Label the lesions and compute their scores. It does not access the scene, so it can run in a worker thread
+        :param args: tuple (cropped SimpleITK image, threshold min, threshold max, min lesion size, max lesion size)
+        :return: tuple (SimpleITK image with the labelled lesions, scores, positions of the lesions in the size range)
+        """
+        croppedImage, thresholdMin, thresholdMax, minimumSize, maximumSize = args
+        relabelImage = self.logic.labelLesions(croppedImage, thresholdMin, thresholdMax)
+        #Computation of the score follows this paper:
+        #C. H McCollough, Radiology, 243(2), 2007
+        scores = self.logic.computeLesionScores(sitk.GetArrayViewFromImage(croppedImage),
+                                                sitk.GetArrayViewFromImage(relabelImage),
+                                                croppedImage.GetSpacing())
+        lesions = self.logic.filterLesionsBySize(scores, minimumSize, maximumSize)
+        return relabelImage, scores, lesions
+
+    def __applyLesions__(self, result):
+        """ Load the lesions in the scene (labelmap, models and table)
+        :param result: result of __computeLesions__
+        """
+        relabelImage, scores, lesions = result
         self.deleteModels()
         for sr in self.summary_reports:
             self.labelScores[sr]=[]
         self.selectedLabelList = []
-        if self.calcificationType == 0 and self.volumeNode and self.roiNode:
-            #print 'in Heart Create Models'
-
-            slicer.vtkSlicerCropVolumeLogic().CropVoxelBased(self.roiNode, self.volumeNode, self.croppedNode)
-            croppedImage    = sitk.ReadImage( sitkUtils.GetSlicerITKReadWriteAddress(self.croppedNode.GetName()))
-            thresholdImage  = sitk.BinaryThreshold(croppedImage,self.ThresholdMin, self.ThresholdMax, 1, 0)
-            connectedCompImage  =sitk.ConnectedComponent(thresholdImage, True)
-            relabelImage  =sitk.RelabelComponent(connectedCompImage)
-            labelStatFilter =sitk.LabelStatisticsImageFilter()
-            labelStatFilter.Execute(croppedImage, relabelImage)
-            if relabelImage.GetPixelID() != sitk.sitkInt16:
-                relabelImage = sitk.Cast( relabelImage, sitk.sitkInt16 )
-            sitk.WriteImage( relabelImage, sitkUtils.GetSlicerITKReadWriteAddress(self.labelsNode.GetName()))
-
-            nLabels = labelStatFilter.GetNumberOfLabels()
-            #print "Number of labels = ", nLabels
-            self.totalScore = 0
-            count = 0
-            #Computation of the score follows this paper:
-            #C. H McCollough, Radiology, 243(2), 2007
-            
-            for n in range(0,nLabels):
-                max = labelStatFilter.GetMaximum(n)
-                mean = labelStatFilter.GetMean(n)
-                size = labelStatFilter.GetCount(n)
-                volume = size*self.voxelVolume
-                if volume > self.MaximumLesionSize:
-                    continue
-
-                if volume < self.MinimumLesionSize:
-                    nLabels = n+1
-                    break
-                
-                density_score = self.computeDensityScore(max)
-
-                #Agatston score is \sum_i area_i * density_score_i
-                #For now we assume that all the plaques have the same density score
-                score = size*(self.sx*self.sy)*density_score
-                
-                mass_score = mean*volume
-
-                #print "label = ", n, "  max = ", max, " score = ", score, " voxels = ", size
-                self.labelScores["Agatston Score"].append(score)
-                self.labelScores["Mass Score"].append(mass_score)
-                self.labelScores["Volume"].append(volume)
-                self.selectedLabelList.append(0)
-                self.marchingCubes.SetInputData(self.labelsNode.GetImageData())
-                self.marchingCubes.SetValue(0, n)
-                self.marchingCubes.Update()
-                    
-                self.transformPolyData.SetInputData(self.marchingCubes.GetOutput())
-                mat = vtk.vtkMatrix4x4()
-                self.labelsNode.GetIJKToRASMatrix(mat)
-                trans = vtk.vtkTransform()
-                trans.SetMatrix(mat)
-                self.transformPolyData.SetTransform(trans)
-                self.transformPolyData.Update()
-                poly = vtk.vtkPolyData()
-                poly.DeepCopy(self.transformPolyData.GetOutput())
-                    
-                modelNode = slicer.vtkMRMLModelNode()
-                slicer.mrmlScene.AddNode(modelNode)
-                dnode = slicer.vtkMRMLModelDisplayNode()
-                slicer.mrmlScene.AddNode(dnode)
-                modelNode.AddAndObserveDisplayNodeID(dnode.GetID())
-                modelNode.SetAndObservePolyData(poly)
+        self.selectLabels.setRowCount(0)
+        VolumeBuffer.writeSitkImage(self.labelsNode, relabelImage)
+        # Surfaces of all the selected lesions with a single marching cubes pass
+        mat = vtk.vtkMatrix4x4()
+        self.labelsNode.GetIJKToRASMatrix(mat)
+        surfaces = self.logic.createLesionSurfaces(self.labelsNode.GetImageData(), mat,
+                                                   scores["Label"][lesions])
+
+        ct=slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeLabels')
+        # Do not refresh the scene for every new model
+        slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+        for count, n in enumerate(lesions):
+            label = int(scores["Label"][n])
+            score = scores["Agatston Score"][n]
+            mass_score = scores["Mass Score"][n]
+            volume = scores["Volume"][n]
+            mean = scores["Mean HU"][n]
+            max = scores["Max HU"][n]
+
+            self.labelScores["Agatston Score"].append(score)
+            self.labelScores["Mass Score"].append(mass_score)
+            self.labelScores["Volume"].append(volume)
+            self.selectedLabelList.append(0)
+            poly = surfaces[label]
+
+            modelNode = slicer.vtkMRMLModelNode()
+            slicer.mrmlScene.AddNode(modelNode)
+            dnode = slicer.vtkMRMLModelDisplayNode()
+            slicer.mrmlScene.AddNode(dnode)
+            modelNode.AddAndObserveDisplayNodeID(dnode.GetID())
+            modelNode.SetAndObservePolyData(poly)
+
+            rgb = [0,0,0]
+            ct.GetLookupTable().GetColor(count+1,rgb)
+            dnode.SetColor(rgb)
+            #Enable Slice intersection
+            dnode.SetSliceDisplayMode(0)
+            dnode.SetSliceIntersectionVisibility(1)
 
-                ct=slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeLabels')
-                rgb = [0,0,0]
-                ct.GetLookupTable().GetColor(count+1,rgb)
-                dnode.SetColor(rgb)
-                #Enable Slice intersection
-                dnode.SetSliceDisplayMode(0)
-                dnode.SetSliceIntersectionVisibility(1)
-
-                self.addLabel(count, rgb, [score,mass_score,volume,mean,max])
-                count = count+1
-
-                self.modelNodes.append(modelNode)
-                self.selectedLabels[poly] = n
-                #a = slicer.util.array(tn.GetID())
-                #sa = sitk.GetImageFromArray(a)
-            for sr in self.summary_reports:
-                self.scoreField[sr].setText(self.totalScores[sr])
-        else:
-            print ("not implemented")
+            self.addLabel(count, rgb, [score,mass_score,volume,mean,max])
+
+            self.modelNodes.append(modelNode)
+            self.selectedLabels[poly] = label
+        slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
+        for sr in self.summary_reports:
+            self.scoreField[sr].setText(self.totalScores[sr])
 
 
 #
@@ -597,6 +674,9 @@ class CIP_CalciumScoringLogic(ScriptedLoadableModuleLogic):
     requiring an instance of the Widget
     """
 
+    # Lower limits of the HU ranges for the Agatston density factors 1, 2, 3 and 4
+    DENSITY_THRESHOLDS = (130, 200, 300, 400)
+
     def __init__(self):
         self.cropVolumeLogic = slicer.vtkSlicerCropVolumeLogic()
         self.threshold = vtk.vtkImageThreshold()
@@ -615,6 +695,142 @@ class CIP_CalciumScoringLogic(ScriptedLoadableModuleLogic):
         self.threshold.Update()
         threshImage.DeepCopy(self.threshold.GetOutput())
 
+    @staticmethod
+    def labelLesions(image, thresholdMin, thresholdMax):
+        """ Label the connected calcified lesions of an image
+        :param image: SimpleITK image
+        :param thresholdMin: minimum HU of a calcification
+        :param thresholdMax: maximum HU of a calcification
+        :return: SimpleITK Int16 image with the lesions labelled 1..N, sorted by size (1=biggest)
+        """
+        thresholdImage = sitk.BinaryThreshold(image, thresholdMin, thresholdMax, 1, 0)
+        connectedCompImage = sitk.ConnectedComponent(thresholdImage, True)
+        relabelImage = sitk.RelabelComponent(connectedCompImage)
+        if relabelImage.GetPixelID() != sitk.sitkInt16:
+            relabelImage = sitk.Cast(relabelImage, sitk.sitkInt16)
+        return relabelImage
+
+    @staticmethod
+    def densityFactor(maxHU):
+        """ Agatston density factor (0-4) for the maximum attenuation of a lesion in a slice
+        :param maxHU: scalar or numpy array of HU values
+        :return: density factor (same shape as maxHU)
+        """
+        return np.digitize(maxHU, CIP_CalciumScoringLogic.DENSITY_THRESHOLDS)
+
+    @staticmethod
+    def computeLesionScores(intensityArray, lesionsArray, spacing):
+        """ Calcium scores for all the lesions of a labelmap at once.
+        The area and the maximum HU of every lesion are measured in every slice (one bincount/maximum.at pass over
+        the (lesion, slice) pairs), so that the Agatston score is the sum of area * density factor over the slices
+        of the lesion (C. H McCollough, Radiology, 243(2), 2007). The mass score is mean HU * volume.
+        It does not need any MRML node.
+        :param intensityArray: numpy array (slices, rows, cols) with the HU values
+        :param lesionsArray: integer numpy array (same shape) with the lesions labelled (0 = background)
+        :param spacing: spacing of the volume (x, y, z)
+        :return: OrderedDict of numpy arrays (one position per lesion) with the keys: Label, Voxels, Volume,
+        Agatston Score, Mass Score, Mean HU, Max HU
+        """
+        numSlices = lesionsArray.shape[0]
+        mask = lesionsArray > 0
+        voxelSlices = np.repeat(np.arange(numSlices), np.count_nonzero(mask.reshape(numSlices, -1), axis=1))
+        values = intensityArray[mask].astype(np.float64)
+        labels, groups = np.unique(lesionsArray[mask], return_inverse=True)
+        groups = groups.ravel()
+        numLesions = labels.size
+
+        # Area (voxels) and maximum HU of every lesion in every slice
+        pairs = groups * numSlices + voxelSlices
+        sliceVoxels = np.bincount(pairs, minlength=numLesions * numSlices).reshape(numLesions, numSlices)
+        sliceMax = np.full(numLesions * numSlices, -np.inf)
+        np.maximum.at(sliceMax, pairs, values)
+        sliceMax = sliceMax.reshape(numLesions, numSlices)
+
+        pixelArea = spacing[0] * spacing[1]
+        voxels = sliceVoxels.sum(axis=1)
+        volume = voxels * pixelArea * spacing[2]
+        mean = np.bincount(groups, weights=values, minlength=numLesions) / np.maximum(voxels, 1)
+        # The slices where the lesion is not present have sliceMax = -inf (density factor = 0)
+        agatston = (sliceVoxels * CIP_CalciumScoringLogic.densityFactor(sliceMax)).sum(axis=1) * pixelArea
+
+        scores = OrderedDict()
+        scores["Label"] = labels
+        scores["Voxels"] = voxels
+        scores["Volume"] = volume
+        scores["Agatston Score"] = agatston
+        scores["Mass Score"] = mean * volume
+        scores["Mean HU"] = mean
+        scores["Max HU"] = sliceMax.max(axis=1) if numSlices > 0 else np.zeros(numLesions)
+        return scores
+
+    @staticmethod
+    def createLesionSurfaces(labelImageData, ijkToRasMatrix, labels):
+        """ Surface models of several labels of a labelmap with a single discrete marching cubes pass.
+        The output of the marching cubes is split by the label of every triangle (cell scalars), and every piece
+        only keeps the points that it uses
+        :param labelImageData: vtkImageData with the labels
+        :param ijkToRasMatrix: vtkMatrix4x4 to transform the surfaces to RAS coordinates
+        :param labels: list/array of the labels to extract
+        :return: dictionary of [label: vtkPolyData in RAS coordinates]
+        """
+        labels = [int(label) for label in labels]
+        if len(labels) == 0:
+            return {}
+        marchingCubes = vtk.vtkDiscreteMarchingCubes()
+        marchingCubes.SetInputData(labelImageData)
+        for i, label in enumerate(labels):
+            marchingCubes.SetValue(i, label)
+        marchingCubes.ComputeScalarsOn()
+        transform = vtk.vtkTransform()
+        transform.SetMatrix(ijkToRasMatrix)
+        transformPolyData = vtk.vtkTransformPolyDataFilter()
+        transformPolyData.SetInputConnection(marchingCubes.GetOutputPort())
+        transformPolyData.SetTransform(transform)
+        transformPolyData.Update()
+        surface = transformPolyData.GetOutput()
+
+        points = PolyDataGeometry.pointsView(surface)
+        normalsArray = surface.GetPointData().GetNormals()
+        normals = numpy_support.vtk_to_numpy(normalsArray) if normalsArray is not None else None
+        # The output of the marching cubes is just triangles
+        triangles = PolyDataGeometry.cellsView(surface.GetPolys()).reshape(-1, 3)
+        cellLabels = numpy_support.vtk_to_numpy(surface.GetCellData().GetScalars()) if triangles.shape[0] > 0 \
+            else np.zeros(0)
+
+        order = np.argsort(cellLabels, kind="mergesort")
+        sortedLabels = cellLabels[order]
+        result = {}
+        for label in labels:
+            start, end = np.searchsorted(sortedLabels, [label, label + 1])
+            pointIds, localTriangles = np.unique(triangles[order[start:end]], return_inverse=True)
+            poly = vtk.vtkPolyData()
+            vtkPoints = vtk.vtkPoints()
+            vtkPoints.SetData(numpy_support.numpy_to_vtk(points[pointIds], deep=True))
+            poly.SetPoints(vtkPoints)
+            cells = np.empty((end - start, 4), dtype=np.int64)
+            cells[:, 0] = 3
+            cells[:, 1:] = localTriangles.reshape(-1, 3)
+            cellArray = vtk.vtkCellArray()
+            cellArray.SetCells(end - start, numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(), deep=True))
+            poly.SetPolys(cellArray)
+            if normals is not None:
+                normalsPiece = numpy_support.numpy_to_vtk(normals[pointIds], deep=True)
+                normalsPiece.SetName(normalsArray.GetName())
+                poly.GetPointData().SetNormals(normalsPiece)
+            result[label] = poly
+        return result
+
+    @staticmethod
+    def filterLesionsBySize(scores, minimumVolume, maximumVolume):
+        """ Positions of the lesions whose volume is in a range (mm3), in the same order as the scores
+        :param scores: result of computeLesionScores
+        :param minimumVolume: minimum volume (mm3)
+        :param maximumVolume: maximum volume (mm3)
+        :return: numpy array of positions
+        """
+        volume = scores["Volume"]
+        return np.flatnonzero((volume >= minimumVolume) & (volume <= maximumVolume))
+
 
 class CIP_CalciumScoringTest(unittest.TestCase):
     """
@@ -4,12 +4,15 @@ It also performs a set of operations to analyze the different structures of
 the volume based on its label map, like Area, Mean, Std.Dev., etc.
 First version: Jorge Onieva (ACIL, jonieva@bwh.harvard.edu). 11/2014'''
 
+import os
 import qt, vtk, ctk, slicer
 import numpy as np
 
 from slicer.ScriptedLoadableModule import *
 
 from CIP.logic.SlicerUtil import SlicerUtil
+from CIP.logic import IntensityLUT, VolumeBuffer
+from CIP_Calibration_logic import CalibrationProfiles, CalibrationBatch
 import CIP.ui as CIPUI
 from slicer.util import VTKObservationMixin
 
@@ -134,6 +137,23 @@ class CIP_CalibrationWidget(ScriptedLoadableModuleWidget,VTKObservationMixin):
         self.layout.addWidget(self.calibrateButton)
         self.calibrateButton.connect('clicked()', self._onCalibrateButtonClicked_)
 
+        # Calibrate with stored profile button
+        self.calibrateProfileButton = ctk.ctkPushButton()
+        self.calibrateProfileButton.setText("Calibrate with stored profile")
+        self.calibrateProfileButton.toolTip = "Calibrate with the air/blood values measured before in the same " \
+                                              "series or in another series of the same scanner"
+        self.layout.addWidget(self.calibrateProfileButton)
+        self.calibrateProfileButton.connect('clicked()', self._onCalibrateProfileButtonClicked_)
+
+        # Batch calibration button
+        self.batchCalibrationButton = ctk.ctkPushButton()
+        self.batchCalibrationButton.setText("Batch calibration...")
+        self.batchCalibrationButton.toolTip = "Calibrate a list of CT files with the stored profiles, without " \
+                                              "loading them in the scene. The list is a csv file with rows: " \
+                                              "CT path, output path[, profile key]"
+        self.layout.addWidget(self.batchCalibrationButton)
+        self.batchCalibrationButton.connect('clicked()', self._onBatchCalibrationButtonClicked_)
+
         # Reset button
         self.resetButton = ctk.ctkPushButton()
         self.resetButton.setText("Reset")
@@ -343,6 +363,58 @@ class CIP_CalibrationWidget(ScriptedLoadableModuleWidget,VTKObservationMixin):
         else:
             slicer.util.infoDisplay("Calibration completed")
 
+    def _onCalibrateProfileButtonClicked_(self):
+        """ The calibrate with stored profile button has been pressed"""
+        key, profile, matchedByName = self.logic.findStoredProfile(self.inputVolume)
+        if matchedByName and not self.logic.isCalibrated(self.inputVolume):
+            # The volume has no DICOM information. Any other volume with the same name could have saved the profile
+            if qt.QMessageBox.question(slicer.util.mainWindow(), "Use profile?",
+                                       "There is no DICOM information for this volume, but there is a calibration "
+                                       "profile saved for a volume with the same name ({0}). "
+                                       "Do you want to use it?".format(self.inputVolume.GetName()),
+                                       qt.QMessageBox.Yes | qt.QMessageBox.No) != qt.QMessageBox.Yes:
+                return
+        error = self.logic.calibrateWithStoredProfile(self.inputVolume, allowVolumeNameMatch=matchedByName)
+        if error:
+            slicer.util.warningDisplay(error)
+        else:
+            slicer.util.infoDisplay("Calibration completed")
+
+    def _onBatchCalibrationButtonClicked_(self):
+        """ The batch calibration button has been pressed"""
+        manifestPath = qt.QFileDialog.getOpenFileName(slicer.util.mainWindow(), "Batch calibration: list of CT files",
+                                                      "", "CSV files (*.csv);;All files (*)")
+        if not manifestPath:
+            return
+        logPath = qt.QFileDialog.getSaveFileName(slicer.util.mainWindow(), "Batch calibration: log file",
+                                                 os.path.join(os.path.dirname(manifestPath), "calibration_log.csv"),
+                                                 "CSV files (*.csv)")
+        if not logPath:
+            return
+
+        progressBar = qt.QProgressDialog(slicer.util.mainWindow())
+        progressBar.minimumDuration = 0
+        progressBar.setCancelButton(None)
+        progressBar.setMaximum(len(CalibrationBatch.readManifest(manifestPath)))
+        progressBar.setValue(0)
+        progressBar.labelText = "Calibrating..."
+        progressBar.show()
+
+        def onVolumeFinished(ctPath, error):
+            progressBar.setValue(progressBar.value + 1)
+            progressBar.labelText = "Calibrated {0}".format(os.path.basename(ctPath))
+            slicer.app.processEvents()
+
+        try:
+            errors = self.logic.runBatch(manifestPath, logPath, callbackStepFunction=onVolumeFinished)
+        finally:
+            progressBar.close()
+        if errors:
+            slicer.util.warningDisplay("{0} volumes could not be calibrated:\n{1}\nSee {2} for details".format(
+                len(errors), "\n".join(ctPath for ctPath, error in errors), logPath))
+        else:
+            slicer.util.infoDisplay("Batch calibration completed")
+
     def _onResetButtonClicked_(self):
         """ The reset button has been pressed"""
         if self.outputSegmentation:
@@ -421,9 +493,23 @@ class CIP_CalibrationWidget(ScriptedLoadableModuleWidget,VTKObservationMixin):
 # This class makes all the operations not related with the user interface (download and handle volumes, etc.)
 #
 class CIP_CalibrationLogic(ScriptedLoadableModuleLogic):
+    # Attribute of the scalar nodes that have been calibrated (value: "slope intercept")
+    CALIBRATED_ATTRIBUTE = "CIP_Calibrated"
+    # Prefix of the profile keys of the volumes that were not loaded from the DICOM database
+    VOLUME_NAME_KEY_PREFIX = "volume:"
+
     def __init__(self):
         """Constructor. """
         ScriptedLoadableModuleLogic.__init__(self)
+        self.__profiles__ = None
+
+    @property
+    def profiles(self):
+        """ Calibration profiles saved in the settings folder of the module (CalibrationProfiles object)"""
+        if self.__profiles__ is None:
+            self.__profiles__ = CalibrationProfiles(os.path.join(SlicerUtil.getSettingsDataFolder("CIP_Calibration"),
+                                                                 "calibration_profiles.json"))
+        return self.__profiles__
 
     def setDefaultParameters(self, parameterNode):
         """
@@ -451,31 +537,129 @@ class CIP_CalibrationLogic(ScriptedLoadableModuleLogic):
         @param blood_output: value expected for blood
         @return: error message if something goes wrong, or None if everything works fine
         """
+        if self.isCalibrated(scalarNode):
+            # The measurements would be taken in the calibrated values
+            return "This volume has already been calibrated. Please load the original volume again"
         s = slicer.util.array(scalarNode.GetName())
         lm = slicer.util.array(labelmapNode.GetName())
 
-        mask = lm == 1
-        if not np.any(mask):
+        air = s[lm == 1]
+        if air.size == 0:
             return "Please mark some area corresponding to air in the volume"
-        air_input = np.mean(s[mask])
+        air_input = np.mean(air)
 
-        mask = lm == 2
-        if not np.any(mask):
+        blood = s[lm == 2]
+        if blood.size == 0:
             return "Please mark some area corresponding to blood in the volume"
-        blood_input = np.mean(s[mask])
+        blood_input = np.mean(blood)
+
+        # Save the measurements, so that they can be reused for other series of the same scanner
+        keys = self.getProfileKeys(scalarNode)
+        if len(keys) == 0:
+            # No DICOM information. The profile can only be reused (after confirmation) for a volume with the same name
+            keys = [self.getVolumeNameKey(scalarNode)]
+        for key in keys:
+            profile = self.profiles.setProfile(key, air_input, blood_input, air_output, blood_output,
+                                               air_std=np.std(air), air_count=air.size,
+                                               blood_std=np.std(blood), blood_count=blood.size)
+        self.applyCalibration(scalarNode, profile["slope"], profile["intercept"])
+
+    def calibrateWithStoredProfile(self, scalarNode, allowVolumeNameMatch=False):
+        """
+        Calibrate the volume with the profile saved for the same series or the same scanner (no need to mark
+        the air and blood regions again)
+        @param scalarNode: MRML Scalar node to be calibrated
+        @param allowVolumeNameMatch: use the profile saved for a volume with the same name when the volume has no
+        DICOM information (see findStoredProfile). It should only be used after the user confirms it
+        @return: error message if something goes wrong, or None if everything works fine
+        """
+        if self.isCalibrated(scalarNode):
+            return "This volume has already been calibrated"
+        key, profile, matchedByName = self.findStoredProfile(scalarNode)
+        if profile is None:
+            return "There is no calibration profile saved for this series or its scanner"
+        if matchedByName and not allowVolumeNameMatch:
+            return "The only calibration profile found was saved for a volume with the same name"
+        self.applyCalibration(scalarNode, profile["slope"], profile["intercept"])
+
+    def findStoredProfile(self, scalarNode):
+        """
+        Profile saved for the series or the scanner of a volume. When the volume was not loaded from the DICOM
+        database, the profile saved for a volume with the same name is returned
+        @param scalarNode: MRML Scalar node
+        @return: tuple (key, profile, matchedByName). (None, None, False) if there is no profile
+        """
+        keys = self.getProfileKeys(scalarNode)
+        if len(keys) > 0:
+            key, profile = self.profiles.findProfile(keys)
+            return key, profile, False
+        key, profile = self.profiles.findProfile([self.getVolumeNameKey(scalarNode)])
+        return key, profile, profile is not None
+
+    def isCalibrated(self, scalarNode):
+        """
+        The volume has already been calibrated (in the current scene)
+        @param scalarNode: MRML Scalar node
+        @return: boolean
+        """
+        return scalarNode.GetAttribute(self.CALIBRATED_ATTRIBUTE) is not None
 
-        # Find the line that passes through these points
-        d = float(blood_input - air_input)
-        if d == 0:
-            # Prevent overflow
-            d = 0.0000001
-        m = (blood_output - air_output) / d
-        b = air_output - (m * air_input)
+    def getVolumeNameKey(self, scalarNode):
+        """
+        Profile key of a volume that was not loaded from the DICOM database (it only identifies the volume by name)
+        @param scalarNode: MRML Scalar node
+        @return: key
+        """
+        return self.VOLUME_NAME_KEY_PREFIX + scalarNode.GetName()
 
+    def getProfileKeys(self, scalarNode):
+        """
+        Keys that identify the calibration profile of a volume: series instance UID and scanner when the volume
+        was loaded from the DICOM database
+        @param scalarNode: MRML Scalar node
+        @return: list of keys in order of preference (empty if the volume has no DICOM information)
+        """
+        metadata = {}
+        instanceUIDs = scalarNode.GetAttribute("DICOM.instanceUIDs")
+        database = getattr(slicer, "dicomDatabase", None)
+        if instanceUIDs and database:
+            fileName = database.fileForInstance(instanceUIDs.split()[0])
+            for tag in (CalibrationProfiles.SERIES_UID_TAG,) + CalibrationProfiles.SCANNER_TAGS:
+                metadata[tag] = database.fileValue(fileName, tag.replace("|", ",").upper())
+        return CalibrationProfiles.candidateKeys(metadata)
+
+    def applyCalibration(self, scalarNode, m, b):
+        """
+        Rescale the volume in place with the line value * m + b (the result is saved as int16). The node is marked
+        with the attribute CALIBRATED_ATTRIBUTE, so that it is not calibrated twice
+        @param scalarNode: MRML Scalar node to be calibrated
+        @param m: slope
+        @param b: intercept
+        """
+        s = slicer.util.array(scalarNode.GetName())
         # Adjust the CT
-        a2 = s * m + b
-        a2 = a2.astype(np.int16)
-        slicer.util.updateVolumeFromArray(scalarNode, a2)
+        if IntensityLUT.isSupported(s.dtype):
+            # Calibrate every possible intensity just once and apply the table to the volume (in place for int16)
+            lut = IntensityLUT.linear(m, b, inputDtype=s.dtype, outputDtype=np.int16)
+            a2 = lut.apply(s, out=s if s.dtype == np.int16 else None)
+        else:
+            a2 = s * m + b
+            a2 = a2.astype(np.int16)
+        VolumeBuffer.writeArray(scalarNode, a2)
+        scalarNode.SetAttribute(self.CALIBRATED_ATTRIBUTE, "{0} {1}".format(m, b))
+
+    def runBatch(self, manifestPath, logPath, numWorkers=None, callbackStepFunction=None):
+        """
+        Calibrate a list of CT files with the stored profiles, without loading them in the scene.
+        See CalibrationBatch for the format of the files
+        @param manifestPath: csv file with rows (CT path, output path[, profile key])
+        @param logPath: csv file where the fit statistics of every series are appended
+        @param numWorkers: number of volumes calibrated in parallel (default: number of cpus)
+        @param callbackStepFunction: function(ctPath, error) invoked every time that a volume is finished
+        @return: list of tuples (CT path, error message) for the volumes that failed
+        """
+        return CalibrationBatch(self.profiles, numWorkers).run(manifestPath, logPath,
+                                                               callbackStepFunction=callbackStepFunction)
 
 
 
@@ -496,6 +680,18 @@ class CIP_CalibrationLogic(ScriptedLoadableModuleLogic):
             min_value = np.min(image_array)
         if max_value is None:
             max_value = np.max(image_array)
+
+        if not inplace and IntensityLUT.isSupported(image_array.dtype):
+            # Integer CT: normalize every possible intensity just once and build the float32 result with a
+            # single gather (the input array is not modified).
+            # Clipping to the min/max of the image does not change any value of the image, so it is always done
+            def function(values):
+                values = values.astype(np.float32)
+                CIP_CalibrationLogic.normalize_CT_image_intensity(values, min_value, max_value, min_output,
+                                                                  max_output, inplace=True)
+                return values
+            return IntensityLUT(function, image_array.dtype, np.float32).apply(image_array)
+
         if clip:
             np.clip(image_array, min_value, max_value, image_array)
 
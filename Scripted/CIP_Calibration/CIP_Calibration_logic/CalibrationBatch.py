@@ -0,0 +1,163 @@
+import csv
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import SimpleITK as sitk
+
+from CIP.logic import IntensityLUT
+from .CalibrationProfiles import CalibrationProfiles
+
+
+class CalibrationBatch(object):
+    """ Calibrate a list of CT files with the profiles stored in a CalibrationProfiles object.
+    The manifest is a csv file where every row contains the path to the CT, the path where the calibrated volume
+    will be saved and, optionally, the key of the profile to use. When there is no key, the profile is searched by
+    series instance UID and then by scanner, using the DICOM metadata of the file. Relative paths are relative to the
+    folder of the manifest.
+    Empty lines and lines that start with '#' are ignored.
+    Every volume is calibrated with a lookup table and written as soon as it is finished, so that every worker holds
+    at most two copies of a single volume. The fit statistics of every series are appended to a csv log.
+    The workers are threads: SimpleITK IO and the lookup table gather release the GIL, and unlike processes they
+    can use the CIP libraries loaded in Slicer.
+    """
+    LOG_COLUMNS = ["date", "input", "output", "profileKey", "slope", "intercept", "air_input", "blood_input",
+                   "air_output", "blood_output", "inputMin", "inputMax", "inputMean", "outputMin", "outputMax",
+                   "outputMean", "saturatedVoxels", "error"]
+
+    def __init__(self, profiles, numWorkers=None):
+        """
+        :param profiles: CalibrationProfiles object
+        :param numWorkers: number of volumes calibrated in parallel (default: number of cpus)
+        """
+        self.profiles = profiles
+        self.numWorkers = numWorkers if numWorkers is not None else (os.cpu_count() or 1)
+        self.__luts__ = {}
+        self.__lutsLock__ = threading.Lock()
+
+    @staticmethod
+    def readManifest(manifestPath):
+        """ Read the list of volumes to calibrate
+        :param manifestPath: csv file with rows (CT path, output path[, profile key]). Relative paths are relative to
+        the folder of the manifest
+        :return: list of tuples (absolute CT path, absolute output path, profile key or None)
+        """
+        cases = []
+        manifestFolder = os.path.dirname(os.path.abspath(manifestPath))
+        with open(manifestPath, 'r') as f:
+            for row in csv.reader(f):
+                if len(row) == 0 or row[0].strip() == "" or row[0].startswith("#"):
+                    continue
+                key = row[2].strip() if len(row) > 2 and row[2].strip() != "" else None
+                cases.append((os.path.normpath(os.path.join(manifestFolder, row[0].strip())),
+                              os.path.normpath(os.path.join(manifestFolder, row[1].strip())), key))
+        return cases
+
+    def __getLUT__(self, profileKey, profile, dtype):
+        """ Lookup table for a profile and an input type (shared by all the volumes that use the same profile)
+        """
+        with self.__lutsLock__:
+            if (profileKey, dtype) not in self.__luts__:
+                self.__luts__[(profileKey, dtype)] = IntensityLUT.linear(profile["slope"], profile["intercept"],
+                                                                         inputDtype=dtype, outputDtype=np.int16)
+            return self.__luts__[(profileKey, dtype)]
+
+    def calibrateFile(self, ctPath, outputPath, profileKey=None):
+        """ Calibrate a CT file and save the result (int16)
+        :param ctPath: path to the CT
+        :param outputPath: path of the calibrated volume
+        :param profileKey: key of the profile. If None, it is searched in the metadata of the file
+        :return: OrderedDict with the fit statistics (see LOG_COLUMNS)
+        """
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(ctPath)
+        reader.ReadImageInformation()
+        if profileKey is not None:
+            keys = [profileKey]
+        else:
+            keys = CalibrationProfiles.candidateKeys(dict((k, reader.GetMetaData(k))
+                                                          for k in reader.GetMetaDataKeys()))
+        profileKey, profile = self.profiles.findProfile(keys)
+        if profile is None:
+            raise ValueError("There is no calibration profile for {} (keys: {})".format(ctPath, keys))
+
+        image = reader.Execute()
+        array = sitk.GetArrayViewFromImage(image)
+        stats = OrderedDict()
+        if IntensityLUT.isSupported(array.dtype):
+            lut = self.__getLUT__(profileKey, profile, array.dtype)
+            calibrated = lut.apply(array)
+            # All the statistics are obtained from the histogram of the input (a single pass over the volume).
+            # Like in the table, the histogram is indexed with the unsigned reinterpretation of the values
+            indexDtype = np.dtype("u{}".format(array.dtype.itemsize))
+            histogram = np.bincount(array.reshape(-1).view(indexDtype), minlength=lut.table.size)
+            present = np.flatnonzero(histogram)
+            inputValues = present.astype(indexDtype).view(array.dtype)
+            outputValues = lut.table[present]
+            counts = histogram[present]
+            info = np.iinfo(np.int16)
+            stats["inputMin"] = int(inputValues.min())
+            stats["inputMax"] = int(inputValues.max())
+            stats["inputMean"] = float(np.dot(inputValues.astype(np.float64), counts) / counts.sum())
+            stats["outputMin"] = int(outputValues.min())
+            stats["outputMax"] = int(outputValues.max())
+            stats["outputMean"] = float(np.dot(outputValues.astype(np.float64), counts) / counts.sum())
+            stats["saturatedVoxels"] = int(counts[(outputValues == info.min) | (outputValues == info.max)].sum())
+        else:
+            calibrated = (array * profile["slope"] + profile["intercept"]).astype(np.int16)
+            stats["inputMin"] = float(array.min())
+            stats["inputMax"] = float(array.max())
+            stats["inputMean"] = float(array.mean())
+            stats["outputMin"] = int(calibrated.min())
+            stats["outputMax"] = int(calibrated.max())
+            stats["outputMean"] = float(calibrated.mean())
+            stats["saturatedVoxels"] = 0
+        del array
+
+        output = sitk.GetImageFromArray(calibrated)
+        output.CopyInformation(image)
+        del image, calibrated
+        sitk.WriteImage(output, outputPath, True)
+
+        row = OrderedDict((("input", ctPath), ("output", outputPath), ("profileKey", profileKey)))
+        for key in ("slope", "intercept", "air_input", "blood_input", "air_output", "blood_output"):
+            row[key] = profile[key]
+        row.update(stats)
+        return row
+
+    def run(self, manifestPath, logPath, callbackStepFunction=None):
+        """ Calibrate all the volumes in a manifest, appending the fit statistics of every series to a csv log
+        :param manifestPath: csv file with rows (CT path, output path[, profile key])
+        :param logPath: csv file where the statistics are appended (one row per volume, including the errors)
+        :param callbackStepFunction: function(ctPath, error) invoked every time that a volume is finished
+        (error is None if the volume was calibrated successfully)
+        :return: list of tuples (CT path, error message) for the volumes that failed
+        """
+        cases = self.readManifest(manifestPath)
+        errors = []
+        writeHeader = not os.path.isfile(logPath) or os.path.getsize(logPath) == 0
+        with open(logPath, 'a') as logFile:
+            writer = csv.DictWriter(logFile, fieldnames=self.LOG_COLUMNS)
+            if writeHeader:
+                writer.writeheader()
+            with ThreadPoolExecutor(max_workers=max(self.numWorkers, 1)) as executor:
+                futures = dict((executor.submit(self.calibrateFile, *case), case) for case in cases)
+                for future in as_completed(futures):
+                    ctPath, outputPath = futures[future][:2]
+                    try:
+                        row = future.result()
+                        error = None
+                    except Exception:
+                        error = traceback.format_exc()
+                        row = {"input": ctPath, "output": outputPath, "error": error.strip().splitlines()[-1]}
+                        errors.append((ctPath, error))
+                    # The log is written from this thread only, as soon as every volume is finished
+                    writer.writerow(dict(row, date=time.strftime("%Y/%m/%d %H:%M:%S")))
+                    logFile.flush()
+                    if callbackStepFunction:
+                        callbackStepFunction(ctPath, error)
+        return errors
@@ -0,0 +1,121 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+class CalibrationProfiles(object):
+    """ Persistent store of calibration profiles, so that the air/blood reference measurements taken in one series
+    can be reused to calibrate other series acquired with the same scanner (or the same series again) without
+    segmenting the reference regions.
+    Every profile is saved with a key that can be a series instance UID or a scanner key (see scannerKey), and it
+    contains the reference measurements (air_input, blood_input), the expected values (air_output, blood_output),
+    the fit parameters (slope, intercept) and some statistics of the measurement.
+    The profiles are stored in a json file that is rewritten every time that a profile changes.
+    """
+    # DICOM tags (in the format used by SimpleITK metadata) that identify a series and a scanner
+    SERIES_UID_TAG = "0020|000e"
+    SCANNER_TAGS = ("0008|0070", "0008|1090", "0018|1000", "0008|1010")     # Manufacturer, model, serial, station
+
+    def __init__(self, filePath):
+        """
+        :param filePath: json file where the profiles are stored (it is created the first time a profile is saved)
+        """
+        self.filePath = filePath
+        self.__profiles__ = OrderedDict()
+        if os.path.isfile(filePath):
+            with open(filePath, 'r') as f:
+                self.__profiles__ = json.load(f, object_pairs_hook=OrderedDict)
+
+    @staticmethod
+    def fit(air_input, blood_input, air_output, blood_output):
+        """ Line that maps the measured air/blood values to the expected ones
+        :return: tuple (slope, intercept)
+        """
+        d = float(blood_input - air_input)
+        if d == 0:
+            # Prevent overflow
+            d = 0.0000001
+        m = (blood_output - air_output) / d
+        b = air_output - (m * air_input)
+        return m, b
+
+    @staticmethod
+    def scannerKey(metadata):
+        """ Key that identifies the scanner that acquired a series
+        :param metadata: dictionary of DICOM tag values (ex: {"0008|0070": "GE MEDICAL SYSTEMS", ...})
+        :return: string key or None if the metadata do not contain any scanner information
+        """
+        values = [str(metadata.get(tag, "")).strip() for tag in CalibrationProfiles.SCANNER_TAGS]
+        if not any(values):
+            return None
+        return "scanner:" + "|".join(values)
+
+    @staticmethod
+    def candidateKeys(metadata):
+        """ Keys that could contain a profile for a series, in order of preference (series UID, scanner)
+        :param metadata: dictionary of DICOM tag values
+        :return: list of keys
+        """
+        keys = []
+        seriesUID = str(metadata.get(CalibrationProfiles.SERIES_UID_TAG, "")).strip()
+        if seriesUID:
+            keys.append(seriesUID)
+        scannerKey = CalibrationProfiles.scannerKey(metadata)
+        if scannerKey is not None:
+            keys.append(scannerKey)
+        return keys
+
+    def keys(self):
+        return list(self.__profiles__.keys())
+
+    def getProfile(self, key):
+        """ Profile saved with a key
+        :return: dictionary or None if there is no profile for the key
+        """
+        return self.__profiles__.get(key)
+
+    def findProfile(self, keys):
+        """ First profile found for a list of keys
+        :param keys: list of keys (see candidateKeys)
+        :return: tuple (key, profile) or (None, None)
+        """
+        for key in keys:
+            if key in self.__profiles__:
+                return key, self.__profiles__[key]
+        return None, None
+
+    def setProfile(self, key, air_input, blood_input, air_output, blood_output, **statistics):
+        """ Save (or replace) a profile
+        :param key: series instance UID, scanner key or any other identifier
+        :param air_input: mean value measured in air
+        :param blood_input: mean value measured in blood
+        :param air_output: value expected for air
+        :param blood_output: value expected for blood
+        :param statistics: any other information of the measurement (ex: air_std, blood_count...)
+        :return: the new profile
+        """
+        slope, intercept = self.fit(air_input, blood_input, air_output, blood_output)
+        profile = OrderedDict((("air_input", float(air_input)), ("blood_input", float(blood_input)),
+                               ("air_output", float(air_output)), ("blood_output", float(blood_output)),
+                               ("slope", slope), ("intercept", intercept),
+                               ("date", time.strftime("%Y/%m/%d %H:%M:%S"))))
+        profile.update((k, float(v)) for k, v in statistics.items())
+        self.__profiles__[key] = profile
+        self.save()
+        return profile
+
+    def removeProfile(self, key):
+        if self.__profiles__.pop(key, None) is not None:
+            self.save()
+
+    def save(self):
+        """ Write all the profiles (the file is replaced atomically, so it is never left half written)
+        """
+        folder = os.path.dirname(self.filePath)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tempPath = self.filePath + ".tmp"
+        with open(tempPath, 'w') as f:
+            json.dump(self.__profiles__, f, indent=2)
+        os.replace(tempPath, self.filePath)
@@ -0,0 +1,2 @@
+from .CalibrationProfiles import *
+from .CalibrationBatch import *
@@ -3,14 +3,13 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import collections
 import itertools
-import numpy as np
 import time
 import SimpleITK as sitk
 import logging
 from collections import OrderedDict
 
 from CIP.logic.SlicerUtil import SlicerUtil
-from CIP.logic import Util
+from CIP.logic import Util, VolumeBuffer
 from CIP.logic import GeometryTopologyData, Point
 from CIP.ui import CaseReportsWidget, MIPViewerWidget
 
@@ -2210,12 +2209,10 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
             labelmapArray = slicer.util.array(self.getNthNoduleLabelmapNode(vtkMRMLScalarVolumeNode, noduleIndex).GetID())
             centroid = Util.centroid(labelmapArray)
             # Calculate the distance map for the specified origin
-            # Get the dimensions of the volume in ZYX coords
-            dims = Util.vtk_numpy_coordinate(vtkMRMLScalarVolumeNode.GetImageData().GetDimensions())
             # Speed map (all ones because the growth will be constant).
-            # The dimensions are reversed because we want the format in ZYX coordinates
-            input = np.ones(dims, np.int32)
-            sitkImage = sitk.GetImageFromArray(input)
+            # The image is created directly in SimpleITK (XYZ coords), with no intermediate numpy volume
+            sitkImage = sitk.Image(vtkMRMLScalarVolumeNode.GetImageData().GetDimensions(), sitk.sitkInt32)
+            sitkImage += 1
             sitkImage.SetSpacing(vtkMRMLScalarVolumeNode.GetSpacing())
             fastMarchingFilter = sitk.FastMarchingImageFilter()
             fastMarchingFilter.SetStoppingValue(self.MAX_TUMOR_RADIUS)
@@ -2223,7 +2220,9 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
             seeds = [Util.numpy_itk_coordinate(centroid)]
             fastMarchingFilter.SetTrialPoints(seeds)
             output = fastMarchingFilter.Execute(sitkImage)
-            self.currentDistanceMaps[(vtkMRMLScalarVolumeNode.GetID(), noduleIndex)] = sitk.GetArrayFromImage(output)
+            # Numpy view of the output buffer (no copy)
+            self.currentDistanceMaps[(vtkMRMLScalarVolumeNode.GetID(), noduleIndex)] = \
+                VolumeBuffer.arrayFromSitkImage(output)
 
         return self.currentDistanceMaps[(vtkMRMLScalarVolumeNode.GetID(), noduleIndex)]
 
@@ -11,6 +11,7 @@ from CIP.ui import PreProcessingWidget
 from CIP.ui import PdfReporter
 from CIP.logic.SlicerUtil import SlicerUtil
 from CIP.logic.Util import Util
+from CIP.logic import IntensityLUT, VolumeBuffer
 from CIP.logic.lung_splitter import LungSplitter as lung_splitter
 from functools import reduce
 
@@ -85,6 +86,8 @@ class CIP_ParenchymaAnalysisWidget(ScriptedLoadableModuleWidget):
         self.lungMaskNode = None  # segmentation node or labelmap volume node of the lung
         self.fileName = None
         self.fileDialog = None
+        self.inputNodesObservers = []   # (node, tag) observers used to invalidate the cached results
+        self.sceneClosedObserver = None
 
         if not parent:
             self.setup()
@@ -142,6 +145,22 @@ class CIP_ParenchymaAnalysisWidget(ScriptedLoadableModuleWidget):
         self.labelSelector.setToolTip("Pick the lung segmentation or labelmap volume.")
         parametersFormLayout.addRow("Lung mask: ", self.labelSelector)
         #
+        # Regional emphysema map
+        #
+        self.emphysemaMapCheckBox = qt.QCheckBox()
+        self.emphysemaMapCheckBox.setText("Window size (mm):")
+        self.emphysemaMapCheckBox.setChecked(False)
+        self.emphysemaMapCheckBox.setToolTip("Create a volume with the local LAA%-950 in a cubic window around every lung voxel")
+        self.emphysemaMapWindowSpinBox = qt.QSpinBox()
+        self.emphysemaMapWindowSpinBox.minimum = 3
+        self.emphysemaMapWindowSpinBox.maximum = 100
+        self.emphysemaMapWindowSpinBox.value = 20
+        emphysemaMapFrame = qt.QFrame()
+        emphysemaMapFrame.setLayout(qt.QHBoxLayout())
+        emphysemaMapFrame.layout().addWidget(self.emphysemaMapCheckBox)
+        emphysemaMapFrame.layout().addWidget(self.emphysemaMapWindowSpinBox)
+        parametersFormLayout.addRow("Regional emphysema map: ", emphysemaMapFrame)
+        #
         # Image filtering section
         #
         self.preProcessingWidget = PreProcessingWidget(self.moduleName, parentWidget=self.parent)
@@ -310,13 +329,48 @@ class CIP_ParenchymaAnalysisWidget(ScriptedLoadableModuleWidget):
         self.RMTHistCheckBox.connect('clicked()', self.onHistogram)
         self.RLTHistCheckBox.connect('clicked()', self.onHistogram)
 
+        self.sceneClosedObserver = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.__onSceneClosed__)
+
     def cleanup(self):
+        self.__removeInputNodesObservers__()
+        if self.sceneClosedObserver is not None:
+            slicer.mrmlScene.RemoveObserver(self.sceneClosedObserver)
+            self.sceneClosedObserver = None
         self.reportsWidget.cleanup()
         self.reportsWidget = None
 
+    def __removeInputNodesObservers__(self):
+        for node, tag in self.inputNodesObservers:
+            node.RemoveObserver(tag)
+        self.inputNodesObservers = []
+
+    def __observeInputNodes__(self):
+        """ Observe the modifications in the content of the CT and the lung mask, so that any cached
+        results of the analysis are discarded when they are edited
+        """
+        self.__removeInputNodesObservers__()
+        for node in (self.CTNode, self.lungMaskNode):
+            if node is None:
+                continue
+            if node.GetClassName() == "vtkMRMLSegmentationNode":
+                events = (slicer.vtkSegmentation.MasterRepresentationModified, slicer.vtkSegmentation.SegmentRemoved)
+            else:
+                events = (slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent,)
+            for event in events:
+                self.inputNodesObservers.append((node, node.AddObserver(event, self.__onInputNodeModified__)))
+
+    def __onInputNodeModified__(self, caller, event):
+        CIP_ParenchymaAnalysisLogic.invalidateCache(caller.GetID())
+
+    def __onSceneClosed__(self, arg1, arg2):
+        # Node ids may be reused in a new scene
+        self.inputNodesObservers = []
+        CIP_ParenchymaAnalysisLogic.invalidateCache()
+
     def onCTSelect(self, node):
         self.CTNode = node
         slicer.util.setSliceViewerLayers(background=self.CTNode, fit=True)
+        self.__observeInputNodes__()
         self.updateButtonStates()
 
     def onLabelSelect(self, node):
@@ -326,6 +380,7 @@ class CIP_ParenchymaAnalysisWidget(ScriptedLoadableModuleWidget):
             slicer.util.setSliceViewerLayers(label=self.lungMaskNode, labelOpacity=0.5)
 
         self.preProcessingWidget.filterApplication.setChecked(self.lungMaskNode is not None)
+        self.__observeInputNodes__()
         self.updateButtonStates()
 
     def updateButtonStates(self):
@@ -406,28 +461,13 @@ class CIP_ParenchymaAnalysisWidget(ScriptedLoadableModuleWidget):
 
         self.preProcessingWidget.createPartialLM(inputNode, self.lungMaskNode)
 
-        label_image = self.lungMaskNode.GetImageData()
-        shape = list(label_image.GetDimensions())
-        input_array = vtk.util.numpy_support.vtk_to_numpy(label_image.GetPointData().GetScalars())
-        original_shape = input_array.shape
-        input_array = input_array.reshape(shape[2], shape[1], shape[0])  # input_array.transpose([2, 1, 0]) would not work!
-
-        input_image = sitk.GetImageFromArray(input_array)
-        input_image.SetSpacing(self.lungMaskNode.GetSpacing())
-        input_image.SetOrigin(self.lungMaskNode.GetOrigin())
+        input_image = VolumeBuffer.sitkImage(self.lungMaskNode)
 
         my_lung_splitter = lung_splitter(split_thirds=True)
-        split_lm = my_lung_splitter.execute(input_image)
-
-        split = sitk.GetArrayFromImage(split_lm)
-
-        input_aa = vtk.util.numpy_support.vtk_to_numpy(label_image.GetPointData().GetScalars())
-
-        input_aa[:] = split.reshape(original_shape)
+        split = my_lung_splitter.execute_array(input_image)
 
-        self.lungMaskNode.StorableModified()
-        self.lungMaskNode.Modified()
-        self.lungMaskNode.InvokeEvent(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.lungMaskNode)
+        # Write the result in place in the labelmap buffer
+        VolumeBuffer.writeArray(self.lungMaskNode, split)
 
         SlicerUtil.changeLabelmapOpacity(0.5)
 
@@ -452,8 +492,16 @@ class CIP_ParenchymaAnalysisWidget(ScriptedLoadableModuleWidget):
 
         self.logic = CIP_ParenchymaAnalysisLogic(self.CTNode, self.lungMaskNode, self.HistogramFreqOption.checked)
         self.populateStats()
-        self.logic.computeEmphysemaOnSlice(self.CTNode, self.logic.labelNode)
+        if self.logic.sitk_ct_slice is None:
+            self.logic.computeEmphysemaOnSlice(self.CTNode, self.logic.labelNode)
         self.logic.createHistogram(self.logic.labelNode)
+        if self.emphysemaMapCheckBox.checked:
+            self.applyButton.text = "Creating emphysema map..."
+            self.applyButton.repaint()
+            slicer.app.processEvents()
+            emphysemaMapNode = self.logic.createRegionalEmphysemaMap(self.CTNode, self.logic.labelNode,
+                                                                     windowSizeMm=self.emphysemaMapWindowSpinBox.value)
+            SlicerUtil.displayForegroundVolume(emphysemaMapNode.GetID(), opacity=0.5)
         for i in range(len(self.histogramCheckBoxes)):
             self.histogramCheckBoxes[i].setChecked(False)
             self.histogramCheckBoxes[i].hide()
@@ -534,6 +582,10 @@ class CIP_ParenchymaAnalysisWidget(ScriptedLoadableModuleWidget):
 
         values["@@EMPHYSEMA_IMAGE@@"] = emphysema_image_path
         values["@@CT_IMAGE@@"] = ct_slice_path
+        axial_thumbnails_path, coronal_thumbnails_path = self.logic.writeEmphysemaThumbnailsToFiles(
+            self.CTNode, self.logic.labelNode, op=0.5)
+        values["@@AXIAL_THUMBNAILS@@"] = axial_thumbnails_path
+        values["@@CORONAL_THUMBNAILS@@"] = coronal_thumbnails_path
 
         # Print the report. Remember that we can optionally specify the absolute path where the report is going to
         # be stored
@@ -593,6 +645,12 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
     """
     __preventDialogs__ = False
 
+    # Results of previous analyses, indexed by (CT node id, lung mask node id). Every entry also stores the
+    # modification stamps of the inputs, so that the results are only reused while the inputs remain unchanged
+    __resultsCache__ = {}
+    __cachedAttributes__ = ("regionTags", "regionColors", "regionValues", "labelStats", "regionHists",
+                            "regionHists_by_region_volume", "regionBins", "sitk_ct_slice", "sitk_emph_slice")
+
     statsColumnKeys = ["LAA%-950", "LAA%-925", "LAA%-910", "LAA%-856", "HAA%-700", "HAA%-600", "HAA%-500", "HAA%-250",
                      "HAA%-600-250", "Perc10", "Perc15", "Mean", "Std", "Kurtosis", "Skewness",
                      "Ventilation Heterogeneity", "Mass", "Volume"]
@@ -656,15 +714,29 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         self.sitk_emph_slice = None
         self.colorTableNode = None
 
-        if lungMaskNode and lungMaskNode.GetClassName() == "vtkMRMLSegmentationNode":
-            # Got a segmentation node, create a label node from it
-            self.labelNode, self.colorTableNode = self.convertSegmentsToCipLabelmapNode(CTNode, lungMaskNode)
+        if not lungMaskNode:
+            raise ValueError("Invalid lungMaskNode")
+        self.__CTNode__ = CTNode
+        self.__lungMaskNode__ = lungMaskNode
+        if lungMaskNode.GetClassName() == "vtkMRMLSegmentationNode":
+            # Got a segmentation node. The label node is created from it only when it is needed (see labelNode)
+            self.__labelNode__ = None
         else:
             # Got a label node, use it as is
-            self.labelNode = lungMaskNode
+            self.__labelNode__ = lungMaskNode
 
-        if not self.labelNode:
-            raise ValueError("Invalid lungMaskNode")
+        # Reuse the results of a previous analysis if neither the CT nor the lung mask changed since then.
+        # The cache is checked before converting a segmentation, so a repeated analysis does not export it again
+        self.__cacheKey__ = (CTNode.GetID(), lungMaskNode.GetID())
+        self.__cacheStamp__ = self.getInputsModificationStamp(CTNode, lungMaskNode)
+        self.freq_by_region_volume = freq_by_region_volume
+        # MRML nodes that are reused when the histograms/charts are displayed again
+        self.histogramTableNodes = {}
+        self.statsChartTableNodes = {}
+        self.statsChartNodes = {}
+        if self.__restoreFromCache__():
+            logging.info("Parenchyma analysis results restored from cache")
+            return
 
         displayNode = self.labelNode.GetDisplayNode()
         colorNode = displayNode.GetColorNode()
@@ -698,8 +770,6 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         self.regionHists = {}
         self.regionBins = {}
 
-        self.freq_by_region_volume = freq_by_region_volume
-
         datalabel_arr = vtk.util.numpy_support.vtk_to_numpy(self.labelNode.GetImageData().GetPointData().GetScalars())
         data_arr = vtk.util.numpy_support.vtk_to_numpy(CTNode.GetImageData().GetPointData().GetScalars())
 
@@ -765,6 +835,69 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
 
                 # this.InvokeEvent(vtkParenchymaAnalysisLogic::EndLabelStats, (void*)"end label stats")
 
+        self.__updateCache__()
+
+    @property
+    def labelNode(self):
+        """ Labelmap of the lung. When the lung mask is a segmentation, it is converted the first time it is needed
+        """
+        if self.__labelNode__ is None:
+            self.__labelNode__, self.colorTableNode = self.convertSegmentsToCipLabelmapNode(self.__CTNode__,
+                                                                                            self.__lungMaskNode__)
+            if not self.__labelNode__:
+                raise ValueError("Invalid lungMaskNode")
+        return self.__labelNode__
+
+    @staticmethod
+    def getInputsModificationStamp(CTNode, lungMaskNode):
+        """ Get a tuple that changes every time that the content of the CT or the lung mask is modified
+        (modification times of the image data or of the segmentation)
+        :param CTNode: vtkMRMLScalarVolumeNode
+        :param lungMaskNode: vtkMRMLLabelMapVolumeNode or vtkMRMLSegmentationNode
+        :return: tuple of modification times
+        """
+        if lungMaskNode.GetClassName() == "vtkMRMLSegmentationNode":
+            maskTime = lungMaskNode.GetSegmentation().GetMTime()
+        else:
+            maskTime = lungMaskNode.GetImageData().GetMTime()
+        return CTNode.GetImageData().GetMTime(), maskTime
+
+    @staticmethod
+    def invalidateCache(nodeID=None):
+        """ Remove the cached results computed with a node (CT or lung mask).
+        :param nodeID: id of the node. If None, all the results are removed
+        """
+        if nodeID is None:
+            CIP_ParenchymaAnalysisLogic.__resultsCache__.clear()
+            return
+        for key in [key for key in CIP_ParenchymaAnalysisLogic.__resultsCache__ if nodeID in key]:
+            del CIP_ParenchymaAnalysisLogic.__resultsCache__[key]
+
+    def __restoreFromCache__(self):
+        """ Load the results of a previous analysis that was run with the same (unmodified) inputs
+        :return: True if the results were found in the cache
+        """
+        entry = CIP_ParenchymaAnalysisLogic.__resultsCache__.get(self.__cacheKey__)
+        if entry is None or entry["stamp"] != self.__cacheStamp__:
+            return False
+        for attr in CIP_ParenchymaAnalysisLogic.__cachedAttributes__:
+            setattr(self, attr, entry[attr])
+        if self.__labelNode__ is None and entry.get("labelNode") is not None \
+                and slicer.mrmlScene.IsNodePresent(entry["labelNode"]):
+            # Labelmap converted from the same (unmodified) segmentation in the previous analysis
+            self.__labelNode__, self.colorTableNode = entry["labelNode"], entry["colorTableNode"]
+        return True
+
+    def __updateCache__(self):
+        """ Store the current results in the cache
+        """
+        entry = {"stamp": self.__cacheStamp__}
+        for attr in CIP_ParenchymaAnalysisLogic.__cachedAttributes__:
+            entry[attr] = getattr(self, attr)
+        if self.__labelNode__ is not self.__lungMaskNode__:
+            entry["labelNode"], entry["colorTableNode"] = self.__labelNode__, self.colorTableNode
+        CIP_ParenchymaAnalysisLogic.__resultsCache__[self.__cacheKey__] = entry
+
     @staticmethod
     def percentile(N, percent, key=lambda x: x):
         """
@@ -885,18 +1018,15 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         # self.setChartLayout()
         #chartViewNode = SlicerUtil.getNode('ChartView')
 
+        chartNode = self.statsChartNodes.get(valueToPlot)
+        if chartNode is not None and slicer.mrmlScene.GetNodeByID(chartNode.GetID()) is not None:
+            # The chart for this value was already built. Just refresh its table (values may have changed)
+            self.__fillStatsChartTableNode__(self.statsChartTableNodes[valueToPlot], valueToPlot)
+            slicer.modules.plots.logic().ShowChartInLayout(chartNode)
+            return
+
         tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", valueToPlot +" data")
-        col1=tableNode.AddColumn()
-        col1.SetName("Label")
-        col2=tableNode.AddColumn()
-        col2.SetName("Value")
-        
-        tableNode.SetColumnType("Label",vtk.VTK_STRING)
-        tableNode.SetColumnType("Value",vtk.VTK_FLOAT)
-        for i, regionTag in enumerate(self.regionTags):
-            tableNode.AddEmptyRow()
-            tableNode.SetCellText(i,0,regionTag)
-            tableNode.SetCellText(i,1,str(self.labelStats[valueToPlot, regionTag]))
+        self.__fillStatsChartTableNode__(tableNode, valueToPlot)
 
         barPlotSeries = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", valueToPlot + " bar plot")
         barPlotSeries.SetAndObserveTableNodeID(tableNode.GetID())
@@ -915,6 +1045,9 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         xLabelStr = "Lung area"
         chartNode.SetXAxisTitle(xLabelStr)
         chartNode.AddAndObservePlotSeriesNodeID(barPlotSeries.GetID())
+
+        self.statsChartTableNodes[valueToPlot] = tableNode
+        self.statsChartNodes[valueToPlot] = chartNode
     
         # Show plot in layout
         slicer.modules.plots.logic().ShowChartInLayout(chartNode)
@@ -931,6 +1064,19 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
 
         #chartNode.SetProperty(valueToPlot, 'lookupTable', colorTableNode.GetID())
 
+    def __fillStatsChartTableNode__(self, tableNode, valueToPlot):
+        """ Fill the table of a stats chart with a "Label" (region) column and a "Value" column
+        """
+        import numpy
+        labels = vtk.vtkStringArray()
+        labels.SetName("Label")
+        labels.SetNumberOfValues(len(self.regionTags))
+        for i, regionTag in enumerate(self.regionTags):
+            labels.SetValue(i, regionTag)
+        tableNode.GetTable().GetRowData().AddArray(labels)
+        values = numpy.array([self.labelStats[valueToPlot, regionTag] for regionTag in self.regionTags])
+        SlicerUtil.setTableNodeNumericColumns(tableNode, [("Value", values)])
+
     def convertSegmentsToCipLabelmapNode(self, CTNode, segmentationNode):
         colorTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLColorTableNode", "__temp__chest_region_colors_basic")
         colorTableNode.SetTypeToUser()
@@ -954,8 +1100,8 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
 
     def deleteLabelNode(self):
         # cleanup
-        if self.labelNode:
-            slicer.mrmlScene.RemoveNode(self.labelNode)
+        if self.__labelNode__:
+            slicer.mrmlScene.RemoveNode(self.__labelNode__)
         if self.colorTableNode: 
             slicer.mrmlScene.RemoveNode(self.colorTableNode)
 
@@ -976,30 +1122,7 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         plotChartNode.SetYAxisRange(0, 50)
 
         for regionTag in self.regionTags:
-            if self.freq_by_region_volume:
-                histogram = self.regionHists_by_region_volume[regionTag]
-            else:
-                histogram = self.regionHists[regionTag]
-
-            bins = self.regionBins[regionTag]
-
-            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", 'TableNode_{}'.format(regionTag))
-            table = tableNode.GetTable()
-
-            arrX = vtk.vtkFloatArray()
-            arrX.SetName("bins".format(regionTag))
-            table.AddColumn(arrX)
-
-            arrY = vtk.vtkFloatArray()
-            arrY.SetName("freq_{}".format(regionTag))
-            table.AddColumn(arrY)
-
-            dataSamples = histogram.size
-            table.SetNumberOfRows(dataSamples)
-
-            for i in range(dataSamples):
-                table.SetValue(i, 0, float(bins[i]))
-                table.SetValue(i, 1, histogram[i])
+            tableNode = self.__fillHistogramTableNode__(regionTag, self.freq_by_region_volume)
 
             plotSeriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", regionTag)
             plotSeriesNode.SetAndObserveTableNodeID(tableNode.GetID())
@@ -1019,41 +1142,42 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
     def ChangeHistogramFrequency(self, histogramsList, byRegionVolume=True):
         plotChartNode = SlicerUtil.getNode('PlotChartNode')
         plotChartNode.RemoveAllPlotSeriesNodeIDs()
-        for regionTag in self.regionTags:
-            if byRegionVolume:
-                plotChartNode.SetYAxisRange(0, 50)
-                histogram = self.regionHists_by_region_volume[regionTag]
-            else:
-                plotChartNode.SetYAxisRange(0, 0.01)
-                histogram = self.regionHists[regionTag]
-
-            bins = self.regionBins[regionTag]
-
-            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", 'TableNode_{}'.format(regionTag))
-            table = tableNode.GetTable()
-
-            arrX = vtk.vtkFloatArray()
-            arrX.SetName("bins".format(regionTag))
-            table.AddColumn(arrX)
-
-            arrY = vtk.vtkFloatArray()
-            arrY.SetName("freq_{}".format(regionTag))
-            table.AddColumn(arrY)
-
-            dataSamples = histogram.size
-            table.SetNumberOfRows(dataSamples)
-
-            for i in range(dataSamples):
-                table.SetValue(i, 0, float(bins[i]))
-                table.SetValue(i, 1, histogram[i])
+        if byRegionVolume:
+            plotChartNode.SetYAxisRange(0, 50)
+        else:
+            plotChartNode.SetYAxisRange(0, 0.01)
+        self.freq_by_region_volume = byRegionVolume
 
+        for regionTag in self.regionTags:
+            # The existing table nodes are refilled, so no new MRML nodes are created when toggling
+            tableNode = self.__fillHistogramTableNode__(regionTag, byRegionVolume)
             plotSeriesNode = SlicerUtil.getNode(regionTag)
             plotSeriesNode.SetAndObserveTableNodeID(tableNode.GetID())
-            plotSeriesNode.SetXColumnName("bins".format(regionTag))
-            plotSeriesNode.SetYColumnName("freq_{}".format(regionTag))
 
         self.AddSelectedHistograms(histogramsList)
 
+    def __fillHistogramTableNode__(self, regionTag, byRegionVolume):
+        """ Fill the table node that contains the histogram of a region ("bins" and "freq_<region>" columns).
+        The table node is created just the first time, and it is reused afterwards
+        :param regionTag: region
+        :param byRegionVolume: use the histogram multiplied by the region volume
+        :return: vtkMRMLTableNode
+        """
+        if byRegionVolume:
+            histogram = self.regionHists_by_region_volume[regionTag]
+        else:
+            histogram = self.regionHists[regionTag]
+        # There is one bin edge more than histogram values
+        bins = self.regionBins[regionTag][:histogram.size]
+
+        tableNode = self.histogramTableNodes.get(regionTag)
+        if tableNode is None or slicer.mrmlScene.GetNodeByID(tableNode.GetID()) is None:
+            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", 'TableNode_{}'.format(regionTag))
+            self.histogramTableNodes[regionTag] = tableNode
+
+        SlicerUtil.setTableNodeNumericColumns(tableNode, [("bins", bins), ("freq_{}".format(regionTag), histogram)])
+        return tableNode
+
     def AddSelectedHistograms(self, histogramsList):
         histogramViewNode = SlicerUtil.getNode('HistogramView')
         plotChartNode = SlicerUtil.getNode('PlotChartNode')
@@ -1174,29 +1298,115 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         import numpy as np
         import SimpleITK as sitk
 
-        image_arr = slicer.util.array(CTNode.GetName()).transpose([2, 1, 0])
-        label_arr = slicer.util.array(labelNode.GetName()).transpose([2, 1, 0])
-
-        sl = int(image_arr.shape[2] / 2.0)
+        # Numpy views (zyx) of the volumes. The labelmap must not be modified here
+        image_arr = slicer.util.arrayFromVolume(CTNode)
+        label_arr = slicer.util.arrayFromVolume(labelNode)
 
+        # Coronal center slice (z, x). The arrays are (z, y, x), so the center is taken from the y extent.
+        # Behaviour change: before, the arrays were transposed to (x, y, z) and the y index was shape[2] / 2, i.e. half
+        # the number of axial slices (it was only the central coronal slice when the number of slices and rows were
+        # equal, and it failed when there were more than twice as many slices as rows). The report and the thumbnails
+        # now always show the central coronal slice, which is a different slice for most scans
+        sl = int(image_arr.shape[1] / 2.0)
         ct_slice = image_arr[:, sl, :]
         slice_label = label_arr[:, sl, :]
-        slice_label[np.logical_and(slice_label > 1, slice_label < 512)] = 1
-        slice_label[slice_label >= 512] = 0
-
-        emph_slice = ct_slice.copy()
 
-        emph_slice[emph_slice >= -950.0] = 0
-        emph_slice[np.logical_and(emph_slice >= -3000.0, emph_slice < -950.0)] = 1
-        emph_slice = emph_slice.astype(np.uint8)
+        emph_slice = ((ct_slice >= -3000.0) & (ct_slice < -950.0) &
+                      (slice_label > 0) & (slice_label < 512)).astype(np.uint8)
 
-        emph_slice[slice_label==0] = 0
-
-        sitk_ct_slice = sitk.GetImageFromArray(ct_slice.transpose())
+        sitk_ct_slice = sitk.GetImageFromArray(ct_slice)
         self.sitk_ct_slice = sitk.Cast(sitk.IntensityWindowing(sitk_ct_slice, windowMinimum=-1200, windowMaximum=200,
                                                           outputMinimum=0, outputMaximum=255), sitk.sitkUInt8)
 
-        self.sitk_emph_slice = sitk.GetImageFromArray(emph_slice.transpose())
+        self.sitk_emph_slice = sitk.GetImageFromArray(emph_slice)
+        self.__updateCache__()
+
+    def createRegionalEmphysemaMap(self, CTNode, labelNode, windowSizeMm=20.0, threshold=-950):
+        """ Build a volume with the local LAA% (percentage of lung voxels below a threshold) inside a
+        cubic neighbourhood centered in every lung voxel. Voxels outside the lung are set to 0.
+        The map is computed with integral volumes, so the cost does not depend on the window size.
+        :param CTNode: CT volume
+        :param labelNode: lung labelmap
+        :param windowSizeMm: side of the cubic neighbourhood (mm)
+        :param threshold: LAA threshold (HU)
+        :return: new vtkMRMLScalarVolumeNode (float32) with the same geometry as the CT
+        """
+        ct_arr = slicer.util.arrayFromVolume(CTNode)
+        label_arr = slicer.util.arrayFromVolume(labelNode)
+        # Radius of the window (in voxels) for every axis in numpy order (zyx)
+        spacing = list(CTNode.GetSpacing())
+        spacing.reverse()
+        radius = [max(0, int(round(windowSizeMm / 2.0 / sp))) for sp in spacing]
+        lowerLabel, upperLabel = CIP_ParenchymaAnalysisLogic.allRegionValues[0]
+        lung = (label_arr >= lowerLabel) & (label_arr <= upperLabel)
+
+        emphysemaMap = self.localLowAttenuationPercentage(ct_arr, lung, radius, threshold)
+
+        mapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
+                                                     slicer.mrmlScene.GenerateUniqueName(CTNode.GetName() + "_LAA{}Map".format(threshold)))
+        mapNode.CopyOrientation(CTNode)
+        slicer.util.updateVolumeFromArray(mapNode, emphysemaMap)
+        return mapNode
+
+    @staticmethod
+    def localLowAttenuationPercentage(ct_arr, lung_arr, radius, threshold=-950):
+        """ Percentage of lung voxels below a threshold inside a box around every lung voxel
+        :param ct_arr: numpy array (zyx) of the CT
+        :param lung_arr: boolean numpy array (zyx) of the lung mask
+        :param radius: window radius (in voxels) for every axis (zyx)
+        :param threshold: LAA threshold (HU)
+        :return: float32 numpy array with values in [0, 100] (0 outside the lung)
+        """
+        import numpy as np
+        lowAttenuation = (ct_arr < threshold) & lung_arr
+        lowAttenuationSums = CIP_ParenchymaAnalysisLogic.boxSums(CIP_ParenchymaAnalysisLogic.integralVolume(lowAttenuation), radius)
+        lungSums = CIP_ParenchymaAnalysisLogic.boxSums(CIP_ParenchymaAnalysisLogic.integralVolume(lung_arr), radius)
+
+        result = np.zeros(ct_arr.shape, dtype=np.float32)
+        # Every lung voxel contains at least itself in its window, so lungSums > 0 there
+        np.divide(lowAttenuationSums, lungSums, out=result, where=lung_arr)
+        result *= 100.0
+        return result
+
+    @staticmethod
+    def integralVolume(mask_arr):
+        """ Summed-area table of a 3D mask, padded with a leading 0 in every axis, so that
+        integral[z, y, x] = mask_arr[:z, :y, :x].sum()
+        :param mask_arr: 3D numpy array (boolean or integer)
+        :return: int32 numpy array with one more element in every dimension
+        """
+        import numpy as np
+        integral = np.zeros(tuple(n + 1 for n in mask_arr.shape), dtype=np.int32)
+        integral[1:, 1:, 1:] = mask_arr
+        for axis in range(3):
+            np.cumsum(integral, axis=axis, out=integral)
+        return integral
+
+    @staticmethod
+    def boxSums(integral, radius):
+        """ Sum of the original values inside a box of (2 * radius + 1) voxels centered in every voxel
+        (clipped in the borders of the volume), calculated from an integral volume
+        :param integral: padded integral volume (see integralVolume)
+        :param radius: radius of the box (in voxels) for every axis
+        :return: int32 numpy array with the shape of the original volume
+        """
+        import numpy as np
+        bounds = []
+        for n, r in zip(integral.shape, radius):
+            n -= 1
+            i = np.arange(n)
+            bounds.append((np.clip(i - r, 0, n), np.clip(i + r + 1, 0, n)))
+        (z0, z1), (y0, y1), (x0, x1) = bounds
+        # Inclusion-exclusion over the 8 corners of every box
+        result = integral[np.ix_(z1, y1, x1)]
+        result -= integral[np.ix_(z0, y1, x1)]
+        result -= integral[np.ix_(z1, y0, x1)]
+        result -= integral[np.ix_(z1, y1, x0)]
+        result += integral[np.ix_(z0, y0, x1)]
+        result += integral[np.ix_(z0, y1, x0)]
+        result += integral[np.ix_(z1, y0, x0)]
+        result -= integral[np.ix_(z0, y0, x0)]
+        return result
 
     def writeEmphysemaOnSliceToFiles(self, op=0.2):
 
@@ -1216,6 +1426,91 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
 
         return img_path, img_path_CT
 
+    def writeEmphysemaThumbnailsToFiles(self, CTNode, labelNode, numberOfSlices=5, axialSlices=None,
+                                        coronalSlices=None, op=0.5, outputFolder=None):
+        """ Write two png strips (axial and coronal) with emphysema overlay thumbnails of several slices.
+        When the slice indexes are not specified, numberOfSlices evenly spaced slices are taken in the
+        range where there is lung.
+        :param CTNode: CT volume
+        :param labelNode: lung labelmap
+        :param numberOfSlices: number of thumbnails in every strip when the slices are not specified
+        :param axialSlices: list of axial (K) slice indexes
+        :param coronalSlices: list of coronal (J) slice indexes
+        :param op: opacity of the emphysema overlay
+        :param outputFolder: folder where the images will be saved (default: temp folder)
+        :return: tuple with the paths of the axial and coronal strips
+        """
+        import numpy as np
+        # Numpy views of the volumes (zyx). No copies are made here
+        ct_arr = slicer.util.arrayFromVolume(CTNode)
+        label_arr = slicer.util.arrayFromVolume(labelNode)
+
+        if axialSlices is None:
+            axialSlices = self.__evenlySpacedLungSlices__(label_arr, 0, numberOfSlices)
+        if coronalSlices is None:
+            coronalSlices = self.__evenlySpacedLungSlices__(label_arr, 1, numberOfSlices)
+
+        # Axial thumbnails: (N, Y, X)
+        axial = self.emphysemaOverlayThumbnails(ct_arr[axialSlices], label_arr[axialSlices], op=op)
+        # Coronal thumbnails: (Z, N, X) => (N, Z, X) with the superior part on top
+        coronal = self.emphysemaOverlayThumbnails(np.moveaxis(ct_arr[:, coronalSlices], 1, 0)[:, ::-1],
+                                                  np.moveaxis(label_arr[:, coronalSlices], 1, 0)[:, ::-1], op=op)
+
+        if outputFolder is None:
+            import tempfile
+            outputFolder = tempfile.mkdtemp()
+        paths = []
+        for name, thumbnails in (("axial", axial), ("coronal", coronal)):
+            # Put all the thumbnails side by side in a single RGB image
+            n, h, w, c = thumbnails.shape
+            strip = thumbnails.transpose(1, 0, 2, 3).reshape(h, n * w, c)
+            path = os.path.join(outputFolder, "emphysema_{}_thumbnails.png".format(name))
+            sitk.WriteImage(sitk.GetImageFromArray(strip, isVector=True), path)
+            paths.append(path)
+        return tuple(paths)
+
+    @staticmethod
+    def __evenlySpacedLungSlices__(label_arr, axis, numberOfSlices):
+        """ Indexes of numberOfSlices evenly spaced slices (in the numpy axis) between the first and the last
+        slice that contain lung
+        """
+        import numpy as np
+        otherAxes = tuple(a for a in range(3) if a != axis)
+        lungSlices = np.flatnonzero(label_arr.any(axis=otherAxes))
+        if lungSlices.size == 0:
+            lungSlices = np.arange(label_arr.shape[axis])
+        # Skip the extremes of the lung, where there is almost no parenchyma
+        indexes = np.linspace(lungSlices[0], lungSlices[-1], numberOfSlices + 2)[1:-1]
+        return np.round(indexes).astype(np.intp)
+
+    @staticmethod
+    def emphysemaOverlayThumbnails(ct_slices, label_slices, op=0.5, threshold=-950, windowMinimum=-1200,
+                                   windowMaximum=200, color=(255, 51, 51)):
+        """ Window a stack of CT slices and blend in color the lung voxels below the emphysema threshold
+        :param ct_slices: numpy array (N, rows, cols) with the CT values
+        :param label_slices: numpy array (N, rows, cols) with the lung labelmap
+        :param op: opacity of the emphysema color
+        :param threshold: emphysema threshold (HU)
+        :param windowMinimum: minimum of the intensity window (HU)
+        :param windowMaximum: maximum of the intensity window (HU)
+        :param color: RGB color of the emphysema voxels
+        :return: numpy uint8 array (N, rows, cols, 3)
+        """
+        import numpy as np
+        if IntensityLUT.isSupported(ct_slices.dtype):
+            gray = IntensityLUT.window(windowMinimum, windowMaximum, inputDtype=ct_slices.dtype).apply(ct_slices)
+        else:
+            gray = np.clip(ct_slices, windowMinimum, windowMaximum).astype(np.float32)
+            gray -= windowMinimum
+            gray *= 255.0 / (windowMaximum - windowMinimum)
+
+        emphysema = (ct_slices < threshold) & (ct_slices >= -3000) & (label_slices > 0) & (label_slices < 512)
+
+        rgb = np.repeat(gray[..., np.newaxis], 3, axis=-1)
+        rgb[emphysema] *= (1.0 - op)
+        rgb[emphysema] += op * np.asarray(color, dtype=np.float32)
+        return rgb.astype(np.uint8)
+
 
 class Slicelet(object):
     """A slicer slicelet is a module widget that comes up in stand alone mode
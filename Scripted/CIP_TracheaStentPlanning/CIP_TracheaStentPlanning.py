@@ -6,12 +6,11 @@ import logging
 from collections import OrderedDict
 import time
 import numpy as np
-import SimpleITK as sitk
 import math
 import itertools
 
 from CIP.logic.SlicerUtil import SlicerUtil
-from CIP.logic import Util
+from CIP.logic import Util, VolumeBuffer, FastMarchingFronts
 
 #
 # CIP_TracheaStentPlanning
@@ -659,6 +658,14 @@ class CIP_TracheaStentPlanningLogic(ScriptedLoadableModuleLogic):
         self.currentLabelmapResults = None
         self.currentLabelmapResultsArray = None
         self.currentDistanceMean = 0  # Current base threshold that will be used to increase/decrease the scope of the segmentation
+        # Run the fast marching only in the region around the fiducials (see FastMarchingFronts)
+        self.segmentationROIMode = True
+        # Number of fast marching fronts that run concurrently (None: number of cpus)
+        self.segmentationNumThreads = None
+        # Fast marching fronts of the current volume (the speed map and the fronts of every seed are cached, so that
+        # only the fronts of the seeds that changed are computed again)
+        self.fastMarchingFronts = None
+        self.fastMarchingFrontsKey = None
 
         # 3D structures (replicated for every structure except in the case of the trachea)
         self.currentTracheaModel = None
@@ -845,89 +852,43 @@ class CIP_TracheaStentPlanningLogic(ScriptedLoadableModuleLogic):
 
         self.currentDistanceMean = (dd01 + dd02 + dd12) / 3
         if SlicerUtil.IsDevelopment: print(("DEBUG: preprocessing:", time.time() - start))
-        # Build the speed map for Fast Marching thresholding the original volume
-        activeVolumeArray = slicer.util.array(activeNode.GetID())
-        speedTest = (activeVolumeArray < -800).astype(np.int32)
-
-        # Create all the auxiliary nodes for results
+        # Run the fast marching filters from the 3 points (concurrently, every one with its own filter).
+        # Every front contributes with its "distance inverted" value (distance - value), and all of them are added
+        # in a single float32 buffer.
+        # In ROI mode every front only marches over the box around its seed that it can reach, and the results are
+        # stored in a compact volume that just covers the fiducials and the margin given by the distances between them
         t1 = time.time()
-        # lm01 = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_lm01")
-        # a01 = slicer.util.array(lm01.GetID())
-        # lm02 = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_lm02")
-        # a02 = slicer.util.array(lm02.GetID())
-        # lm12 = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_lm12")
-        # a12 = slicer.util.array(lm12.GetID())
-        dim = activeNode.GetImageData().GetDimensions()
-        shape = [dim[2], dim[1], dim[0]]
-        a01 = np.zeros(shape, np.int32)
-        a02 = np.zeros(shape, np.int32)
-        a12 = np.zeros(shape, np.int32)
+        # The cache is discarded when the volume or its voxels change
+        key = (activeNode.GetID(), activeNode.GetImageData().GetMTime())
+        if self.fastMarchingFronts is None or self.fastMarchingFrontsKey != key:
+            self.fastMarchingFronts = FastMarchingFronts(slicer.util.array(activeNode.GetID()), spacing,
+                                                         speedThreshold=-800)
+            self.fastMarchingFrontsKey = key
+        self.fastMarchingFronts.roiMode = self.segmentationROIMode
+        self.fastMarchingFronts.numThreads = self.segmentationNumThreads or (os.cpu_count() or 1)
+        box, results = self.fastMarchingFronts.run([(pos0, dd01), (pos2, dd02), (pos1, dd12)])
+        if SlicerUtil.IsDevelopment: print(("DEBUG: fast marching filters:", time.time() - t1))
+
         # Results of the algorithm
-        self.currentResultsNode = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_result", addToScene=True)
-        self.currentResultsArray = slicer.util.array(self.currentResultsNode.GetID())
+        t1 = time.time()
+        self.currentResultsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
+                                                                     activeNode.GetName() + "_result")
+        self.currentResultsNode.CopyOrientation(activeNode)
+        # Origin of the box (the RAS coordinates of its first voxel)
+        self.currentResultsNode.SetOrigin(Util.ijk_to_ras(activeNode, [box[2].start, box[1].start, box[0].start]))
+        VolumeBuffer.writeArray(self.currentResultsNode, results)
+        self.currentResultsArray = VolumeBuffer.arrayView(self.currentResultsNode)
         self.currentLabelmapResults = SlicerUtil.getLabelmapFromScalar(self.currentResultsNode,
                                                                        activeNode.GetName() + "_results_lm")
-        if SlicerUtil.IsDevelopment: print(("DEBUG: create aux nodes:", time.time() - t1))
-        # Create SimpleITK FastMarching filter with the thresholded original image as a speed map
-        sitkImage = sitk.GetImageFromArray(speedTest)
-        fastMarchingFilter = sitk.FastMarchingImageFilter()
-        sitkImage.SetSpacing(spacing)
-
-        # Run the fast marching filters from the 3 points.
-        # Every result array will contain the "distance inverted" value (distance - value) because we will add all the arrays
-        # Filter 01
-        t1 = time.time()
-        d = dd01
-        fastMarchingFilter.SetStoppingValue(d)
-        seeds = [pos0]
-        fastMarchingFilter.SetTrialPoints(seeds)
-        output = fastMarchingFilter.Execute(sitkImage)
-        outputArray = sitk.GetArrayFromImage(output)
-        # a01[:] = 0
-        temp = outputArray <= d
-        a01[temp] = d - outputArray[temp]
-        # lm01.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: filter 01:", time.time() - t1))
-
-        # Filter 02
-        t1 = time.time()
-        d = dd02
-        fastMarchingFilter.SetStoppingValue(d)
-        seeds = [pos2]
-        fastMarchingFilter.SetTrialPoints(seeds)
-        output = fastMarchingFilter.Execute(sitkImage)
-        outputArray = sitk.GetArrayFromImage(output)
-        # a02[:] = 0
-        temp = outputArray <= d
-        a02[temp] = d - outputArray[temp]
-        # lm02.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: filter 02:", time.time() - t1))
-
-        # Filter 12
-        t1 = time.time()
-        d = dd12
-        fastMarchingFilter.SetStoppingValue(d)
-        seeds = [pos1]
-        fastMarchingFilter.SetTrialPoints(seeds)
-        output = fastMarchingFilter.Execute(sitkImage)
-        outputArray = sitk.GetArrayFromImage(output)
-        # a12[:] = 0
-        temp = outputArray <= d
-        a12[temp] = d - outputArray[temp]
-        # lm12.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: filter 12:", time.time() - t1))
-
-        t1 = time.time()
-        # Sum the results of the 3 filters
-        self.currentResultsArray[:] = a01 + a02 + a12
-        self.currentResultsNode.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: processing results:", time.time() - t1))
+        if SlicerUtil.IsDevelopment: print(("DEBUG: create results nodes:", time.time() - t1))
 
         # Threshold to get the final labelmap
         t1 = time.time()
         self.thresholdFilter = vtk.vtkImageThreshold()
         self.thresholdFilter.SetInputData(self.currentResultsNode.GetImageData())
         self.thresholdFilter.SetReplaceOut(True)
+        # The fast marching results are float: the labelmap must be an integer volume
+        self.thresholdFilter.SetOutputScalarTypeToShort()
         self.thresholdFilter.SetOutValue(0)  # Value of the background
         self.thresholdFilter.SetInValue(1)  # Value of the segmented nodule
         self.thresholdFilter.ThresholdByUpper(self.currentDistanceMean)
@@ -6,7 +6,6 @@ import logging
 from collections import OrderedDict
 import time
 import numpy as np
-import SimpleITK as sitk
 import math
 import itertools
 
@@ -14,7 +13,7 @@ import scipy.optimize as scipy_opt
 import vtk.util.numpy_support as nc
 from CIP.logic.SlicerUtil import SlicerUtil
 
-from CIP.logic import Util
+from CIP.logic import Util, VolumeBuffer, FastMarchingFronts, MeshCrossSection, PolyDataGeometry
 
 
 #
@@ -704,6 +703,22 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         self.currentLabelmapResults = None
         self.currentLabelmapResultsArray = None
         self.currentDistanceMean = 0  # Current base threshold that will be used to increase/decrease the scope of the segmentation
+        # Run the fast marching only in the region around the fiducials (see FastMarchingFronts)
+        self.segmentationROIMode = True
+        # Number of fast marching fronts that run concurrently (None: number of cpus)
+        self.segmentationNumThreads = None
+        # The cross section fits of the automatic optimization hold the GIL, so by default they run one after another
+        # (no speedup). With optimizationUseProcesses they run in optimizationNumWorkers processes (None: number of
+        # cpus) forked from the Slicer process, only in Linux (see MeshCrossSection.fitSections)
+        self.optimizationNumWorkers = None
+        self.optimizationUseProcesses = False
+        # Maximum number of times per second that the cylinders are rendered during the optimization (None: always)
+        self.optimizationMaxFrameRate = 5
+        self.__lastOptimizationRender__ = 0
+        # Fast marching fronts of the current volume (the speed map and the fronts of every seed are cached, so that
+        # only the fronts of the seeds that changed are computed again)
+        self.fastMarchingFronts = None
+        self.fastMarchingFrontsKey = None
 
         # 3D structures (replicated for every structure except in the case of the trachea)
         self.currentTracheaModel = None
@@ -901,89 +916,43 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
 
         self.currentDistanceMean = (dd01 + dd02 + dd12) / 3
         if SlicerUtil.IsDevelopment: print(("DEBUG: preprocessing:", time.time() - start))
-        # Build the speed map for Fast Marching thresholding the original volume
-        activeVolumeArray = slicer.util.array(activeNode.GetID())
-        speedTest = (activeVolumeArray < -800).astype(np.int32)
-
-        # Create all the auxiliary nodes for results
+        # Run the fast marching filters from the 3 points (concurrently, every one with its own filter).
+        # Every front contributes with its "distance inverted" value (distance - value), and all of them are added
+        # in a single float32 buffer.
+        # In ROI mode every front only marches over the box around its seed that it can reach, and the results are
+        # stored in a compact volume that just covers the fiducials and the margin given by the distances between them
         t1 = time.time()
-        # lm01 = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_lm01")
-        # a01 = slicer.util.array(lm01.GetID())
-        # lm02 = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_lm02")
-        # a02 = slicer.util.array(lm02.GetID())
-        # lm12 = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_lm12")
-        # a12 = slicer.util.array(lm12.GetID())
-        dim = activeNode.GetImageData().GetDimensions()
-        shape = [dim[2], dim[1], dim[0]]
-        a01 = np.zeros(shape, np.int32)
-        a02 = np.zeros(shape, np.int32)
-        a12 = np.zeros(shape, np.int32)
+        # The cache is discarded when the volume or its voxels change
+        key = (activeNode.GetID(), activeNode.GetImageData().GetMTime())
+        if self.fastMarchingFronts is None or self.fastMarchingFrontsKey != key:
+            self.fastMarchingFronts = FastMarchingFronts(slicer.util.array(activeNode.GetID()), spacing,
+                                                         speedThreshold=-800)
+            self.fastMarchingFrontsKey = key
+        self.fastMarchingFronts.roiMode = self.segmentationROIMode
+        self.fastMarchingFronts.numThreads = self.segmentationNumThreads or (os.cpu_count() or 1)
+        box, results = self.fastMarchingFronts.run([(pos0, dd01), (pos2, dd02), (pos1, dd12)])
+        if SlicerUtil.IsDevelopment: print(("DEBUG: fast marching filters:", time.time() - t1))
+
         # Results of the algorithm
-        self.currentResultsNode = SlicerUtil.cloneVolume(activeNode, activeNode.GetName() + "_result", addToScene=True)
-        self.currentResultsArray = slicer.util.array(self.currentResultsNode.GetID())
+        t1 = time.time()
+        self.currentResultsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode",
+                                                                     activeNode.GetName() + "_result")
+        self.currentResultsNode.CopyOrientation(activeNode)
+        # Origin of the box (the RAS coordinates of its first voxel)
+        self.currentResultsNode.SetOrigin(Util.ijk_to_ras(activeNode, [box[2].start, box[1].start, box[0].start]))
+        VolumeBuffer.writeArray(self.currentResultsNode, results)
+        self.currentResultsArray = VolumeBuffer.arrayView(self.currentResultsNode)
         self.currentLabelmapResults = SlicerUtil.getLabelmapFromScalar(self.currentResultsNode,
                                                                        activeNode.GetName() + "_results_lm")
-        if SlicerUtil.IsDevelopment: print(("DEBUG: create aux nodes:", time.time() - t1))
-        # Create SimpleITK FastMarching filter with the thresholded original image as a speed map
-        sitkImage = sitk.GetImageFromArray(speedTest)
-        fastMarchingFilter = sitk.FastMarchingImageFilter()
-        sitkImage.SetSpacing(spacing)
-
-        # Run the fast marching filters from the 3 points.
-        # Every result array will contain the "distance inverted" value (distance - value) because we will add all the arrays
-        # Filter 01
-        t1 = time.time()
-        d = dd01
-        fastMarchingFilter.SetStoppingValue(d)
-        seeds = [pos0]
-        fastMarchingFilter.SetTrialPoints(seeds)
-        output = fastMarchingFilter.Execute(sitkImage)
-        outputArray = sitk.GetArrayFromImage(output)
-        # a01[:] = 0
-        temp = outputArray <= d
-        a01[temp] = d - outputArray[temp]
-        # lm01.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: filter 01:", time.time() - t1))
-
-        # Filter 02
-        t1 = time.time()
-        d = dd02
-        fastMarchingFilter.SetStoppingValue(d)
-        seeds = [pos2]
-        fastMarchingFilter.SetTrialPoints(seeds)
-        output = fastMarchingFilter.Execute(sitkImage)
-        outputArray = sitk.GetArrayFromImage(output)
-        # a02[:] = 0
-        temp = outputArray <= d
-        a02[temp] = d - outputArray[temp]
-        # lm02.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: filter 02:", time.time() - t1))
-
-        # Filter 12
-        t1 = time.time()
-        d = dd12
-        fastMarchingFilter.SetStoppingValue(d)
-        seeds = [pos1]
-        fastMarchingFilter.SetTrialPoints(seeds)
-        output = fastMarchingFilter.Execute(sitkImage)
-        outputArray = sitk.GetArrayFromImage(output)
-        # a12[:] = 0
-        temp = outputArray <= d
-        a12[temp] = d - outputArray[temp]
-        # lm12.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: filter 12:", time.time() - t1))
-
-        t1 = time.time()
-        # Sum the results of the 3 filters
-        self.currentResultsArray[:] = a01 + a02 + a12
-        self.currentResultsNode.GetImageData().Modified()
-        if SlicerUtil.IsDevelopment: print(("DEBUG: processing results:", time.time() - t1))
+        if SlicerUtil.IsDevelopment: print(("DEBUG: create results nodes:", time.time() - t1))
 
         # Threshold to get the final labelmap
         t1 = time.time()
         self.thresholdFilter = vtk.vtkImageThreshold()
         self.thresholdFilter.SetInputData(self.currentResultsNode.GetImageData())
         self.thresholdFilter.SetReplaceOut(True)
+        # The fast marching results are float: the labelmap must be an integer volume
+        self.thresholdFilter.SetOutputScalarTypeToShort()
         self.thresholdFilter.SetOutValue(0)  # Value of the background
         self.thresholdFilter.SetInValue(1)  # Value of the segmented nodule
         self.thresholdFilter.ThresholdByUpper(self.currentDistanceMean)
@@ -1122,6 +1091,8 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         """
         print ("DEBUG: automaticOptimizationYStent")
         trachea = self.buildTracheaButterflySubdivisionFilter(self.currentTracheaModel)
+        # The subdivided mesh is converted to numpy arrays just once for all the cross sections
+        tracheaSection = MeshCrossSection.fromPolyData(trachea.GetOutput())
         # First call. Start in user seed
 
 
@@ -1131,28 +1102,7 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         centroids = []
         norms = []
         rads = []
-        i=1
-        for point in points:
-            i=i+1
-            norm = [1, 0, 1]
-            cons = ({'type': 'eq', 'fun': lambda n: np.array(np.sqrt(sum((n[0:3]) ** 2)) - 1),
-                     'jac': lambda n: np.array(n[0:3] / np.sqrt(sum((n[0:3]) ** 2)))})
-            print(("DEBUG: automaticOptimizationYStent. Calling optimize with: ", point))
-            normal_vector = scipy_opt.minimize(self.cylinderSurfaceArea, norm, args=(point, trachea), constraints=cons,
-                                               method='SLSQP',
-                                               options={'disp': True})
-            inter = self.intersection(trachea, self.plane(normal_vector.x, point), point)
-            print(("DEBUG: automaticOptimizationYStent. Intersection: ", inter))
-            centr = self.centroide(self.polygon(inter))
-            print(("DEBUG: automaticOptimizationYStent. Centroid: ", centr))
-            rad = self.radius(centr, inter)
-            #rad = self.radius2(self.cylinderSurfaceArea(normal_vector.x, centr, trachea))
-            print(("DEBUG: automaticOptimizationYStent. Radius: ", rad))
-            norm = (normal_vector.x)
-            centroids.append(centr)
-            norms.append(norm)
-            rads.append(rad)
-            self.updateProgressBar(i)
+        self.__fitCrossSections__(tracheaSection, points, centroids, norms, rads, 1)
 
         # Second call. Calculate a plane close to the first one
 
@@ -1161,27 +1111,7 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         p32 = p3[0] + 8 * norms[2][0], p3[1] + 8 * norms[2][1], p3[2] + 8 * norms[2][2]
 
         points2 = [p12, p22, p32]
-        for point in points2:
-            i=i+1
-            norm = [1, 0, 1]
-            cons = ({'type': 'eq', 'fun': lambda n: np.array(np.sqrt(sum((n[0:3]) ** 2)) - 1),
-                     'jac': lambda n: np.array(n[0:3] / np.sqrt(sum((n[0:3]) ** 2)))})
-            print(("DEBUG: automaticOptimizationYStent. Calling optimize with: ", point))
-            normal_vector = scipy_opt.minimize(self.cylinderSurfaceArea, norm, args=(point, trachea), constraints=cons,
-                                               method='SLSQP',
-                                               options={'disp': True})
-            inter = self.intersection(trachea, self.plane(normal_vector.x, point), point)
-            print(("DEBUG: automaticOptimizationYStent. Intersection: ", inter))
-            centr = self.centroide(self.polygon(inter))
-            print(("DEBUG: automaticOptimizationYStent. Centroid: ", centr))
-            rad = self.radius(centr, inter)
-            #rad = self.radius2(self.cylinderSurfaceArea(normal_vector.x,centr, trachea))
-            print(("DEBUG: automaticOptimizationYStent. Radius: ", rad))
-            norm = (normal_vector.x)
-            centroids.append(centr)
-            norms.append(norm)
-            rads.append(rad)
-            self.updateProgressBar(i)
+        self.__fitCrossSections__(tracheaSection, points2, centroids, norms, rads, 4)
 
         mediumPoints = self.dist_ort(centroids)
         print("DEBUG: radios")
@@ -1197,7 +1127,8 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         c1 = centroids[0]
         c2 = centroids[1]
         c3 = centroids[2]
-        arguments = c1, c2, c3, trachea
+        # The points of the trachea are indexed just once for all the evaluations of the objective function
+        arguments = c1, c2, c3, self.buildTracheaPointsIndex(trachea)
         self.currentCentroids=c1,c2,c3
         self.progressBar.close()
         #self.progressBar = None
@@ -1256,6 +1187,7 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
                   'jac': lambda parameters: np.array([0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0])}
                  )
 
+        self.__lastOptimizationRender__ = 0
         res2 = scipy_opt.minimize(self.minimum, parameters, args=(arguments), constraints=cons2, method='SLSQP',
                                   options={'disp': True, 'ftol': 0.01, 'maxiter': 150}, callback=self.myfunc)
 
@@ -1269,15 +1201,54 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         qt.QMessageBox.information(slicer.util.mainWindow(), "The optimization is completed", "The optimization is completed, You can now change the stent position and radius.")
         return pointsVector, radiusVector
 
+    def __fitCrossSections__(self, tracheaSection, points, centroids, norms, rads, progressStep):
+        """
+        Fits the plane with the minimum cross section of the trachea through every point (the fits are independent,
+        so they can run in parallel processes, see MeshCrossSection.fitSections) and appends the results to the lists
+        :param tracheaSection: MeshCrossSection of the subdivided trachea
+        :param points: seeds of the planes
+        :param centroids: list where the centroids of the sections are appended
+        :param norms: list where the normal vectors are appended
+        :param rads: list where the radius are appended
+        :param progressStep: last step of the progress bar before the fits
+        """
+        if SlicerUtil.IsDevelopment:
+            for point in points:
+                print(("DEBUG: automaticOptimizationYStent. Calling optimize with: ", point))
+        finished = [progressStep]
+
+        def onFitFinished(index):
+            finished[0] += 1
+            self.updateProgressBar(finished[0])
+
+        results = tracheaSection.fitSections([(point, [1, 0, 1]) for point in points],
+                                             numWorkers=self.optimizationNumWorkers,
+                                             useProcesses=self.optimizationUseProcesses,
+                                             options={'disp': SlicerUtil.IsDevelopment},
+                                             callbackStepFunction=onFitFinished)
+        for norm, centr, rad in results:
+            if SlicerUtil.IsDevelopment:
+                print(("DEBUG: automaticOptimizationYStent. Centroid: ", centr))
+                print(("DEBUG: automaticOptimizationYStent. Radius: ", rad))
+            centroids.append(centr)
+            norms.append(norm)
+            rads.append(rad)
+
     def myfunc(self, params):
         """
-        Updates Cylinder values during the optimization process
+        Updates Cylinder values during the optimization process.
+        The views are refreshed at most optimizationMaxFrameRate times per second
         Args:
             params: Cylinder parameters (points and radius)
 
         Returns:
 
         """
+        if self.optimizationMaxFrameRate:
+            now = time.time()
+            if now - self.__lastOptimizationRender__ < 1.0 / self.optimizationMaxFrameRate:
+                return
+            self.__lastOptimizationRender__ = now
         pm1 = [params[1], params[2], params[3]]
         pm2 = [params[5], params[6], params[7]]
         pm3 = [params[9], params[10], params[11]]
@@ -1287,23 +1258,6 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         slicer.app.processEvents()
         SlicerUtil.refreshActiveWindows()
 
-    def cylinderSurfaceArea(self, norm_vector, point, tracheaFilter):
-        """
-        Calculate area of a cylinder based on a normal vector, a point and a butterfly subdivision filter
-        based on the current trachea model
-        :param norm_vector:
-        :param point:
-        :param tracheaFilter:
-        :return: area
-        """
-        plane = self.plane(norm_vector, point)
-        intersection = self.intersection(tracheaFilter, plane, point)
-        result = vtk.vtkPolyData()
-        result.SetPoints(intersection.GetOutput().GetPoints())
-        result.SetLines(intersection.GetOutput().GetCells())
-        return self.area(result, norm_vector)
-
-
     def buildTracheaButterflySubdivisionFilter(self, tracheaModel):
         """
         adds more points to the trachea segmentation
@@ -1318,91 +1272,6 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         tr2.Update()
         return tr2
 
-    def plane(self, N, p):
-        """
-        calculates the plane with N normal vector and point P
-        :param N: Normal vector
-        :param p: Point
-        :return: Plane
-        """
-        pp = vtk.vtkPlane()
-        pp.SetOrigin(p)
-        denominator = np.sqrt(sum((N[:]) ** 2))
-        v = np.zeros(3)
-        v[:] = (N[:] / denominator)
-        pp.SetNormal(v[0], v[1], v[2])
-        return pp
-
-    def intersection(self, tr, pp, p):
-        """
-        calculates the intersection between a plane and the trachea
-        :param tr: trachea
-        :param pp: plane
-        :param p: point
-        :return: intersection
-        """
-
-        ii = vtk.vtkCutter()
-        ii.SetCutFunction(pp)
-        ii.SetInputConnection(tr.GetOutputPort())
-
-        ii.Update()
-        n=ii.GetOutput().GetNumberOfPoints()
-
-        cc = vtk.vtkConnectivityFilter()
-        cc.SetInputConnection(ii.GetOutputPort())
-        cc.SetExtractionModeToClosestPointRegion()
-        cc.SetClosestPoint(p)
-        cc.Update()
-        return cc
-
-    def area(self, poly, n):
-        """
-        calculates the area of a polygon
-        :param poly: polygon
-        :param n: normal vector of the polygon
-        :return: area
-        """
-        aa = poly.GetLines()
-        aa.InitTraversal()
-        total = np.zeros(3, )
-        if poly.GetNumberOfPoints() == 0:
-            return 1000
-        for i in range(aa.GetNumberOfCells()):
-            p_idx = vtk.vtkIdList()
-            aa.GetNextCell(p_idx)
-            p1_idx = p_idx.GetId(0)
-            p2_idx = p_idx.GetId(1)
-            p1 = np.array(poly.GetPoints().GetPoint(p1_idx))
-            p2 = np.array(poly.GetPoints().GetPoint(p2_idx))
-            total = total + np.cross(p1, p2)
-        result = np.dot(total, n / np.linalg.norm(n))
-        Result = abs(result / 2)
-        return Result
-
-    def centroide(self, intersection):
-        """
-        calculates the centroid of the intersection
-        :param intersection
-        :return: centroid
-        """
-        centroid = (sum(intersection[:]) / len(intersection))
-        return centroid
-
-    def radius(self, centroid, curve):
-        """
-        calculates the radius of the biggest circle inside a curve
-        :param centroid:
-        :param curve:
-        :return: radius
-        """
-        loc = vtk.vtkPointLocator()
-        loc.SetDataSet(curve.GetOutput())
-        loc.BuildLocator()
-        Idclosest = loc.FindClosestPoint(centroid)
-        closest = np.array(curve.GetOutput().GetPoints().GetPoint(Idclosest))
-        radius = np.sqrt(np.sum((closest[0:3] - centroid[0:3]) ** 2))
-        return radius
     def radius2(self, area):
         """
         Not used. Calculates the equivalent radius of a determined area.
@@ -1414,19 +1283,6 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         """
         return np.sqrt(area/np.pi)
 
-    def polygon(self, intersection):
-        """
-        creates a polygon with the data of an intersection
-        :param intersection:
-        :return: polygon
-        """
-
-        polygon = np.zeros([intersection.GetOutput().GetNumberOfPoints(), 3])
-        for i in range(intersection.GetOutput().GetNumberOfPoints()):
-            polygon[i] = intersection.GetOutput().GetPoints().GetPoint(i)
-        return polygon
-
-
     def dist_ort(self, centroids):
         """
         calculates the medium points of the 3 cylinders
@@ -1549,22 +1405,25 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         variables[11] = mediumPoints[2][2]
         return variables
 
+    def buildTracheaPointsIndex(self, tracheaFilter):
+        """
+        builds the index of the points of the trachea, that is used to find the closest trachea points to the cylinders
+        :param tracheaFilter: butterfly subdivision filter of the trachea (see buildTracheaButterflySubdivisionFilter)
+        :return: PolyDataGeometry (its kd-tree is built just once)
+        """
+        geometry = PolyDataGeometry(tracheaFilter.GetOutput())
+        geometry.buildTree()
+        return geometry
+
     def homologous(self, traq, p_cil):
         """
         calculates the points of the trachea that correspond to the given points of the cylinder
-        :param traq: trachuea
-        :param p_cil: cylinder points
-        :return: trachea points
+        :param traq: PolyDataGeometry of the trachea (see buildTracheaPointsIndex)
+        :param p_cil: cylinder points (numpy array Nx3)
+        :return: trachea points (numpy array Nx3)
         """
-        loc = vtk.vtkPointLocator()
-        loc.SetDataSet(traq.GetOutput())
-        loc.BuildLocator()
-        vector = vtk.vtkPoints()
-        for i in range(len(p_cil)):
-            d = loc.FindClosestPoint(p_cil[i])
-            res = traq.GetOutput().GetPoints().GetPoint(d)
-            vector.InsertNextPoint(res)
-        return vector
+        # All the points are queried at once
+        return traq.closestPointsCoordinates(p_cil)
 
     def functional(self, cil1, cil2, cil3, hom1, hom2, hom3):
         """
@@ -1577,26 +1436,16 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         :param hom3: right bronchi points
         :return: distances
         """
-        suma = 0
-        for i in range(len(cil1)):
-            punto = hom1.GetPoint(i)
-            cilind = cil1[i]
-            suma = suma + (np.sqrt(np.sum((punto[0:2] - cilind[0:2]) ** 2)))
-        for i in range(len(cil2)):
-            punto = hom2.GetPoint(i)
-            cilind = cil2[i]
-            suma = suma + (np.sqrt(np.sum((punto[0:2] - cilind[0:2]) ** 2)))
-        for i in range(len(cil3)):
-            punto = hom3.GetPoint(i)
-            cilind = cil3[i]
-            suma = suma + (np.sqrt(np.sum((punto[0:2] - cilind[0:2]) ** 2)))
-        return suma
+        cil = np.concatenate((cil1, cil2, cil3))
+        hom = np.concatenate((hom1, hom2, hom3))
+        return np.sum(np.sqrt(np.sum((hom[:, 0:2] - cil[:, 0:2]) ** 2, axis=1)))
 
     def minimum(self, parameters, centroid1, centroid2, centroid3, traq):
         """
         calculates the medium square error of the distances between cylinder and trachea
         :param parameters: initial parameters (points and radius)
         :param centroids: centroids
+        :param traq: PolyDataGeometry of the trachea (see buildTracheaPointsIndex)
         :return: error
         """
         pm2 = [0, 0, 0]
@@ -1630,10 +1479,10 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         points_cil1 = self.cylinder(centroid1, pm1, rad1, ll1, ff)
         points_cil2 = self.cylinder(centroid2, pm2, rad2, ll2, ff)
         points_cil3 = self.cylinder(centroid3, pm3, rad3, ll3, ff)
-        hom1 = self.homologous(traq, points_cil1)
-        hom2 = self.homologous(traq, points_cil2)
-        hom3 = self.homologous(traq, points_cil3)
-        error = self.functional(points_cil1, points_cil2, points_cil3, hom1, hom2, hom3)
+        # Single query for the points of the 3 cylinders
+        hom = self.homologous(traq, np.concatenate((points_cil1, points_cil2, points_cil3)))
+        n1, n2 = len(points_cil1), len(points_cil1) + len(points_cil2)
+        error = self.functional(points_cil1, points_cil2, points_cil3, hom[:n1], hom[n1:n2], hom[n2:])
         return error
 
     def updateCylindersRadius(self, stentKey, newRadius1, newRadius2, newRadius3):